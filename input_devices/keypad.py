@@ -1,24 +1,41 @@
 import threading
 import logging
-import RPi.GPIO as gpio
+import pigpio
 from queue import Queue
 import time
 
+#Key labels by row and column
+KEYPAD_LAYOUT = [["1", "2", "3"],
+                 ["4", "5", "6"],
+                 ["7", "8", "9"],
+                 ["star", "0", "pound"]]
+
 class keypad:
-    #This keypad function is meant to be called every 10 ms (or so) as the other keypad function wasn't working properly
-    #Still not sure why the other one doesn't work well tbh
     """
     Description:
     This class supports a DIY keypad with 12 keys, 7 pins
-    This class is a way to do this by continuously polling the keypad GPIO inputs to see if there has been a
-    button press. To do this, it launches its own thread, and then commmunicates with the parent via the
-    threading.Event() class
-    
+    It scans the keypad on its own thread at scan_hz. All the rows are held high,
+    so one pigpio bank read shows whether any key is down. Only then is each row
+    driven high in turn, with all the columns read at once by a single bank read.
+    Every pigpio call is a round-trip to the daemon (roughly 50-100 us of CPU on a
+    Pi), so an idle scan costs 1 round-trip and a scan with a key down costs
+    3 + 3 per row (15 for this keypad). At the default 50 Hz that is 50 round-trips
+    a second while idle. Raising scan_hz costs CPU in proportion, and the debounce
+    time is debounce_scans / scan_hz. Every
+    key has its own debounce counter, which counts up while the key reads pressed
+    and down while it reads released; the key only changes state when the counter
+    reaches debounce_scans or 0. The keys are independent, so several keys can be
+    held at the same time (n-key rollover, within the limits of a matrix without
+    diodes). Nothing in the scan sleeps except the wait for the next scan, and the
+    thread exits as soon as stop_thread() is called.
+
     Usage:
     keypad_handle = keypad(keypad_gpio_defs)
-    Then, you need to periodically check the queue (about every 10ms) and pop the button presses
+    Then, you need to periodically check the queue (about every 10ms) and pop the key events
     if not keypad_handle.keypad_queue.empty():
-       button_that_was_pressed = keypad_handle.keypad_queue.get()
+       key, event, timestamp = keypad_handle.keypad_queue.get()
+    event is 'press', 'release' or 'hold' (sent once when a key has been held for
+    hold_seconds), timestamp is the time.monotonic() of the scan that saw it
 
     Inputs:
     pin_dict - a dictionary that defines the RPi outputs connected to the keypad
@@ -32,24 +49,48 @@ class keypad:
                         'col2':20,
                         'col3':16
                     }
+    scan_hz - number of keypad scans per second, see above for the cost
+    debounce_scans - number of scans a key has to read the same for its state to change
+    hold_seconds - time a key has to be held down for a 'hold' event
+    thread_init_function - The pointer to a function to run at the start of the
+                           scan thread, e.g. realtime.enable_thread. None to skip it.
 
     Outputs:
     None
     """
 
-    def __init__(self, pin_dict):
+    def __init__(self, pin_dict, scan_hz=50, debounce_scans=2, hold_seconds=1.0, thread_init_function=None):
         """
         Description:
         Initialization of the keypad class
         
         Inputs:
         pin_dict - see class def
+        scan_hz - see class def
+        debounce_scans - see class def
+        hold_seconds - see class def
+        thread_init_function - see class def
 
         Outputs:
         None
         """
 
         self.pin_dict = pin_dict
+        self.scan_hz = scan_hz
+        self.debounce_scans = debounce_scans
+        self.hold_seconds = hold_seconds
+        self.thread_init_function = thread_init_function
+        self.rows = [pin_dict[f'row{num}'] for num in range(1, len(KEYPAD_LAYOUT) + 1)]
+        self.cols = [pin_dict[f'col{num}'] for num in range(1, len(KEYPAD_LAYOUT[0]) + 1)]
+        self.row_mask = sum(1 << row for row in self.rows)
+        self.col_mask = sum(1 << col for col in self.cols)
+
+        #Debounce state for every key, indexed [row][col]
+        self.counters = [[0] * len(self.cols) for _ in self.rows]
+        self.pressed = [[False] * len(self.cols) for _ in self.rows]
+        self.press_times = [[0.0] * len(self.cols) for _ in self.rows]
+        self.hold_sent = [[False] * len(self.cols) for _ in self.rows]
+
         self.keypad_queue = Queue()
         self._setup_gpios()
         self.stop_flag = threading.Event()
@@ -99,18 +140,41 @@ class keypad:
         None
         """
 
-        gpio.setup(self.pin_dict['row1'], gpio.OUT)
-        gpio.setup(self.pin_dict['row2'], gpio.OUT)
-        gpio.setup(self.pin_dict['row3'], gpio.OUT)
-        gpio.setup(self.pin_dict['row4'], gpio.OUT)
-        gpio.setup(self.pin_dict['col1'], gpio.IN, pull_up_down=gpio.PUD_DOWN)
-        gpio.setup(self.pin_dict['col2'], gpio.IN, pull_up_down=gpio.PUD_DOWN)
-        gpio.setup(self.pin_dict['col3'], gpio.IN, pull_up_down=gpio.PUD_DOWN)
+        self.pi = pigpio.pi()
+        for row in self.rows:
+            self.pi.set_mode(row, pigpio.OUTPUT)
+        #Rows are held high between scans, so a single read shows any key that is down
+        self.pi.set_bank_1(self.row_mask)
+        for col in self.cols:
+            self.pi.set_mode(col, pigpio.INPUT)
+            self.pi.set_pull_up_down(col, pigpio.PUD_DOWN)
+
+    def _scan_rows(self):
+        """
+        Description:
+        Drives the rows high one at a time and reads the columns for each, then
+        drives them all high again
+        
+        Inputs:
+        None
+
+        Outputs:
+        banks - list of the bank 1 reads, one per row
+        """
+
+        banks = []
+        self.pi.clear_bank_1(self.row_mask)
+        for row in self.rows:
+            self.pi.set_bank_1(1 << row)
+            banks.append(self.pi.read_bank_1())
+            self.pi.clear_bank_1(1 << row)
+        self.pi.set_bank_1(self.row_mask)
+        return banks
 
     def _keypad_loop(self):
         """
         Description:
-        Checks to see if a button was pressed, row by row using the _check_line() function
+        Scans the keypad scan_hz times per second until stop_thread() is called
         
         Inputs:
         None
@@ -119,101 +183,145 @@ class keypad:
         None
         """
 
-        while(True):
-            self._check_line(self.pin_dict['row1'], ["1","2","3"])
-            self._check_line(self.pin_dict['row2'], ["4","5","6"])
-            self._check_line(self.pin_dict['row3'], ["7","8","9"])
-            self._check_line(self.pin_dict['row4'], ["star","0","pound"])
-            time.sleep(0.05)
-
-    def _check_line(self, row, characters):
+        if self.thread_init_function is not None:
+            self.thread_init_function("keypad")
+        scan_period = 1.0 / self.scan_hz
+        next_scan = time.monotonic()
+        while not self.stop_flag.is_set():
+            now = time.monotonic()
+            bank = self.pi.read_bank_1()
+            if bank & self.col_mask:
+                banks = self._scan_rows()
+            else:
+                #No column is high with every row driven, so every key reads released
+                banks = [bank] * len(self.rows)
+            for row_num, row_bank in enumerate(banks):
+                self._check_line(row_num, row_bank, now)
+            next_scan += scan_period
+            if next_scan < now:
+                #Fell behind (e.g. the thread was descheduled), don't try to catch up
+                next_scan = now + scan_period
+            self.stop_flag.wait(next_scan - time.monotonic())
+
+    def _check_line(self, row_num, bank, now):
         """
         Description:
-        Checks to see if a button was pressed for a specific column. If so, puts that button in the
-        keypad_queue
+        Steps the debounce state machine of each key on one row of the keypad,
+        putting any press, release or hold in the keypad_queue
         
         Inputs:
-        row - the RPi gpio number of the row to check
-        characters - the label of the characters in that row, ex. row 2 = [4,5,6]
+        row_num - index of the row in KEYPAD_LAYOUT
+        bank - bank 1 read taken with only this row driven high
+        now - time.monotonic() of this scan
 
         Outputs:
         None
         """
 
-        gpio.output(row, gpio.HIGH)
-        time.sleep(0.01)
-        if gpio.input(self.pin_dict['col1']) == 1:
-            print("col1")
-            self.keypad_queue.put(characters[0])
-            time.sleep(0.3)
-        elif gpio.input(self.pin_dict['col2']) == 1:
-            print("col2")
-            self.keypad_queue.put(characters[1])
-            time.sleep(0.3)
-        elif gpio.input(self.pin_dict['col3']) == 1:
-            print("col3")
-            self.keypad_queue.put(characters[2])
-            time.sleep(0.3)
-        gpio.output(row, gpio.LOW)
+        counters = self.counters[row_num]
+        pressed = self.pressed[row_num]
+        for col_num, col in enumerate(self.cols):
+            if (bank >> col) & 1:
+                counters[col_num] = min(counters[col_num] + 1, self.debounce_scans)
+            else:
+                counters[col_num] = max(counters[col_num] - 1, 0)
+
+            key = KEYPAD_LAYOUT[row_num][col_num]
+            if not pressed[col_num] and counters[col_num] == self.debounce_scans:
+                pressed[col_num] = True
+                self.press_times[row_num][col_num] = now
+                self.hold_sent[row_num][col_num] = False
+                self.keypad_queue.put((key, 'press', now))
+            elif pressed[col_num] and counters[col_num] == 0:
+                pressed[col_num] = False
+                self.keypad_queue.put((key, 'release', now))
+            elif (pressed[col_num] and not self.hold_sent[row_num][col_num]
+                  and now - self.press_times[row_num][col_num] >= self.hold_seconds):
+                self.hold_sent[row_num][col_num] = True
+                self.keypad_queue.put((key, 'hold', now))
 
     def stop_thread(self):
+        """
+        Description:
+        Stops the scan thread and releases pigpio
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
         self.stop_flag.set()
         self.keypad_thread.join()
+        if self.pi is not None:
+            self.pi.stop()
+            self.pi = None
 
-class keypad2:
+class keypad_irq:
     """
-    ***NOTE: THIS IS NOT WORKING***
-
     Description:
     This class supports a DIY keypad with 12 keys, 7 pins
-    This class is a way to do this by setting interrupts with gpio.add_event_detect(). However,
-    after extensive testing, it was determined that this does not work properly for some reason.
-    
+    Interrupt driven version of keypad, it uses no CPU while no key is touched.
+    All the rows are driven high and pigpio reports the column edges, with the
+    hardware glitch filter throwing away anything shorter than glitch_us and a
+    microsecond tick for every edge. A rising column edge triggers one fast scan
+    that drives the rows one at a time to find which row the key is on. The edges
+    the scan itself causes on the column are recognized by their ticks and ignored.
+    A falling edge is the release, and a pigpio watchdog on the column reports a
+    key still held after hold_seconds. Only one key per column is tracked at a time.
+    This replaces keypad2, which used gpio.add_event_detect() and never worked.
+
     Usage:
-    keypad_handle = keypad(keypad_gpio_defs, keypad_btn_decode)
-    After this, the function should just call the callback function when a button is pressed.
+    keypad_handle = keypad_irq(keypad_gpio_defs)
+    Then, check the queue the same way as for keypad
+    if not keypad_handle.keypad_queue.empty():
+       key, event, timestamp = keypad_handle.keypad_queue.get()
 
     Inputs:
-    pin_dict - a dictionary that defines the RPi outputs connected to the keypad
-                Formatting:
-                keypad_gpio_defs = {
-                        'row1':26,
-                        'row2':19,
-                        'row3':13,
-                        'row4':6,
-                        'col1':21,
-                        'col2':20,
-                        'col3':16
-                    }
-    callback_function - function from parent to be called when a keypress is detected
+    pin_dict - a dictionary that defines the RPi outputs connected to the keypad,
+               see keypad
+    glitch_us - microseconds a column has to be stable for an edge to be reported
+    hold_seconds - time a key has to be held down for a 'hold' event
 
     Outputs:
     None
     """
 
-    def __init__(self, pin_dict, callback_function):
+    def __init__(self, pin_dict, glitch_us=5000, hold_seconds=1.0):
         """
         Description:
-        Initialization of the keypad class
+        Initialization of the keypad_irq class
         
         Inputs:
         pin_dict - see class def
-        callback_function - see class def
+        glitch_us - see class def
+        hold_seconds - see class def
 
         Outputs:
         None
         """
 
         self.pin_dict = pin_dict
-        self.callback_function = callback_function
+        self.glitch_us = glitch_us
+        self.hold_seconds = hold_seconds
+        self.rows = [pin_dict[f'row{num}'] for num in range(1, len(KEYPAD_LAYOUT) + 1)]
+        self.cols = [pin_dict[f'col{num}'] for num in range(1, len(KEYPAD_LAYOUT[0]) + 1)]
+        self.row_mask = sum(1 << row for row in self.rows)
         self.keypad_queue = Queue()
-        self.setup_gpios()
-        logging.info(f"Keypad initialized successfully")
 
-    def setup_gpios(self):
+        #Key currently down on each column, and the ticks of the last row scan
+        self.active_keys = {}
+        self.scan_start_tick = 0
+        self.scan_end_tick = 0
+
+        self._setup_gpios()
+        logging.info(f"Keypad (interrupt driven) initialized successfully")
+
+    def __del__(self):
         """
         Description:
-        Initialization the Rpi GPIOs using the pin_dict dictionary from __init__()
+        Destructor for the class - ensures the callbacks are cancelled if the process is killed
         
         Inputs:
         None
@@ -222,32 +330,13 @@ class keypad2:
         None
         """
 
-        #Setup the GPIO directions and pullups
-        gpio.setup(self.pin_dict['row1'], gpio.OUT)
-        gpio.setup(self.pin_dict['row2'], gpio.OUT)
-        gpio.setup(self.pin_dict['row3'], gpio.OUT)
-        gpio.setup(self.pin_dict['row4'], gpio.OUT)
-        gpio.setup(self.pin_dict['col1'], gpio.IN, pull_up_down=gpio.PUD_DOWN)
-        gpio.setup(self.pin_dict['col2'], gpio.IN, pull_up_down=gpio.PUD_DOWN)
-        gpio.setup(self.pin_dict['col3'], gpio.IN, pull_up_down=gpio.PUD_DOWN)
-
-        #Turn on the GPIOs
-        gpio.output(self.pin_dict['row1'], gpio.HIGH)
-        gpio.output(self.pin_dict['row2'], gpio.HIGH)
-        gpio.output(self.pin_dict['row3'], gpio.HIGH)
-        gpio.output(self.pin_dict['row4'], gpio.HIGH)
-        time.sleep(1)
-
-        #Initialize keypress variable
-        self.keypress_active = False
-
-        #Add interrupt sequences
-        self.add_event_detects()
-
-    def add_event_detects(self):
+        self.stop_thread()
+
+    def _setup_gpios(self):
         """
         Description:
-        Adds event interrupts for each of the input pins
+        Initialization the Rpi GPIOs using the pin_dict dictionary from __init__(),
+        and registers the column edge callbacks
         
         Inputs:
         None
@@ -256,129 +345,104 @@ class keypad2:
         None
         """
 
-        gpio.add_event_detect(self.pin_dict['col1'], gpio.RISING, bouncetime=200, callback=self.keypad_column_func)
-        gpio.add_event_detect(self.pin_dict['col2'], gpio.RISING, bouncetime=200, callback=self.keypad_column_func)
-        gpio.add_event_detect(self.pin_dict['col3'], gpio.RISING, bouncetime=200, callback=self.keypad_column_func)
-        logging.info("Added button event interrupts for keypad")
-
-    def reset_row_gpios(self):
+        self.pi = pigpio.pi()
+        for row in self.rows:
+            self.pi.set_mode(row, pigpio.OUTPUT)
+        self.pi.set_bank_1(self.row_mask)
+        self.callbacks = []
+        for col in self.cols:
+            self.pi.set_mode(col, pigpio.INPUT)
+            self.pi.set_pull_up_down(col, pigpio.PUD_DOWN)
+            self.pi.set_glitch_filter(col, self.glitch_us)
+            self.callbacks.append(self.pi.callback(col, pigpio.EITHER_EDGE, self._on_edge))
+
+    def _timestamp(self, tick):
         """
         Description:
-        Resets the GPIOs to their initial state, ready to detect another press
+        Converts a pigpio tick to time.monotonic()
         
         Inputs:
-        None
+        tick - pigpio tick of the edge, in microseconds
 
         Outputs:
-        None
+        timestamp - time.monotonic() of the edge
         """
 
-        #Turn on the GPIOs
-        gpio.output(self.pin_dict['row1'], gpio.HIGH)
-        gpio.output(self.pin_dict['row2'], gpio.HIGH)
-        gpio.output(self.pin_dict['row3'], gpio.HIGH)
-        gpio.output(self.pin_dict['row4'], gpio.HIGH)
-        logging.debug("Turned all the row gpio outputs back on")
+        return time.monotonic() - pigpio.tickDiff(tick, self.pi.get_current_tick()) / 1e6
 
-    def keypad_column_func(self, gpionum):
+    def _find_row(self, col):
         """
         Description:
-        Decodes the keypress and passes that information to the callback function from __init__()
+        Drives the rows high one at a time to find the row of the key pressed on a
+        column, then drives them all high again
         
         Inputs:
-        None
+        col - the RPi gpio number of the column
 
         Outputs:
-        None
+        row_num - index of the row in KEYPAD_LAYOUT, or None if the key was let go
         """
 
-        #Turn off the interrupt sequences
-        #self.remove_event_detects() Removed because I think this is causing segfaults, instead added keypress_active variable
-        if self.keypress_active:
-            return
-        self.keypress_active = True
-        colname = self.get_colnum_from_gpio(gpionum)
-        colnum = int(colname[-1])
-        logging.debug(f'gpionum = {gpionum}')
-        logging.debug(f'colname = {colname}')
-        logging.debug(f'colnum = {colnum}')
+        self.scan_start_tick = self.pi.get_current_tick()
+        found = None
+        self.pi.clear_bank_1(self.row_mask)
+        for row_num, row in enumerate(self.rows):
+            self.pi.set_bank_1(1 << row)
+            bank = self.pi.read_bank_1()
+            self.pi.clear_bank_1(1 << row)
+            if (bank >> col) & 1:
+                found = row_num
+                break
+        self.pi.set_bank_1(self.row_mask)
+        self.scan_end_tick = self.pi.get_current_tick()
+        return found
+
+    def _on_edge(self, gpio_num, level, tick):
+        """
+        Description:
+        pigpio callback for the column edges and watchdog timeouts. Runs on the
+        pigpio callback thread.
         
-        #Is it row 1?
-        gpio.output(self.pin_dict['row1'], gpio.LOW)
-        if gpio.input(self.pin_dict[colname]) == 0:
-            logging.debug("Detected a row1 press")
-            self.reset_row_gpios()
-            if colnum == 1:
-                self.callback_function('1')
-            elif colnum == 2:
-                self.callback_function('2')
-            elif colnum == 3:
-                self.callback_function('3')
-            else:
-                logging.debug("Unable to determine the button from a row1 press")
-            time.sleep(0.5)
-            self.keypress_active = False
-            return
+        Inputs:
+        gpio_num - the column that changed
+        level - 1 for a rising edge, 0 for a falling edge, pigpio.TIMEOUT for the watchdog
+        tick - pigpio tick of the edge
 
-        #Is it row 2?
-        gpio.output(self.pin_dict['row2'], gpio.LOW)
-        if gpio.input(self.pin_dict[colname]) == 0:
-            logging.debug("Detected a row2 press")
-            self.reset_row_gpios()
-            if colnum == 1:
-                self.callback_function('4')
-            elif colnum == 2:
-                self.callback_function('5')
-            elif colnum == 3:
-                self.callback_function('6')
-            else:
-                logging.debug("Unable to determine the button from a row2 press")
-            time.sleep(0.5)
-            self.keypress_active = False
-            return
+        Outputs:
+        None
+        """
 
-        #Is it row 3?
-        gpio.output(self.pin_dict['row3'], gpio.LOW)
-        if gpio.input(self.pin_dict[colname]) == 0:
-            logging.debug("Detected a row3 press")
-            self.reset_row_gpios()
-            if colnum == 1:
-                self.callback_function('7')
-            elif colnum == 2:
-                self.callback_function('8')
-            elif colnum == 3:
-                self.callback_function('9')
-            else:
-                logging.debug("Unable to determine the button from a row3 press")
-            time.sleep(0.5)
-            self.keypress_active = False
+        #Edges caused by the row scan, these can be seen a little after it finished
+        if pigpio.tickDiff(self.scan_start_tick, tick) <= pigpio.tickDiff(self.scan_start_tick, self.scan_end_tick):
             return
-        
-        #Is it row 4?
-        gpio.output(self.pin_dict['row4'], gpio.LOW)
-        if gpio.input(self.pin_dict[colname]) == 0:
-            logging.debug("Detected a row4 press")
-            self.reset_row_gpios()
-            if colnum == 1:
-                self.callback_function('star')
-            elif colnum == 2:
-                self.callback_function('0')
-            elif colnum == 3:
-                self.callback_function('pound')
-            else:
-                logging.debug("Unable to determine the button from a row4 press")
-            time.sleep(0.5)
-            self.keypress_active = False
-            return
-        
-        time.sleep(0.5)
-        self.keypress_active = False
-        logging.debug("Unable to find what row triggered the button")
+        col_num = self.cols.index(gpio_num)
+        if level == pigpio.TIMEOUT:
+            self.pi.set_watchdog(gpio_num, 0)
+            key = self.active_keys.get(gpio_num)
+            if key is not None:
+                self.keypad_queue.put((key, 'hold', self._timestamp(tick)))
+        elif level == 1:
+            if gpio_num in self.active_keys:
+                return
+            row_num = self._find_row(gpio_num)
+            if row_num is None:
+                logging.debug("Unable to find what row triggered the button")
+                return
+            key = KEYPAD_LAYOUT[row_num][col_num]
+            self.active_keys[gpio_num] = key
+            self.pi.set_watchdog(gpio_num, int(self.hold_seconds * 1000))
+            self.keypad_queue.put((key, 'press', self._timestamp(tick)))
+        else:
+            self.pi.set_watchdog(gpio_num, 0)
+            key = self.active_keys.pop(gpio_num, None)
+            if key is not None:
+                self.keypad_queue.put((key, 'release', self._timestamp(tick)))
 
-    def get_colnum_from_gpio(self, gpionum):
+    def stop_thread(self):
         """
         Description:
-        Returns the column number from the gpio that was pressed
+        Cancels the callbacks and releases pigpio. Named like keypad.stop_thread()
+        so the two are interchangeable, there is no thread of our own.
         
         Inputs:
         None
@@ -387,6 +451,11 @@ class keypad2:
         None
         """
 
-        for key in self.pin_dict:
-            if self.pin_dict[key] == gpionum:
-                return key
+        if self.pi is None:
+            return
+        for callback in self.callbacks:
+            callback.cancel()
+        for col in self.cols:
+            self.pi.set_watchdog(col, 0)
+        self.pi.stop()
+        self.pi = None
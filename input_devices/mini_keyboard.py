@@ -24,13 +24,16 @@ class mini_keyboard:
 
     Usage:
         kb = mini_keyboard("USB Composite Device Keyboard")
+        An optional thread_init_function is run at the start of every reader thread, e.g. to
+        give it realtime priority.
         if not kb.keypad_queue.empty():
             btn = kb.keypad_queue.get()
             # process btn (e.g. "R2C3" or "dial_left_up")
     """
 
-    def __init__(self, device_name_filter="USB Composite Device Keyboard"):
+    def __init__(self, device_name_filter="USB Composite Device Keyboard", thread_init_function=None):
         self.keypad_queue = Queue()
+        self.thread_init_function = thread_init_function
         self.stop_flag = threading.Event()
         self.threads = []
         self.devices = []
@@ -53,6 +56,8 @@ class mini_keyboard:
             self.threads.append(t)
 
     def _event_loop(self, device):
+        if self.thread_init_function is not None:
+            self.thread_init_function("mini_keyboard")
         for event in device.read_loop():
             if self.stop_flag.is_set():
                 break
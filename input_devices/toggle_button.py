@@ -1,39 +1,76 @@
-import RPi.GPIO as gpio
 import threading
 import logging
+import os
+import fcntl
+import select
+import struct
 import time
 from queue import Queue
 
+#Linux GPIO character device ABI v1, see linux/gpio.h
+GPIO_GET_LINEEVENT_IOCTL = 0xC030B404
+GPIOHANDLE_GET_LINE_VALUES_IOCTL = 0xC040B408
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+GPIOHANDLE_REQUEST_BIAS_PULL_UP = 1 << 5
+GPIOEVENT_REQUEST_BOTH_EDGES = (1 << 0) | (1 << 1)
+GPIOEVENT_EVENT_RISING_EDGE = 0x01
+#struct gpioevent_request: lineoffset, handleflags, eventflags, consumer_label[32], fd
+GPIOEVENT_REQUEST = struct.Struct("=III32si")
+#struct gpioevent_data: timestamp (ns), id, padded to 16 bytes
+GPIOEVENT_DATA = struct.Struct("=QI4x")
+GPIOHANDLE_DATA_SIZE = 64
+
 class toggle_button:
     """
     Description:
     #This function is meant to report when a button is pressed. Connect your button to the gpio given in
     #__init__ and gnd.
-    
+    The button is read through the Linux GPIO character device: the kernel watches
+    both edges of the line (with its pull-up turned on) and hands over every edge
+    with its own CLOCK_MONOTONIC timestamp (Linux 5.7+, the pull-up needs 5.5+).
+    A thread blocks in select() on the line until the next edge or the next
+    deadline, so nothing is polled. A level only
+    counts once it has been stable for debounce_ms, measured on the kernel
+    timestamps, so the latency is the debounce window. The debounced presses are
+    sorted into:
+      click - a short press with no second press within double_click_ms
+      double_click - two short presses within double_click_ms
+      long_press - held for long_press_ms, sent while the button is still down
+
     Usage:
     button_handle = toggle_button(gpio_number, button_type)
-    Then, you need to periodically check the queue (about every 10ms) and pop the button presses
-    if not button_handle.button_queue.empty():
-       keypad_handle.keypad_queue.get()
+    Then, you need to periodically check the queue (about every 10ms) and pop the button events
+    if not button_handle.toggle_button_queue.empty():
+       event, timestamp = button_handle.toggle_button_queue.get()
+    timestamp is the time.monotonic() of the edge that finished the event
 
     Inputs:
-    gpio_num - the number of the gpio on the Rpi
+    gpio_num - the number of the gpio on the Rpi (the line offset on the gpiochip)
     button_type = Either 'normally_open' or 'normally_closed'. The class will update the queue
                   when the state indicates the button has been pressed. If not used, will default
                   to "normally open" as most buttons are
+    debounce_ms - time a level has to be stable to count
+    double_click_ms - longest time from the end of a click to the next press for a double click
+    long_press_ms - time the button has to be held for a long press
+    chip_path - the gpiochip device the gpio is on
 
     Outputs:
     None
     """
 
-    def __init__(self, gpio_num, button_type="normally_open"):
+    def __init__(self, gpio_num, button_type="normally_open", debounce_ms=20, double_click_ms=300,
+                 long_press_ms=800, chip_path="/dev/gpiochip0"):
         """
         Description:
         Initialization of the toggle_button class
-        
+
         Inputs:
         gpio_num - see class def
         button_type - see class def
+        debounce_ms - see class def
+        double_click_ms - see class def
+        long_press_ms - see class def
+        chip_path - see class def
 
         Outputs:
         None
@@ -41,9 +78,14 @@ class toggle_button:
 
         self.gpio_num = gpio_num
         self.button_type = button_type
+        self.debounce_ns = debounce_ms * 1000000
+        self.double_click_ns = double_click_ms * 1000000
+        self.long_press_ns = long_press_ms * 1000000
+        self.chip_path = chip_path
         self.toggle_button_queue = Queue()
-        self._setup_gpios()
+        #Created first so __del__ works even if the gpio can't be opened
         self.stop_flag = threading.Event()
+        self._setup_gpios()
         logging.info(f"Toggle button initialized successfully")
 
         self._start_thread()
@@ -52,7 +94,7 @@ class toggle_button:
         """
         Description:
         Destructor for the class, ensures all threads are stopped
-        
+
         Inputs:
         None
 
@@ -62,12 +104,12 @@ class toggle_button:
 
         self._stop_thread()
 
-
     def _setup_gpios(self):
         """
         Description:
-        Initialization the Rpi GPIOs using the gpio_num variable
-        
+        Requests edge events for the gpio from the gpiochip, with the pull-up on,
+        and reads its current level
+
         Inputs:
         None
 
@@ -75,13 +117,55 @@ class toggle_button:
         None
         """
 
-        gpio.setup(self.gpio_num, gpio.IN, pull_up_down=gpio.PUD_UP)
+        chip_fd = os.open(self.chip_path, os.O_RDONLY)
+        try:
+            request = bytearray(GPIOEVENT_REQUEST.pack(self.gpio_num,
+                                                       GPIOHANDLE_REQUEST_INPUT | GPIOHANDLE_REQUEST_BIAS_PULL_UP,
+                                                       GPIOEVENT_REQUEST_BOTH_EDGES, b"smart_bed", 0))
+            fcntl.ioctl(chip_fd, GPIO_GET_LINEEVENT_IOCTL, request)
+        finally:
+            os.close(chip_fd)
+        self.line_fd = GPIOEVENT_REQUEST.unpack(request)[4]
+        self.level = self._read_level()
+
+    def _read_level(self):
+        """
+        Description:
+        Reads the current level of the line
+
+        Inputs:
+        None
+
+        Outputs:
+        level - 0 or 1
+        """
+
+        values = bytearray(GPIOHANDLE_DATA_SIZE)
+        fcntl.ioctl(self.line_fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, values)
+        return values[0]
+
+    def _is_pressed_level(self, level):
+        """
+        Description:
+        Whether a line level means the button is pressed. A normally open button
+        pulls the line low when pressed, a normally closed one lets it go high.
+
+        Inputs:
+        level - 0 or 1
+
+        Outputs:
+        True if the level means pressed
+        """
+
+        if self.button_type == "normally_closed":
+            return level == 1
+        return level == 0
 
     def _start_thread(self):
         """
         Description:
         Starts the thread that keeps track of the button presses. Is run from __init__()
-        
+
         Inputs:
         None
 
@@ -90,85 +174,154 @@ class toggle_button:
         """
 
         #Initialize the button state
-        if self.button_type == "normally_closed":
-            self.button_state = 0
-        else:
-            self.button_state = 1
+        self.pressed = self._is_pressed_level(self.level)
+        self.pending_level = None
+        self.pending_ns = 0
+        self.press_ns = None
+        self.long_press_sent = False
+        self.click_ns = None
+
+        #Writing to this pipe wakes the thread up to stop
+        self.wake_read_fd, self.wake_write_fd = os.pipe()
 
         #Initialize the toggle_button_loop thread
         self.button_thread = threading.Thread(target=self._toggle_button_loop)
         self.button_thread.start()
 
-    def _toggle_button_loop(self):
+    def _put(self, event, event_ns):
         """
         Description:
-        Checks to see if a button was pressed
-        
+        Puts a button event in the toggle_button_queue
+
         Inputs:
-        None
+        event - 'click', 'double_click' or 'long_press'
+        event_ns - CLOCK_MONOTONIC time of the event in ns
 
         Outputs:
         None
         """
 
-        new_button_state = gpio.input(self.gpio_num)
-        if new_button_state == self.button_state:
-            pass
-        elif self.button_type == 'normally_open' and new_button_state == 0:
-            self.keypad_queue.put("Press")
-            self.button_state = 0
-        elif self.button_type == 'normally_closed' and new_button_state == 1:
-            self.keypad_queue.put("Press")
-            self.button_state = 1
+        logging.debug(f"Toggle button: {event}")
+        self.toggle_button_queue.put((event, event_ns / 1e9))
 
-        time.sleep(0.02)
+    def _next_deadline(self):
+        """
+        Description:
+        The next time something happens without a new edge: the debounce window
+        ending, a long press, or a click no longer able to become a double click
 
-    def _stop_thread(self):
-        self.stop_flag.set()
-        self.button_thread.join()
+        Inputs:
+        None
 
-class toggle_button2:
-    """
-    #This function relies on the gpio.add_event_detect() function that is, at best, unreliable. DO NOT USE
-    #I left it here in case we figure out how to make this functionality more reliable
+        Outputs:
+        deadline_ns - CLOCK_MONOTONIC time in ns, or None to wait for an edge
+        """
 
-    Description:
-    #Button that changes the state from 0->1 or 1->0 on each press (so we need to detect an event for both)
-    
-    Usage:
-    button_handle = toggle_button(gpio_number, callback_function)
+        deadlines = []
+        if self.pending_level is not None:
+            deadlines.append(self.pending_ns + self.debounce_ns)
+        if self.pressed and self.press_ns is not None and not self.long_press_sent:
+            deadlines.append(self.press_ns + self.long_press_ns)
+        if self.click_ns is not None and not self.pressed:
+            deadlines.append(self.click_ns + self.double_click_ns)
+        return min(deadlines) if deadlines else None
 
-    Inputs:
-    gpio_num - the number of the gpio on the Rpi
-    callback_function - pointer to a function in the parent that will be called when the button is triggered
+    def _commit(self, level, edge_ns):
+        """
+        Description:
+        A level has been stable for the debounce window, updates the press state
 
-    Outputs:
-    None
-    """
+        Inputs:
+        level - the stable line level
+        edge_ns - kernel timestamp of the edge that led to it
 
-    def __init__(self, gpio_num, callback_function):
+        Outputs:
+        None
+        """
+
+        pressed = self._is_pressed_level(level)
+        if pressed == self.pressed:
+            return
+        self.pressed = pressed
+        if pressed:
+            self.press_ns = edge_ns
+            self.long_press_sent = False
+            return
+        if self.long_press_sent or self.press_ns is None:
+            self.click_ns = None
+        elif self.click_ns is not None:
+            self.click_ns = None
+            self._put('double_click', edge_ns)
+        else:
+            self.click_ns = edge_ns
+        self.press_ns = None
+
+    def _run_deadlines(self, now_ns):
         """
         Description:
-        Initialization of the toggle_button class
-        
+        Handles every deadline that has passed
+
         Inputs:
-        gpio_number - see class def
-        callback_function - see class def
+        now_ns - time.monotonic_ns()
 
         Outputs:
         None
         """
 
-        self.gpio_num = gpio_num
-        self.callback_function = callback_function
-        self.setup_gpio()
-        logging.info(f"Button initialized on GPIO{gpio_num}")
+        if self.pending_level is not None and now_ns >= self.pending_ns + self.debounce_ns:
+            level, edge_ns = self.pending_level, self.pending_ns
+            self.pending_level = None
+            #The line itself is the truth, the last edge's direction is only a fallback
+            try:
+                level = self._read_level()
+            except OSError:
+                logging.warning("Toggle button: unable to read the line, using the last edge")
+            self._commit(level, edge_ns)
+        if (self.pressed and self.press_ns is not None and not self.long_press_sent
+                and now_ns >= self.press_ns + self.long_press_ns):
+            self.long_press_sent = True
+            if self.click_ns is not None:
+                #A click just before the long press was not the start of a double click
+                self._put('click', self.click_ns)
+                self.click_ns = None
+            self._put('long_press', self.press_ns + self.long_press_ns)
+        if self.click_ns is not None and not self.pressed and now_ns >= self.click_ns + self.double_click_ns:
+            click_ns = self.click_ns
+            self.click_ns = None
+            self._put('click', click_ns)
+
+    def _toggle_button_loop(self):
+        """
+        Description:
+        Waits for edges and deadlines until _stop_thread() is called
+
+        Inputs:
+        None
 
-    def setup_gpio(self):
+        Outputs:
+        None
+        """
+
+        while not self.stop_flag.is_set():
+            deadline_ns = self._next_deadline()
+            timeout = None
+            if deadline_ns is not None:
+                timeout = max(0, deadline_ns - time.monotonic_ns()) / 1e9
+            readable, _, _ = select.select([self.line_fd, self.wake_read_fd], [], [], timeout)
+            if self.line_fd in readable:
+                data = os.read(self.line_fd, GPIOEVENT_DATA.size * 16)
+                for offset in range(0, len(data) - GPIOEVENT_DATA.size + 1, GPIOEVENT_DATA.size):
+                    edge_ns, edge_id = GPIOEVENT_DATA.unpack_from(data, offset)
+                    #Every edge restarts the debounce window
+                    self.pending_level = 1 if edge_id == GPIOEVENT_EVENT_RISING_EDGE else 0
+                    self.pending_ns = edge_ns
+            self._run_deadlines(time.monotonic_ns())
+
+    def _stop_thread(self):
         """
         Description:
-        Initialization of the gpio and event detect interrupt
-        
+        Stops the thread and releases the gpio line
+
         Inputs:
         None
 
@@ -176,6 +329,14 @@ class toggle_button2:
         None
         """
 
-        #Setup the GPIO direction
-        gpio.setup(self.gpio_num, gpio.IN, pull_up_down=gpio.PUD_UP)
-        gpio.add_event_detect(self.gpio_num, gpio.BOTH, bouncetime=2000, callback=self.callback_function)
\ No newline at end of file
+        #__init__ may have failed part way, only undo what was done
+        stop_flag = getattr(self, 'stop_flag', None)
+        if stop_flag is None or stop_flag.is_set():
+            return
+        stop_flag.set()
+        if hasattr(self, 'button_thread'):
+            os.write(self.wake_write_fd, b'\0')
+            self.button_thread.join()
+        for fd_name in ('line_fd', 'wake_read_fd', 'wake_write_fd'):
+            if hasattr(self, fd_name):
+                os.close(getattr(self, fd_name))
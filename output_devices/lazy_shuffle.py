@@ -0,0 +1,63 @@
+import random
+from array import array
+
+class lazy_shuffle:
+    """
+    Description:
+    Shuffled playlist that draws the next song only when it is needed. It runs one
+    step of a Fisher-Yates shuffle per draw over a compact index array, so starting
+    a shuffle of tens of thousands of songs costs one array allocation instead of a
+    full shuffle, and no list of paths is copied. After every song has been drawn
+    once, the shuffle starts over.
+
+    Usage:
+    shuffle_handle = lazy_shuffle(song_filepaths)
+    next_song = shuffle_handle.next()
+
+    Inputs:
+    paths - list of song file paths, it is not copied or changed
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, paths):
+        """
+        Description:
+        Initialization of the lazy_shuffle class
+
+        Inputs:
+        paths - see class def
+
+        Outputs:
+        None
+        """
+
+        if not paths:
+            raise ValueError("Cannot shuffle an empty playlist")
+        self.paths = paths
+        self.order = array('I', range(len(paths)))
+        self.position = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def next(self):
+        """
+        Description:
+        Draws the next song
+
+        Inputs:
+        None
+
+        Outputs:
+        path - path of the next song
+        """
+
+        if self.position == len(self.order):
+            self.position = 0
+        pick = random.randrange(self.position, len(self.order))
+        self.order[self.position], self.order[pick] = self.order[pick], self.order[self.position]
+        path = self.paths[self.order[self.position]]
+        self.position += 1
+        return path
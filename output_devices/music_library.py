@@ -0,0 +1,258 @@
+import vlc
+import logging
+import threading
+import json
+import random
+import os, time
+from concurrent.futures import ThreadPoolExecutor
+
+#How long to wait for VLC to parse a single file
+PARSE_TIMEOUT = 10
+#Only files with these extensions are indexed, anything else in music_dir (cover art,
+#playlists, text files) would never parse and cost PARSE_TIMEOUT on every rebuild
+AUDIO_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.oga', '.opus', '.m4a', '.aac', '.wav', '.wma', '.aiff', '.aif', '.mka')
+
+class music_library:
+    """
+    Description:
+    Persistent index of the music in a directory. For every file it keeps the path,
+    size, mtime, duration and tags, and saves them to a JSON file. On startup the
+    saved index is loaded right away, then a background thread rescans the directory
+    and only re-parses the files that are new or whose size/mtime changed, using a
+    small worker pool. Only audio files (see AUDIO_EXTENSIONS) are indexed. Files
+    that could not be parsed (no known duration) stay in
+    the list but are parsed again on every rebuild until it works. Playback can then start from the in-memory list, with real
+    durations and without scanning the directory.
+
+    Usage:
+    library_handle = music_library(music_dir, "/home/gabe/.smartbed/music_library.json", vlc_instance)
+    song_filepaths = library_handle.get_paths()
+    song_duration = library_handle.get_duration(song_filepaths[0])
+
+    Inputs:
+    music_dir - The path to a directory with music mp3s
+    index_filepath - Where to save the index, None to keep it in memory only
+    instance - The vlc.Instance used to parse the files
+    workers - Number of files to parse at the same time
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, music_dir, index_filepath, instance, workers=2):
+        """
+        Description:
+        Initialization of the music_library class
+
+        Inputs:
+        music_dir - see class def
+        index_filepath - see class def
+        instance - see class def
+        workers - see class def
+
+        Outputs:
+        None
+        """
+
+        self.music_dir = music_dir
+        self.index_filepath = index_filepath
+        self.instance = instance
+        self.workers = workers
+        self.entries = {}
+        #Paths of the entries as a tuple, for sample_paths(). None when the entries have changed.
+        self._path_tuple = None
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        self._load()
+        self.rebuild()
+        logging.info(f"Music library initialized with {len(self.entries)} songs")
+
+    def _load(self):
+        """
+        Description:
+        Loads the saved index, if there is one
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        if self.index_filepath is None or not os.path.isfile(self.index_filepath):
+            return
+        try:
+            with open(self.index_filepath) as index_file:
+                saved = json.load(index_file)
+        except (OSError, ValueError):
+            logging.warning(f"music_library: unable to read {self.index_filepath}, rebuilding it")
+            return
+        if saved.get('music_dir') == self.music_dir:
+            self.entries = {entry['path']: entry for entry in saved.get('entries', [])}
+
+    def _save(self):
+        """
+        Description:
+        Writes the index to disk. The file is replaced atomically so a power cut
+        can't leave half an index behind.
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        if self.index_filepath is None:
+            return
+        with self._lock:
+            saved = {'music_dir': self.music_dir, 'entries': list(self.entries.values())}
+        tmp_filepath = self.index_filepath + ".tmp"
+        try:
+            with open(tmp_filepath, 'w') as index_file:
+                json.dump(saved, index_file)
+            os.replace(tmp_filepath, self.index_filepath)
+        except OSError:
+            logging.warning(f"music_library: unable to write {self.index_filepath}")
+
+    def _parse(self, file_path, size, mtime):
+        """
+        Description:
+        Parses a single file with VLC to get its duration and tags
+
+        Inputs:
+        file_path - path of the file
+        size - size of the file in bytes
+        mtime - modification time of the file
+
+        Outputs:
+        entry - dict with the path, size, mtime, duration (seconds, 0 if unknown) and tags
+        """
+
+        media = self.instance.media_new(file_path)
+        media.parse_with_options(vlc.MediaParseFlag.local, PARSE_TIMEOUT*1000)
+        deadline = time.monotonic() + PARSE_TIMEOUT
+        while media.get_parsed_status() == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        duration = max(media.get_duration(), 0) / 1000
+        tags = {}
+        for name, meta in (('title', vlc.Meta.Title), ('artist', vlc.Meta.Artist), ('album', vlc.Meta.Album)):
+            value = media.get_meta(meta)
+            if value:
+                tags[name] = value
+        media.release()
+        if duration <= 0:
+            logging.warning(f"music_library: unable to get the duration of {file_path}")
+        return {'path': file_path, 'size': size, 'mtime': mtime, 'duration': duration, 'tags': tags}
+
+    def _rebuild(self):
+        """
+        Description:
+        Rescans music_dir and re-parses only the new or changed files
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        try:
+            with os.scandir(self.music_dir) as scan:
+                found = {}
+                for dir_entry in scan:
+                    if dir_entry.is_file() and dir_entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                        stat = dir_entry.stat()
+                        found[dir_entry.path] = (stat.st_size, stat.st_mtime)
+        except OSError:
+            logging.warning(f"music_library: unable to scan {self.music_dir}")
+            self.ready.set()
+            return
+
+        with self._lock:
+            removed = [path for path in self.entries if path not in found]
+            for path in removed:
+                del self.entries[path]
+            if removed:
+                self._path_tuple = None
+            #A failed parse (duration 0) is not trusted, it is retried like a changed file
+            changed = [(path, size, mtime) for path, (size, mtime) in found.items()
+                       if path not in self.entries
+                       or (self.entries[path]['size'], self.entries[path]['mtime']) != (size, mtime)
+                       or self.entries[path]['duration'] <= 0]
+
+        if changed:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for entry in pool.map(lambda args: self._parse(*args), changed):
+                    with self._lock:
+                        if entry['path'] not in self.entries:
+                            self._path_tuple = None
+                        self.entries[entry['path']] = entry
+        if changed or removed:
+            self._save()
+        logging.info(f"Music library rebuilt: {len(changed)} parsed, {len(removed)} removed, {len(found)} total")
+        self.ready.set()
+
+    def rebuild(self):
+        """
+        Description:
+        Starts a background rebuild of the index
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        threading.Thread(target=self._rebuild, daemon=True).start()
+
+    def get_paths(self):
+        """
+        Description:
+        Returns the paths of every song in the index
+
+        Inputs:
+        None
+
+        Outputs:
+        paths - sorted list of song file paths
+        """
+
+        with self._lock:
+            return sorted(self.entries)
+
+    def sample_paths(self, count):
+        """
+        Description:
+        Picks a few songs at random without copying the whole list
+
+        Inputs:
+        count - number of songs wanted
+
+        Outputs:
+        paths - list of up to count song file paths
+        """
+
+        with self._lock:
+            if self._path_tuple is None:
+                self._path_tuple = tuple(self.entries)
+            paths = self._path_tuple
+        return [paths[index] for index in random.sample(range(len(paths)), min(count, len(paths)))]
+
+    def get_duration(self, file_path):
+        """
+        Description:
+        Returns the duration of a song from the index
+
+        Inputs:
+        file_path - path of the song
+
+        Outputs:
+        duration - seconds, 0 if the song is not in the index or has no known duration
+        """
+
+        entry = self.entries.get(file_path)
+        if entry is None:
+            return 0
+        return entry['duration']
@@ -0,0 +1,254 @@
+import vlc
+import logging
+import threading
+import ctypes
+import time
+import numpy as np
+
+class music_visualizer:
+    """
+    Description:
+    Sound-reactive light mode. A second, silent VLC player decodes the same song as
+    the music player and hands the PCM to an audio callback, which copies it into a
+    ring buffer. (libVLC audio callbacks replace the audio output, so they can't be
+    put on the player you are listening to.) A light thread then runs at frame_rate:
+    it takes the newest block_size samples, computes the band energies with a
+    precomputed DFT, smooths them with an attack/release envelope and maps them to
+    an LED duty cycle. Every buffer is allocated up front, so the per-block path
+    allocates no arrays, and its cost is fixed by block_size and frame_rate.
+
+    Usage:
+    visualizer_handle = music_visualizer(vlc_instance, led_handle.set_pwm)
+    visualizer_handle.start()
+    visualizer_handle.follow("/home/gabe/Music/music_playlist/song.mp3")
+    ...
+    visualizer_handle.stop()
+
+    Inputs:
+    instance - The vlc.Instance to create the analysis player from
+    pwm_function - The pointer to the function that sets the LED duty cycle
+    min_duty - Duty cycle for silence
+    max_duty - Duty cycle for the loudest sound
+    frame_rate - LED updates per second
+    block_size - Number of samples analysed per LED update
+    sample_rate - Sample rate the audio is decoded at
+
+    Outputs:
+    None
+    """
+
+    #Frequency bands (Hz) and how much each one drives the lights
+    bands = ((20, 150, 0.6), (150, 600, 0.25), (600, 2500, 0.1), (2500, 8000, 0.05))
+
+    def __init__(self, instance, pwm_function, min_duty=2, max_duty=60, frame_rate=50, block_size=512,
+                 sample_rate=22050):
+        """
+        Description:
+        Initialization of the music_visualizer class
+
+        Inputs:
+        See class def
+
+        Outputs:
+        None
+        """
+
+        self.pwm_function = pwm_function
+        self.min_duty = min_duty
+        self.max_duty = max_duty
+        self.frame_rate = frame_rate
+        self.block_size = block_size
+        self.sample_rate = sample_rate
+
+        #Ring buffer the VLC audio callback writes mono int16 samples into
+        self.ring = np.zeros(sample_rate, dtype=np.int16)
+        self.write_index = 0
+
+        #Analysis buffers and the precomputed DFT, window and band matrices
+        num_bins = block_size // 2 + 1
+        n = np.arange(block_size)[:, np.newaxis]
+        k = np.arange(num_bins)[np.newaxis, :]
+        window = np.hanning(block_size).astype(np.float32) / 32768.0
+        self.cos_matrix = (np.cos(2 * np.pi * n * k / block_size) * window[:, np.newaxis]).astype(np.float32)
+        self.sin_matrix = (np.sin(2 * np.pi * n * k / block_size) * window[:, np.newaxis]).astype(np.float32)
+        bin_freqs = np.arange(num_bins) * sample_rate / block_size
+        self.band_matrix = np.zeros((num_bins, len(self.bands)), dtype=np.float32)
+        self.band_weights = np.zeros(len(self.bands), dtype=np.float32)
+        for band_num, (low, high, weight) in enumerate(self.bands):
+            in_band = (bin_freqs >= low) & (bin_freqs < high)
+            self.band_matrix[in_band, band_num] = 1.0 / max(1, np.count_nonzero(in_band))
+            self.band_weights[band_num] = weight
+        self.block = np.zeros(block_size, dtype=np.float32)
+        self.real = np.zeros(num_bins, dtype=np.float32)
+        self.imag = np.zeros(num_bins, dtype=np.float32)
+        self.band_energy = np.zeros(len(self.bands), dtype=np.float32)
+        self.envelope = np.zeros(len(self.bands), dtype=np.float32)
+        self.peak = np.full(len(self.bands), 1e-6, dtype=np.float32)
+        self.scratch = np.zeros(len(self.bands), dtype=np.float32)
+
+        #The callbacks have to be kept referenced for as long as VLC can call them
+        self._play_cb = vlc.CallbackDecorators.AudioPlayCb(self._on_audio)
+        self.instance = instance
+        self.player = instance.media_player_new()
+        self.player.audio_set_callbacks(self._play_cb, None, None, None, None, None)
+        self.player.audio_set_format("S16N", sample_rate, 1)
+
+        self.stop_flag = threading.Event()
+        self.light_thread = None
+        logging.info("Music visualizer initialized")
+
+    def _on_audio(self, data, samples, count, pts):
+        """
+        Description:
+        VLC audio callback, runs on a VLC thread. Copies the decoded samples into
+        the ring buffer with at most two memmoves.
+
+        Inputs:
+        data - opaque pointer (unused)
+        samples - pointer to count int16 samples
+        count - number of samples
+        pts - presentation time stamp (unused)
+
+        Outputs:
+        None
+        """
+
+        ring_size = len(self.ring)
+        count = min(count, ring_size)
+        start = self.write_index
+        first = min(count, ring_size - start)
+        ctypes.memmove(self.ring.ctypes.data + start * 2, samples, first * 2)
+        if count > first:
+            ctypes.memmove(self.ring.ctypes.data, samples + first * 2, (count - first) * 2)
+        self.write_index = (start + count) % ring_size
+
+    def _analyse(self):
+        """
+        Description:
+        Runs one analysis block on the newest samples and returns the LED level
+
+        Inputs:
+        None
+
+        Outputs:
+        level - float from 0 to 1
+        """
+
+        end = self.write_index
+        start = end - self.block_size
+        if start >= 0:
+            np.copyto(self.block, self.ring[start:end], casting='unsafe')
+        else:
+            np.copyto(self.block[:-start], self.ring[start:], casting='unsafe')
+            np.copyto(self.block[-start:], self.ring[:end], casting='unsafe')
+
+        #Power spectrum through the precomputed (windowed) DFT matrices
+        np.matmul(self.block, self.cos_matrix, out=self.real)
+        np.matmul(self.block, self.sin_matrix, out=self.imag)
+        np.multiply(self.real, self.real, out=self.real)
+        np.multiply(self.imag, self.imag, out=self.imag)
+        np.add(self.real, self.imag, out=self.real)
+        np.matmul(self.real, self.band_matrix, out=self.band_energy)
+        np.sqrt(self.band_energy, out=self.band_energy)
+
+        #Fast attack, slow release envelope
+        np.multiply(self.envelope, 0.85, out=self.scratch)
+        np.maximum(self.band_energy, self.scratch, out=self.envelope)
+        #Slowly decaying peak per band for automatic gain
+        np.multiply(self.peak, 0.999, out=self.peak)
+        np.maximum(self.peak, self.envelope, out=self.peak)
+        np.divide(self.envelope, self.peak, out=self.scratch)
+        return float(np.dot(self.scratch, self.band_weights))
+
+    def _light_loop(self):
+        """
+        Description:
+        Updates the LEDs at frame_rate until stop() is called
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        frame_period = 1.0 / self.frame_rate
+        next_frame = time.monotonic()
+        while not self.stop_flag.is_set():
+            #Leave the lights alone while nothing is playing
+            if self.player.is_playing():
+                level = self._analyse()
+                self.pwm_function(self.min_duty + (self.max_duty - self.min_duty) * level)
+            next_frame += frame_period
+            if self.stop_flag.wait(max(0, next_frame - time.monotonic())):
+                break
+
+    def start(self):
+        """
+        Description:
+        Starts the light thread
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        if self.light_thread is not None and self.light_thread.is_alive():
+            return
+        self.stop_flag.clear()
+        self.light_thread = threading.Thread(target=self._light_loop, daemon=True)
+        self.light_thread.start()
+        logging.info("Music visualizer started")
+
+    def stop(self):
+        """
+        Description:
+        Stops the light thread and the analysis player. Once it returns, the
+        lights are not written again until start().
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self.stop_flag.set()
+        if self.light_thread is not None and self.light_thread is not threading.current_thread():
+            self.light_thread.join()
+        self.player.stop()
+        logging.info("Music visualizer stopped")
+
+    def follow(self, file_path, position_ms=0):
+        """
+        Description:
+        Starts decoding a song for the analysis, to follow the music player
+
+        Inputs:
+        file_path - path of the song the music player just started
+        position_ms - where the music player is in the song
+
+        Outputs:
+        None
+        """
+
+        self.player.set_media(self.instance.media_new(file_path))
+        self.player.play()
+        if position_ms > 0:
+            self.player.set_time(int(position_ms))
+
+    def set_pause(self, paused):
+        """
+        Description:
+        Pauses or resumes the analysis player along with the music player
+
+        Inputs:
+        paused - True to pause
+
+        Outputs:
+        None
+        """
+
+        self.player.set_pause(1 if paused else 0)
@@ -3,6 +3,51 @@ import logging
 import threading
 import os, time
 import random
+import numpy as np
+from urllib.parse import urlparse, unquote
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+from output_devices.music_library import music_library
+from output_devices.lazy_shuffle import lazy_shuffle
+from output_devices.tone_generator import tone_generator
+from rpi_helpers.page_cache import page_cache
+
+#How long the alarm warm-up waits for VLC to parse the media and to start playing
+PREPARE_TIMEOUT = 5
+#Chunk size used when pre-reading the next track from the SD card
+PREFETCH_CHUNK = 1024*1024
+
+#libVLC options for each instance profile
+#default - what vlc.Instance() does with no options
+#low_latency - audio only: no video outputs or subtitle/art lookups, and a short
+#              input cache, since every file is local
+VLC_PROFILES = {
+    'default': [],
+    'low_latency': ['--no-video', '--no-xlib', '--vout=dummy', '--no-sub-autodetect-file',
+                    '--no-metadata-network-access', '--no-stats', '--no-osd', '--no-snapshot-preview',
+                    '--file-caching=100', '--live-caching=100', '--quiet'],
+}
+
+def vlc_options(profile="default", audio_output=None):
+    """
+    Description:
+    Builds the libVLC command line options for an instance profile
+
+    Inputs:
+    profile - name of a profile in VLC_PROFILES
+    audio_output - name of the libVLC audio output module (e.g. 'alsa', 'pulse'),
+                   None to let VLC pick one
+
+    Outputs:
+    options - list of option strings for vlc.Instance()
+    """
+
+    if profile not in VLC_PROFILES:
+        raise ValueError(f"Unknown VLC profile: {profile}")
+    options = list(VLC_PROFILES[profile])
+    if audio_output is not None:
+        options.append(f"--aout={audio_output}")
+    return options
 
 class sound_blaster:
     """
@@ -17,12 +62,32 @@ class sound_blaster:
     Inputs:
     music_dir - The path to a directory with music mp3s
     alarm_filepath - The path to an mp3 with the music for the alarm
+    library_filepath - Where to save the music_dir index, see music_library
+    prefetch_bytes - How much of the next track to pre-read into memory while the
+                     current one plays, 0 to only pre-parse it, None for the whole file
+    page_cache_mode - How to keep the alarm file (and the next prefetch_tracks songs) in
+                      memory, see page_cache
+    prefetch_tracks - Number of upcoming songs to ask the kernel to cache, when
+                      page_cache_mode is not 'off'
+    shuffle_window - Number of upcoming songs kept in the VLC playlist when playing
+                     a shuffled directory
+    alarm_tone - Name of the synthesized tone played if the alarm file is missing or
+                 broken, see tone_generator. None to fall back to the music instead.
+    crossfade_seconds - Length of the fades when the alarm starts over music and
+                        when it stops and the music comes back
+    duck_level - Music gain (0-1) while the alarm plays, 0 fades it out and pauses it
+    mix_update_hz - Volume updates per second while a fade is running
+    vlc_profile - Name of the libVLC option set to create the instance with, see VLC_PROFILES
+    audio_output - libVLC audio output module to use, None for VLC's choice
 
     Outputs:
     None
     """
 
-    def __init__(self, music_dir, alarm_filepath):
+    def __init__(self, music_dir, alarm_filepath, library_filepath=None, prefetch_bytes=None,
+                 page_cache_mode="off", prefetch_tracks=2, shuffle_window=3, alarm_tone="chime",
+                 crossfade_seconds=3, duck_level=0.0, mix_update_hz=20, vlc_profile="default",
+                 audio_output=None):
         """
         Description:
         Initialization of the switch class
@@ -30,6 +95,17 @@ class sound_blaster:
         Inputs:
         music_dir - The path to a directory with music mp3s
         alarm_filepath - The path to an mp3 with the music for the alarm
+        library_filepath - The path to save the music library index
+        prefetch_bytes - How much of the next track to pre-read
+        page_cache_mode - How to keep the alarm file in memory
+        prefetch_tracks - Number of upcoming songs to cache
+        shuffle_window - Number of upcoming songs kept in VLC when shuffling
+        alarm_tone - Name of the fallback alarm tone
+        crossfade_seconds - Length of the fades between the music and the alarm
+        duck_level - Music level while the alarm plays
+        mix_update_hz - Volume updates per second while fading
+        vlc_profile - Name of the libVLC option set
+        audio_output - libVLC audio output module
 
         Outputs:
         None
@@ -37,9 +113,68 @@ class sound_blaster:
 
         self.music_dir = music_dir
         self.alarm_filepath = alarm_filepath
-        self.instance = vlc.Instance()
+        self.prefetch_bytes = prefetch_bytes
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+        self.prefetch_tracks = prefetch_tracks
+        self.shuffle_window = shuffle_window
+        self._shuffle = None
+        #Number of songs at the start of the shuffle playlist already swapped for the placeholder
+        self._shuffle_played = 0
+        self.crossfade_seconds = crossfade_seconds
+        self.duck_level = duck_level
+        self.mix_update_hz = mix_update_hz
+        self.page_cache = page_cache(page_cache_mode)
+        #Only the alarm file is pinned, this is the path it was pinned under
+        self._pinned_alarm = None
+        if page_cache_mode == 'tmpfs':
+            #Alarm files are small, so in tmpfs mode the alarm stays pinned in RAM all the time
+            self._alarm_hot_path()
+        self.instance = vlc.Instance(vlc_options(vlc_profile, audio_output))
+        logging.info(f"VLC instance created with the {vlc_profile} profile")
+        #Stands in for the songs a shuffle has already played, see _top_up_shuffle()
+        self._played_placeholder = self.instance.media_new_location("vlc://nop")
+        self.library = music_library(music_dir, library_filepath, self.instance)
+        #The fallback tone is built now, so it is ready instantly if the alarm file fails
+        self.alarm_tone_filepath = None
+        if alarm_tone is not None:
+            self.alarm_tone_filepath = tone_generator().wav_path(alarm_tone)
+
+        #Two channels, one player each, so the music and the alarm can be mixed
         self.media_list_player = self.instance.media_list_player_new()
-        self.play_thread = None
+        self.media_list = self.instance.media_list_new()
+        self.media_list_player.set_media_list(self.media_list)
+        self.alarm_list_player = self.instance.media_list_player_new()
+        self.alarm_list = self.instance.media_list_new()
+        self.alarm_list_player.set_media_list(self.alarm_list)
+        self.alarm_list_player.set_playback_mode(vlc.PlaybackMode.loop)
+        self._players = {'music': self.media_list_player, 'alarm': self.alarm_list_player}
+
+        #Each channel has a level (the volume the user or the alarm asked for) and a
+        #mixer gain (0-1, moved by the crossfades). VLC gets level*gain.
+        self._levels = {'music': 50, 'alarm': 50}
+        self._gains = {'music': 1.0, 'alarm': 1.0}
+        self._applied_volumes = {'music': None, 'alarm': None}
+        self._envelopes = {}
+        self._next_mix_time = None
+        self._music_ducked = False
+        self.visualizer = None
+
+        self._alarm_prepared = False
+        self._alarm_playing = False
+        self._alarm_active = False
+        #'prepare' is the deadline for the audio output to start during a warm-up
+        self._deadlines = {'music': None, 'alarm': None, 'prepare': None}
+        #(file_path, result_queue) of a warm-up waiting for the alarm player to start
+        self._pending_prepare = None
+        self.state = vlc.State.NothingSpecial
+        self.alarm_state = vlc.State.NothingSpecial
+        self.current_media_path = None
+        self.current_alarm_path = None
+        self.command_queue = Queue()
+        self._attach_events(self.media_list_player, 'music')
+        self._attach_events(self.alarm_list_player, 'alarm')
+        self.play_thread = threading.Thread(target=self._playback_loop, daemon=True)
+        self.play_thread.start()
         logging.info("Sound controller initialized")
 
     def __del__(self):
@@ -55,12 +190,359 @@ class sound_blaster:
         """
 
         self.stop()
+        self.command_queue.put(('quit', ()))
+
+    def _attach_events(self, list_player, channel):
+        """
+        Description:
+        Subscribes to the VLC player events, so the playback state is kept up to
+        date by VLC itself instead of being asked for through ctypes every time
+        
+        Inputs:
+        list_player - the vlc media list player of the channel
+        channel - 'music' or 'alarm'
+
+        Outputs:
+        None
+        """
+
+        event_manager = list_player.get_media_player().event_manager()
+        events = {
+            vlc.EventType.MediaPlayerPlaying: 'playing',
+            vlc.EventType.MediaPlayerPaused: 'paused',
+            vlc.EventType.MediaPlayerStopped: 'stopped',
+            vlc.EventType.MediaPlayerEndReached: 'end_reached',
+            vlc.EventType.MediaPlayerMediaChanged: 'media_changed',
+            vlc.EventType.MediaPlayerEncounteredError: 'error',
+        }
+        for event_type, name in events.items():
+            event_manager.event_attach(event_type, self._on_vlc_event, name, channel)
+
+    def _on_vlc_event(self, event, name, channel):
+        """
+        Description:
+        Runs on a VLC thread for every subscribed event. It only updates the state
+        snapshot and hands the event to the playback worker, since VLC must not be
+        called back from inside its own event thread.
+        
+        Inputs:
+        event - the vlc event
+        name - the name given in _attach_events()
+        channel - the channel the event came from
+
+        Outputs:
+        None
+        """
+
+        states = {
+            'playing': vlc.State.Playing,
+            'paused': vlc.State.Paused,
+            'stopped': vlc.State.Stopped,
+            'end_reached': vlc.State.Ended,
+            'error': vlc.State.Error,
+        }
+        if name in states:
+            if channel == 'music':
+                self.state = states[name]
+            else:
+                self.alarm_state = states[name]
+                if name == 'playing' and self._pending_prepare is not None:
+                    self.command_queue.put(('event', (name, channel)))
+        if name in ('media_changed', 'end_reached', 'error'):
+            self.command_queue.put(('event', (name, channel)))
+
+    def _event(self, name, channel):
+        """
+        Description:
+        Worker side of the VLC events that need an action
+        
+        Inputs:
+        name - the name given in _attach_events()
+        channel - the channel the event came from
+
+        Outputs:
+        None
+        """
+
+        if channel == 'alarm':
+            if name == 'playing' and self._pending_prepare is not None:
+                #The warm-up's zero volume play started, the audio output works
+                self.alarm_list_player.set_pause(1)
+                self.alarm_list_player.get_media_player().set_time(0)
+                self._alarm_prepared = True
+                logging.info(f"Alarm sound prepared from {self._pending_prepare[0]}")
+                self._finish_prepare(True)
+            elif name == 'media_changed':
+                media = self.alarm_list_player.get_media_player().get_media()
+                self.current_alarm_path = unquote(urlparse(media.get_mrl()).path) if media is not None else None
+            elif name == 'error':
+                logging.error(f"sound_blaster: VLC could not play {self.current_alarm_path}")
+                if self._alarm_playing:
+                    #Never leave the alarm silent, fall back to the alarm tone or the music
+                    fallback = self._alarm_fallbacks(1)
+                    if fallback and self.current_alarm_path != fallback[0]:
+                        logging.warning(f"sound_blaster: falling back to {fallback[0]} for the alarm")
+                        self._load_alarm(self.instance.media_new(fallback[0]))
+                        self.alarm_list_player.play()
+            return
+
+        if name == 'media_changed':
+            media = self.media_list_player.get_media_player().get_media()
+            self.current_media_path = unquote(urlparse(media.get_mrl()).path) if media is not None else None
+            logging.debug(f"Now playing {self.current_media_path}")
+            if media is not None and self.visualizer is not None:
+                self.visualizer.follow(self.current_media_path)
+            if media is not None:
+                self._top_up_shuffle(media)
+                self._prefetch_next(media)
+        elif name == 'end_reached':
+            logging.debug(f"End of {self.current_media_path}")
+        elif name == 'error':
+            logging.error(f"sound_blaster: VLC could not play {self.current_media_path}")
+
+    def _top_up_shuffle(self, current_media):
+        """
+        Description:
+        When playing a lazy shuffle, draws songs until there are shuffle_window
+        songs queued after current_media, and releases the songs already played.
+        The list player keeps its place by index, so a played song is swapped for
+        a shared placeholder instead of being removed, which would make it skip
+        ahead. The playlist still gets one entry longer per song played, but each
+        of those entries is a reference to the same placeholder, not a media of its own.
+        
+        Inputs:
+        current_media - the vlc media that just started playing
+
+        Outputs:
+        None
+        """
+
+        if self._shuffle is None:
+            return
+        self.media_list.lock()
+        try:
+            index = self.media_list.index_of_item(current_media)
+            if index < 0:
+                return
+            for played in range(self._shuffle_played, index):
+                self.media_list.remove_index(played)
+                self.media_list.insert_media(self._played_placeholder, played)
+            self._shuffle_played = max(self._shuffle_played, index)
+            for _ in range(index + self.shuffle_window + 1 - self.media_list.count()):
+                self.media_list.add_media(self.instance.media_new(self._shuffle.next()))
+        finally:
+            self.media_list.unlock()
+
+    def _play_shuffled(self, file_list):
+        """
+        Description:
+        Worker side of play_shuffled(). Only the first shuffle_window songs go into
+        the VLC playlist, the rest are drawn as playback moves along.
+        
+        Inputs:
+        file_list - A list of the music mp3s
+
+        Outputs:
+        None
+        """
+
+        self._play([])
+        self._shuffle = lazy_shuffle(file_list)
+        self._shuffle_played = 0
+        for _ in range(min(self.shuffle_window, len(file_list))):
+            self.media_list.add_media(self.instance.media_new(self._shuffle.next()))
+        self.media_list_player.set_playback_mode(vlc.PlaybackMode.default)
+        self.media_list_player.play()
+
+    def _prefetch_next(self, current_media):
+        """
+        Description:
+        Gets the track after current_media ready while current_media plays: VLC
+        pre-parses it now (asynchronously) so opening it at the track boundary
+        finds everything already probed, and its bytes are read from the SD card
+        in the background so they come from the page cache when VLC asks.
+        
+        Inputs:
+        current_media - the vlc media that just started playing
+
+        Outputs:
+        None
+        """
+
+        count = self.media_list.count()
+        index = self.media_list.index_of_item(current_media)
+        if count < 2 or index < 0:
+            return
+        next_media = self.media_list.item_at_index((index + 1) % count)
+        if next_media.get_parsed_status() != vlc.MediaParsedStatus.done:
+            next_media.parse_with_options(vlc.MediaParseFlag.local, 0)
+        if self.prefetch_bytes != 0:
+            self._prefetch_pool.submit(self._read_ahead, next_media.get_mrl())
+        for offset in range(2, self.prefetch_tracks + 1):
+            upcoming_mrl = self.media_list.item_at_index((index + offset) % count).get_mrl()
+            self.page_cache.prefetch(unquote(urlparse(upcoming_mrl).path))
+
+    def _read_ahead(self, mrl):
+        """
+        Description:
+        Reads a track (or its first prefetch_bytes) and throws the data away, just
+        to pull it into the page cache. Runs on the prefetch pool.
+        
+        Inputs:
+        mrl - the VLC location of the track, e.g. file:///home/gabe/Music/song.mp3
+
+        Outputs:
+        None
+        """
+
+        file_path = unquote(urlparse(mrl).path)
+        remaining = self.prefetch_bytes
+        try:
+            with open(file_path, 'rb', buffering=0) as track_file:
+                while remaining is None or remaining > 0:
+                    chunk_size = PREFETCH_CHUNK if remaining is None else min(PREFETCH_CHUNK, remaining)
+                    chunk = track_file.read(chunk_size)
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+        except OSError:
+            logging.warning(f"sound_blaster: unable to pre-read {file_path}")
+            return
+        logging.debug(f"Pre-read {file_path}")
+
+    def _playback_loop(self):
+        """
+        Description:
+        The playback worker. This is the only thread that touches the VLC players:
+        it runs the commands from command_queue one at a time, and while waiting
+        for the next command it also watches the stop deadlines and the mixer
+        ticks, so a "stop after N seconds" is just a timeout on the queue and a
+        stop() cancels it at once.
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        while True:
+            wakeups = [t for t in list(self._deadlines.values()) + [self._next_mix_time] if t is not None]
+            timeout = None
+            if wakeups:
+                timeout = max(0, min(wakeups) - time.monotonic())
+            try:
+                command, args = self.command_queue.get(timeout=timeout)
+            except Empty:
+                command = None
+            if command == 'quit':
+                return
+            if command is not None:
+                try:
+                    getattr(self, f'_{command}')(*args)
+                except Exception:
+                    logging.exception(f"sound_blaster: {command} command failed")
+            self._run_timers()
+
+    def _run_timers(self):
+        """
+        Description:
+        Runs whatever is due: the stop deadlines of the channels and the next
+        mixer tick
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        now = time.monotonic()
+        if self._deadlines['music'] is not None and now >= self._deadlines['music']:
+            logging.info(f"Music playback time is up")
+            self._stop_music()
+        if self._deadlines['prepare'] is not None and now >= self._deadlines['prepare']:
+            logging.error("sound_blaster: the audio output did not start")
+            self.alarm_list_player.stop()
+            self._finish_prepare(False)
+        if self._deadlines['alarm'] is not None and now >= self._deadlines['alarm']:
+            logging.info(f"Alarm playback time is up")
+            self._alarm_active = False
+            self._stop_alarm()
+        if self._next_mix_time is not None and now >= self._next_mix_time:
+            self._mix_tick(now)
+
+    def _fade(self, channel, target_gain, seconds, end_action=None):
+        """
+        Description:
+        Starts a fade of a channel's mixer gain. The whole envelope is computed
+        now, the mixer ticks only look values up in it.
+        
+        Inputs:
+        channel - 'music' or 'alarm'
+        target_gain - gain at the end of the fade, 0-1
+        seconds - length of the fade
+        end_action - function to run when the fade is done, e.g. to pause the music
+
+        Outputs:
+        None
+        """
+
+        num_steps = max(1, int(seconds * self.mix_update_hz))
+        envelope = np.linspace(self._gains[channel], target_gain, num_steps + 1)[1:]
+        self._envelopes[channel] = (time.monotonic(), envelope, end_action)
+        if self._next_mix_time is None:
+            self._next_mix_time = time.monotonic()
+
+    def _mix_tick(self, now):
+        """
+        Description:
+        Moves every fading channel to its envelope value for this tick, and
+        schedules the next tick if anything is still fading
+        
+        Inputs:
+        now - time.monotonic() of this tick
+
+        Outputs:
+        None
+        """
+
+        for channel, (start_time, envelope, end_action) in list(self._envelopes.items()):
+            step = int((now - start_time) * self.mix_update_hz)
+            if step >= len(envelope) - 1:
+                self._gains[channel] = float(envelope[-1])
+                del self._envelopes[channel]
+                self._apply_channel(channel)
+                if end_action is not None:
+                    end_action()
+            else:
+                self._gains[channel] = float(envelope[step])
+                self._apply_channel(channel)
+        self._next_mix_time = now + 1.0/self.mix_update_hz if self._envelopes else None
+
+    def _apply_channel(self, channel):
+        """
+        Description:
+        Sends level*gain of a channel to VLC, only if it changed
+        
+        Inputs:
+        channel - 'music' or 'alarm'
+
+        Outputs:
+        None
+        """
+
+        volume = int(round(self._levels[channel] * self._gains[channel]))
+        if volume != self._applied_volumes[channel]:
+            self._players[channel].get_media_player().audio_set_volume(volume)
+            self._applied_volumes[channel] = volume
 
     def _play(self, file_list, repeat_count=0, total_playtime=0):
         """
         Description:
         Plays music files in order. Can determine a total time to play or a number of
-        repeats of the music
+        repeats of the music, after which the music is stopped
         
         Inputs:
         file_list - A list of the music mp3s
@@ -72,27 +554,320 @@ class sound_blaster:
         """
 
         total_duration = 0
+        self._shuffle = None
+        self._music_ducked = False
+        self._envelopes.pop('music', None)
+        self.media_list_player.stop()
         self.media_list = self.instance.media_list_new()
         self.media_list_player.set_media_list(self.media_list)
         for file_path in file_list:
             media = self.instance.media_new(file_path)
             self.media_list.add_media(media)
-            total_duration += media.get_duration() / 1000  # Duration in seconds
-
+            total_duration += self.library.get_duration(file_path)  # Duration in seconds
         self.media_list_player.set_playback_mode(vlc.PlaybackMode.loop)  # Set loop mode
-        self.media_list_player.play()
 
+        #Music started under the alarm stays ducked
+        self._gains['music'] = self.duck_level if self._alarm_playing else 1.0
+        self._apply_channel('music')
+        if self.media_list.count() > 0:
+            self.media_list_player.play()
+            logging.info(f"Started the music player")
+
+        self._deadlines['music'] = None
         if total_playtime > 0:
-            # If total playtime is set, just wait for that total playtime
-            time.sleep(total_playtime)
-        elif repeat_count > 0:
-            # If repeat_count is set, wait for the total duration of the playlist multiplied by the repeat count
-            time.sleep(total_duration * repeat_count)
+            # If total playtime is set, stop after that total playtime
+            self._deadlines['music'] = time.monotonic() + total_playtime
+        elif repeat_count > 0 and total_duration > 0:
+            # If repeat_count is set, stop after the total duration of the playlist multiplied by the repeat count
+            self._deadlines['music'] = time.monotonic() + total_duration * repeat_count
+
+    def _load_alarm(self, media):
+        """
+        Description:
+        Puts a media in the alarm channel's (looping) playlist
+        
+        Inputs:
+        media - the vlc media to play as the alarm
+
+        Outputs:
+        None
+        """
+
+        self.alarm_list_player.stop()
+        self.alarm_list = self.instance.media_list_new()
+        self.alarm_list.add_media(media)
+        self.alarm_list_player.set_media_list(self.alarm_list)
+
+    def _play_alarm(self, total_playtime):
+        """
+        Description:
+        Worker side of play_alarm(). Unpauses the alarm loaded by prepare_alarm(),
+        or loads it now if there was no warm-up. The alarm fades in over
+        crossfade_seconds while any playing music fades down to duck_level (and
+        is paused if that is 0).
+        
+        Inputs:
+        total_playtime - seconds after which the alarm stops
+
+        Outputs:
+        None
+        """
+
+        if self._pending_prepare is not None:
+            #The warm-up already loaded the alarm and is starting it at zero volume
+            logging.info("sound_blaster: alarm started during its warm-up")
+            self._alarm_prepared = True
+            self._finish_prepare(True)
+        if not self._alarm_prepared:
+            fallback = [] if os.path.isfile(self.alarm_filepath) else self._alarm_fallbacks(1)
+            if not fallback:
+                file_path = self._alarm_hot_path()
+            else:
+                logging.warning(f"sound_blaster: {self.alarm_filepath} is missing, using the fallback alarm")
+                file_path = fallback[0]
+            self._load_alarm(self.instance.media_new(file_path))
+        self._alarm_prepared = False
+        self._alarm_playing = True
+
+        self._gains['alarm'] = 0.0
+        self._apply_channel('alarm')
+        self.alarm_list_player.play()
+        self._fade('alarm', 1.0, self.crossfade_seconds)
+        if self.state == vlc.State.Playing:
+            self._fade('music', self.duck_level, self.crossfade_seconds,
+                       self._pause_music if self.duck_level == 0 else None)
+        self._deadlines['alarm'] = time.monotonic() + total_playtime
+        logging.info(f"Started the alarm player")
+
+    def _pause_music(self):
+        """
+        Description:
+        Pauses the music once it has faded out under the alarm
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self.media_list_player.set_pause(1)
+        self._music_ducked = True
+        if self.visualizer is not None:
+            self.visualizer.set_pause(True)
+
+    def _resume_music(self):
+        """
+        Description:
+        Brings the music back up after the alarm, unpausing it if the alarm
+        paused it
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        if self._music_ducked:
+            self._music_ducked = False
+            self.media_list_player.set_pause(0)
+            if self.visualizer is not None:
+                self.visualizer.set_pause(False)
+        if self.state in (vlc.State.Playing, vlc.State.Paused) or 'music' in self._envelopes:
+            self._fade('music', 1.0, self.crossfade_seconds)
+        else:
+            self._gains['music'] = 1.0
+
+    def _stop_alarm(self):
+        """
+        Description:
+        Worker side of stopping the alarm: fades the alarm out, then stops it,
+        and brings the music back
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self._deadlines['alarm'] = None
+        if self._pending_prepare is not None:
+            self._finish_prepare(False)
+            self.alarm_list_player.stop()
+        if self._alarm_playing:
+            self._alarm_playing = False
+            self._fade('alarm', 0.0, self.crossfade_seconds, self.alarm_list_player.stop)
+            self._resume_music()
+            logging.info(f"Stopped the alarm player")
+        elif self._alarm_prepared:
+            self._alarm_prepared = False
+            self.alarm_list_player.stop()
+
+    def _stop_music(self):
+        """
+        Description:
+        Worker side of stopping the music
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self._deadlines['music'] = None
+        self._shuffle = None
+        self._music_ducked = False
+        self._envelopes.pop('music', None)
+        self.media_list_player.stop()
+        if self.visualizer is not None:
+            self.visualizer.set_pause(True)
+        logging.info(f"Stopped the music player")
+
+    def _stop(self):
+        """
+        Description:
+        Worker side of stop() when no alarm is playing: stops the music and
+        drops a prepared alarm
+        
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self._stop_music()
+        self._stop_alarm()
+
+    def _enqueue(self, file_list):
+        """
+        Description:
+        Worker side of enqueue_files()
+        
+        Inputs:
+        file_list - A list of the music mp3s
+
+        Outputs:
+        None
+        """
+
+        for file_path in file_list:
+            self.media_list.add_media(self.instance.media_new(file_path))
+
+    def _seek(self, seconds):
+        """
+        Description:
+        Worker side of seek()
+        
+        Inputs:
+        seconds - position in the current song
+
+        Outputs:
+        None
+        """
+
+        self.media_list_player.get_media_player().set_time(int(seconds * 1000))
+
+    def _prepare(self, media, file_path, result_queue):
+        """
+        Description:
+        Worker side of prepare_alarm(). Loads the parsed alarm media and starts it
+        at zero volume. The worker doesn't wait for the audio output, the 'playing'
+        event or the 'prepare' deadline finishes the warm-up, see _finish_prepare().
+        
+        Inputs:
+        media - the parsed vlc media
+        file_path - path the media was made from, for the logs
+        result_queue - Queue that gets True or False when the warm-up is done
+
+        Outputs:
+        None
+        """
+
+        if self._alarm_playing or self._alarm_prepared:
+            result_queue.put(True)
+            return
+        if self._pending_prepare is not None:
+            self._finish_prepare(False)
+        self._load_alarm(media)
+        player = self.alarm_list_player.get_media_player()
+        player.audio_set_volume(0)
+        self._applied_volumes['alarm'] = 0
+        self._pending_prepare = (file_path, result_queue)
+        self._deadlines['prepare'] = time.monotonic() + PREPARE_TIMEOUT
+        self.alarm_list_player.play()
+
+    def _finish_prepare(self, result):
+        """
+        Description:
+        Ends a warm-up started by _prepare() and hands its result to prepare_alarm()
+        
+        Inputs:
+        result - True if the alarm is ready to play
+
+        Outputs:
+        None
+        """
+
+        self._deadlines['prepare'] = None
+        if self._pending_prepare is not None:
+            self._pending_prepare[1].put(result)
+            self._pending_prepare = None
+
+    def set_visualizer(self, visualizer, timeout=None):
+        """
+        Description:
+        Hooks a music_visualizer up to the music channel, so it follows every
+        song change, pause and stop. None unhooks it.
+        
+        Inputs:
+        visualizer - a music_visualizer, or None
+        timeout - seconds to wait for the playback worker to make the change, so
+                  no follow() that was already queued can reach an unhooked
+                  visualizer. None to not wait. The wait is bounded since the
+                  worker can be busy, and the caller is usually the main loop.
+
+        Outputs:
+        done - True if the worker made the change in time (always False without a timeout)
+        """
+
+        result_queue = Queue() if timeout is not None else None
+        self.command_queue.put(('attach_visualizer', (visualizer, result_queue)))
+        if result_queue is None:
+            return False
+        try:
+            return result_queue.get(timeout=timeout)
+        except Empty:
+            return False
+
+    def _attach_visualizer(self, visualizer, result_queue=None):
+        """
+        Description:
+        Worker side of set_visualizer()
+        
+        Inputs:
+        visualizer - a music_visualizer, or None
+        result_queue - Queue that gets True once the visualizer is set, or None
+
+        Outputs:
+        None
+        """
+
+        try:
+            self.visualizer = visualizer
+            if visualizer is not None and self.state == vlc.State.Playing and self.current_media_path is not None:
+                visualizer.follow(self.current_media_path, self.media_list_player.get_media_player().get_time())
+        finally:
+            if result_queue is not None:
+                result_queue.put(True)
 
     def play_files(self, file_list, shuffle=False, repeat_count=0, total_playtime=0):
         """
         Description:
-        Starts the thread that plays music
+        Asks the playback worker to play music. Whatever is playing is replaced.
         
         Inputs:
         file_list - A list of the music mp3s
@@ -106,15 +881,58 @@ class sound_blaster:
 
         if shuffle:
             random.shuffle(file_list)
-        if not self.play_thread or not self.play_thread.is_alive():
-            logging.info(f"Started the music player")
-            self.play_thread = threading.Thread(target=self._play, args=(file_list, repeat_count, total_playtime))
-            self.play_thread.start()
+        self.command_queue.put(('play', (file_list, repeat_count, total_playtime)))
+
+    def play_shuffled(self, file_list):
+        """
+        Description:
+        Asks the playback worker to play music in a random order, drawing the
+        songs lazily, see lazy_shuffle. Better than play_files(shuffle=True) for
+        big directories.
+        
+        Inputs:
+        file_list - A list of the music mp3s, it is not copied or changed
+
+        Outputs:
+        None
+        """
+
+        if file_list:
+            self.command_queue.put(('play_shuffled', (file_list,)))
+
+    def enqueue_files(self, file_list):
+        """
+        Description:
+        Adds music to the end of the current playlist
+        
+        Inputs:
+        file_list - A list of the music mp3s
+
+        Outputs:
+        None
+        """
+
+        self.command_queue.put(('enqueue', (file_list,)))
+
+    def seek(self, seconds):
+        """
+        Description:
+        Jumps to a position in the current song
+        
+        Inputs:
+        seconds - position in the current song
+
+        Outputs:
+        None
+        """
+
+        self.command_queue.put(('seek', (seconds,)))
 
     def stop(self):
         """
         Description:
-        Stops the thread that is playing music
+        If the alarm is playing, fades it out and brings back any music it
+        ducked. Otherwise stops the music. Any pending stop deadline is cancelled.
         
         Inputs:
         None
@@ -123,13 +941,17 @@ class sound_blaster:
         None
         """
 
-        logging.info(f"Stopped the music player")
-        self.media_list_player.stop()
+        if self._alarm_active:
+            self._alarm_active = False
+            self.command_queue.put(('stop_alarm', ()))
+        else:
+            self.command_queue.put(('stop', ()))
 
     def is_playing(self):
         """
         Description:
-        Asks if music is being played
+        Asks if music or the alarm is being played. This is a plain read of the
+        state kept up to date by the VLC events.
         
         Inputs:
         None
@@ -138,12 +960,27 @@ class sound_blaster:
         True if music is playing, False if not
         """
 
-        return self.media_list_player.get_state() == vlc.State.Playing
+        return self.state == vlc.State.Playing or self.alarm_state == vlc.State.Playing
+
+    def is_alarm_playing(self):
+        """
+        Description:
+        Asks if the alarm has been started and not stopped yet
+        
+        Inputs:
+        None
+
+        Outputs:
+        True if the alarm is on, False if not
+        """
+
+        return self._alarm_active
     
     def play_directory(self, directory, shuffle=True):
         """
         Description:
-        Plays music from a directory
+        Plays music from a directory. The music_dir songs come from the
+        music library index instead of a directory scan.
         
         Inputs:
         directory - A directory with only mp3 files inside to be played
@@ -153,11 +990,17 @@ class sound_blaster:
         None
         """
 
-        song_filenames = os.listdir(directory)
-        song_filepaths = []
-        for song_filename in song_filenames:
-            song_filepaths.append(directory + '/' + song_filename)
-        self.play_files(song_filepaths, shuffle=shuffle)
+        if directory == self.music_dir and self.library.entries:
+            song_filepaths = self.library.get_paths()
+        else:
+            song_filenames = os.listdir(directory)
+            song_filepaths = []
+            for song_filename in song_filenames:
+                song_filepaths.append(directory + '/' + song_filename)
+        if shuffle:
+            self.play_shuffled(song_filepaths)
+        else:
+            self.play_files(song_filepaths)
         logging.info(f"Music started from directory {directory}")
 
     def play_music_dir(self):
@@ -176,22 +1019,154 @@ class sound_blaster:
         logging.info(f"Playing music")
         self.play_directory(self.music_dir)
 
-    def play_alarm(self):
+    def play_alarm(self, volume=None):
         """
         Description:
         Plays the file that was specified as the alarm_filepath when the
-        class was instantiated
+        class was instantiated, on the alarm channel. Music that is playing
+        is ducked under it, and comes back when the alarm is stopped.
         
         Inputs:
-        None
+        volume - alarm volume (0-100), None to keep the last one
 
         Outputs:
         None
         """
 
         logging.info(f"Playing alarm sound")
-        self.play_files([self.alarm_filepath], total_playtime=3600)
-    
+        self._alarm_active = True
+        if volume is not None:
+            self._set_volume(volume)
+        self.command_queue.put(('play_alarm', (3600,)))
+
+    def _alarm_hot_path(self):
+        """
+        Description:
+        Gets the alarm file ready to be read from memory, see page_cache.hot_path().
+        If alarm_filepath has changed since it was last pinned, the old copy
+        is released first.
+        
+        Inputs:
+        None
+
+        Outputs:
+        file_path - the path to play the alarm from
+        """
+
+        if self._pinned_alarm is not None and self._pinned_alarm != self.alarm_filepath:
+            self.page_cache.release(self._pinned_alarm)
+            self._pinned_alarm = None
+        if not os.path.isfile(self.alarm_filepath):
+            return self.alarm_filepath
+        file_path = self.page_cache.hot_path(self.alarm_filepath)
+        if file_path != self.alarm_filepath:
+            self._pinned_alarm = self.alarm_filepath
+        return file_path
+
+    def _alarm_fallbacks(self, count=4):
+        """
+        Description:
+        Sounds to use when the alarm file can't be played, best first: the
+        synthesized alarm tone, then a few songs picked at random from the
+        music library
+        
+        Inputs:
+        count - most fallbacks to return
+
+        Outputs:
+        file_list - list of file paths
+        """
+
+        fallbacks = []
+        if self.alarm_tone_filepath is not None:
+            fallbacks.append(self.alarm_tone_filepath)
+        fallbacks.extend(self.library.sample_paths(count - len(fallbacks)))
+        return fallbacks
+
+    def _parse_media(self, file_path):
+        """
+        Description:
+        Creates a media object and waits for VLC to parse it, so opening it
+        later costs nothing
+        
+        Inputs:
+        file_path - path of the file to parse
+
+        Outputs:
+        media - the parsed vlc media, or None if the file is missing or could not be parsed
+        """
+
+        if not os.path.isfile(file_path):
+            logging.warning(f"sound_blaster: {file_path} does not exist")
+            return None
+        media = self.instance.media_new(file_path)
+        media.parse_with_options(vlc.MediaParseFlag.local, PREPARE_TIMEOUT*1000)
+        deadline = time.monotonic() + PREPARE_TIMEOUT
+        while media.get_parsed_status() == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if media.get_parsed_status() != vlc.MediaParsedStatus.done or media.get_duration() <= 0:
+            logging.warning(f"sound_blaster: unable to parse {file_path}")
+            return None
+        return media
+
+    def prepare_alarm(self):
+        """
+        Description:
+        Warm-up for the alarm. Pre-parses the alarm file (falling back to the
+        alarm tone or a song from music_dir if the alarm file is missing or
+        broken), then has the playback worker load it and briefly play it at zero
+        volume so the audio output is opened and known to be working. The alarm
+        player is then left paused at the start, and play_alarm() only has to
+        unpause it. The music channel is not touched.
+        The parsing can take seconds per file, so it runs on the calling thread,
+        and the worker, which also runs the stops, volume changes and fades,
+        only ever gets the ready media. Blocks the caller until the warm-up is done.
+        
+        Inputs:
+        None
+
+        Outputs:
+        True if the alarm is ready to play, False if not
+        """
+
+        if self._alarm_playing:
+            return True
+        media, file_path = self._parse_alarm()
+        if media is None:
+            logging.error("sound_blaster: no playable alarm sound found")
+            return False
+        if file_path != self.alarm_filepath:
+            logging.warning(f"sound_blaster: falling back to {file_path} for the alarm")
+        result_queue = Queue()
+        self.command_queue.put(('prepare', (media, file_path, result_queue)))
+        return result_queue.get()
+
+    def _parse_alarm(self):
+        """
+        Description:
+        Parses the alarm file, or the first fallback that parses if it can't be.
+        Runs on the caller of prepare_alarm(), not on the playback worker.
+        
+        Inputs:
+        None
+
+        Outputs:
+        media - the parsed vlc media, or None if nothing could be parsed
+        file_path - the file the media was made from
+        """
+
+        candidates = [self.alarm_filepath] + self._alarm_fallbacks()
+        for file_path in candidates:
+            if file_path == self.alarm_filepath:
+                media = self._parse_media(self._alarm_hot_path())
+            else:
+                #Fallbacks are only read ahead, not pinned, so they don't pile up in RAM
+                self.page_cache.prefetch(file_path)
+                media = self._parse_media(file_path)
+            if media is not None:
+                return media, file_path
+        return None, None
+
     def _set_volume(self, level):
         """
         Description:
@@ -217,20 +1192,18 @@ class sound_blaster:
             logging.warning("sound_blaster: volume value more than 100: %r. Volume will be set to 100", level)
             level_val = 100
 
-        try:
-            self.media_list_player.get_media_player().audio_set_volume(level_val)
-        except Exception:
-            # don’t crash if VLC isn’t ready
-            pass
+        channel = 'alarm' if self._alarm_active else 'music'
+        self._levels[channel] = level_val
+        self.command_queue.put(('apply_channel', (channel,)))
 
-        self._volume = level_val
-        logging.info(f"Volume set to {level_val}%")
+        logging.info(f"{channel.capitalize()} volume set to {level_val}%")
 
     @property
     def volume(self):
         """
         Description:
-        Current audio volume (0–100). Returns the last value actually set.
+        Current audio volume (0–100) of the alarm while it is on, otherwise
+        of the music. Returns the last value actually set.
         
         Inputs:
         None
@@ -238,7 +1211,7 @@ class sound_blaster:
         Outputs:
         volume - int from 0–100
         """
-        return getattr(self, "_volume", 50)
+        return self._levels['alarm' if self._alarm_active else 'music']
 
     @volume.setter
     def volume(self, value):
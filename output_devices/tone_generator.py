@@ -0,0 +1,212 @@
+import logging
+import os
+import wave
+import numpy as np
+
+class tone_generator:
+    """
+    Description:
+    Builds alarm sounds from scratch as NumPy PCM buffers, so there is always an alarm
+    even if the alarm mp3 is missing or broken. Each tone is generated in one vectorized
+    pass, cached in memory, and written once as a WAV file to tmpfs, which VLC plays
+    without any real decoding. The tones are made to loop cleanly.
+
+    Usage:
+    tone_handle = tone_generator()
+    file_path = tone_handle.wav_path("chime")
+    #play file_path
+
+    Available tones:
+    chime - repeating bell-like notes, params: notes (Hz), note_seconds
+    rising - tone that climbs in pitch and loudness, params: start_hz, end_hz
+    pink_noise - soft 1/f noise, like rain or a waterfall
+
+    Inputs:
+    sample_rate - samples per second of the generated sound
+    tmpfs_dir - directory to write the WAV files to
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, sample_rate=44100, tmpfs_dir="/dev/shm/smartbed"):
+        """
+        Description:
+        Initialization of the tone_generator class
+
+        Inputs:
+        sample_rate - see class def
+        tmpfs_dir - see class def
+
+        Outputs:
+        None
+        """
+
+        self.sample_rate = sample_rate
+        self.tmpfs_dir = tmpfs_dir
+        self.tones = {
+            'chime': self._chime,
+            'rising': self._rising,
+            'pink_noise': self._pink_noise,
+        }
+        self._buffers = {}
+        self._paths = {}
+        logging.info("Tone generator initialized")
+
+    def _time(self, seconds):
+        """
+        Description:
+        Time of every sample
+
+        Inputs:
+        seconds - length of the sound
+
+        Outputs:
+        t - array of sample times in seconds
+        """
+
+        return np.arange(int(seconds * self.sample_rate)) / self.sample_rate
+
+    def _chime(self, seconds, notes=(523.25, 659.25, 783.99, 1046.5), note_seconds=0.75):
+        """
+        Description:
+        Bell-like notes: a few inharmonic partials with an exponential decay,
+        played one after another
+
+        Inputs:
+        seconds - length of the sound
+        notes - frequencies of the notes in Hz
+        note_seconds - time between notes
+
+        Outputs:
+        samples - float array from -1 to 1
+        """
+
+        t = self._time(seconds)
+        note_t = t % note_seconds
+        note_num = (t // note_seconds).astype(int) % len(notes)
+        freq = np.asarray(notes)[note_num]
+        envelope = np.exp(-4.0 * note_t / note_seconds)
+        samples = np.zeros_like(t)
+        for partial, weight in ((1.0, 1.0), (2.76, 0.4), (5.4, 0.2)):
+            samples += weight * np.sin(2 * np.pi * partial * freq * note_t)
+        return samples * envelope
+
+    def _rising(self, seconds, start_hz=220.0, end_hz=880.0):
+        """
+        Description:
+        Exponential pitch sweep that also gets louder, pulsing twice a second
+
+        Inputs:
+        seconds - length of the sound
+        start_hz - starting pitch
+        end_hz - ending pitch
+
+        Outputs:
+        samples - float array from -1 to 1
+        """
+
+        t = self._time(seconds)
+        sweep_rate = np.log(end_hz / start_hz) / seconds
+        phase = 2 * np.pi * start_hz * (np.exp(sweep_rate * t) - 1) / sweep_rate
+        loudness = 0.3 + 0.7 * t / seconds
+        pulse = 0.5 + 0.5 * np.sin(2 * np.pi * 2.0 * t) ** 2
+        return np.sin(phase) * loudness * pulse
+
+    def _pink_noise(self, seconds):
+        """
+        Description:
+        Pink noise, made by shaping white noise to 1/f power in the frequency domain.
+        Shaping the whole buffer at once makes it loop without a click.
+
+        Inputs:
+        seconds - length of the sound
+
+        Outputs:
+        samples - float array from -1 to 1
+        """
+
+        num_samples = int(seconds * self.sample_rate)
+        spectrum = np.fft.rfft(np.random.default_rng(0).standard_normal(num_samples))
+        freqs = np.arange(len(spectrum))
+        freqs[0] = 1
+        samples = np.fft.irfft(spectrum / np.sqrt(freqs), num_samples)
+        return samples
+
+    def _key(self, name, seconds, params):
+        """
+        Description:
+        Cache key for a tone
+
+        Inputs:
+        See build()
+
+        Outputs:
+        key - hashable tuple
+        """
+
+        if name not in self.tones:
+            raise ValueError(f"Unknown alarm tone: {name}")
+        frozen = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in params.items()))
+        return (name, float(seconds), frozen)
+
+    def build(self, name, seconds=10.0, **params):
+        """
+        Description:
+        Returns the PCM buffer for a tone, building it only the first time
+
+        Inputs:
+        name - name of the tone, one of tone_generator.tones
+        seconds - length of the tone, it is meant to be looped
+        params - tone specific parameters, see class def
+
+        Outputs:
+        pcm - read-only int16 array
+        """
+
+        key = self._key(name, seconds, params)
+        pcm = self._buffers.get(key)
+        if pcm is None:
+            samples = self.tones[name](seconds, **params)
+            #Normalize with a little headroom, and a short fade at both ends so the loop point doesn't click
+            samples = samples * (0.8 / max(np.max(np.abs(samples)), 1e-9))
+            fade = min(len(samples) // 2, int(0.01 * self.sample_rate))
+            ramp = np.linspace(0.0, 1.0, fade)
+            samples[:fade] *= ramp
+            samples[len(samples) - fade:] *= ramp[::-1]
+            pcm = (samples * 32767).astype(np.int16)
+            pcm.flags.writeable = False
+            self._buffers[key] = pcm
+        return pcm
+
+    def wav_path(self, name, seconds=10.0, **params):
+        """
+        Description:
+        Returns a WAV file of the tone in tmpfs, writing it only the first time
+
+        Inputs:
+        See build()
+
+        Outputs:
+        file_path - path of the WAV file, or None if it could not be written
+        """
+
+        key = self._key(name, seconds, params)
+        pcm = self.build(name, seconds, **params)
+        file_path = self._paths.get(key)
+        if file_path is not None and os.path.isfile(file_path):
+            return file_path
+        file_path = os.path.join(self.tmpfs_dir, f"tone_{name}_{len(self._paths)}.wav")
+        try:
+            os.makedirs(self.tmpfs_dir, exist_ok=True)
+            with wave.open(file_path, 'wb') as wav_file:
+                wav_file.setnchannels(1)
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(self.sample_rate)
+                wav_file.writeframes(pcm.tobytes())
+        except OSError:
+            logging.warning(f"tone_generator: unable to write {file_path}")
+            return None
+        self._paths[key] = file_path
+        logging.info(f"Alarm tone {name} written to {file_path}")
+        return file_path
@@ -0,0 +1,218 @@
+import logging
+import subprocess
+import threading
+import time
+import datetime
+
+#Field ranges of a crontab line: minute, hour, day of month, month, day of week
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+CRON_NICKNAMES = {
+    '@yearly': "0 0 1 1 *",
+    '@annually': "0 0 1 1 *",
+    '@monthly': "0 0 1 * *",
+    '@weekly': "0 0 * * 0",
+    '@daily': "0 0 * * *",
+    '@midnight': "0 0 * * *",
+    '@hourly': "0 * * * *",
+}
+CRON_NAMES = {
+    3: {name: num for num, name in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep',
+                                               'oct', 'nov', 'dec'], 1)},
+    4: {name: num for num, name in enumerate(['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'])},
+}
+
+class cron_schedule:
+    """
+    Description:
+    Finds when the alarm will next go off, by reading the user's crontab. The
+    alarm is started by a cron job that creates the cron_alarm_filepath file, so
+    every crontab line that mentions match_text is an alarm time. Supports the
+    usual crontab syntax: *, lists, ranges, steps, month and day names, and the
+    @daily style nicknames (not @reboot). The crontab is read once when the class
+    is created, then re-read every reload_seconds on a background thread, since
+    running crontab takes a fork/exec (and up to 5 s if it hangs) and next_time()
+    is called from the main loop. The parsed entries are swapped in all at once,
+    so next_time() always sees either the old or the new crontab.
+
+    Usage:
+    schedule_handle = cron_schedule("/home/gabe/.smartbed/startalarm.start")
+    next_alarm = schedule_handle.next_time() #time.time() of the next alarm, or None
+
+    Inputs:
+    match_text - text a crontab line has to contain to count as an alarm
+    reload_seconds - how long the parsed crontab is reused
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, match_text, reload_seconds=3600):
+        """
+        Description:
+        Initialization of the cron_schedule class
+
+        Inputs:
+        See class def
+
+        Outputs:
+        None
+        """
+
+        self.match_text = match_text
+        self.reload_seconds = reload_seconds
+        self.entries = []
+        self.loaded_time = None
+        self._reload_thread = None
+        self.reload()
+
+    def _parse_field(self, text, field_num):
+        """
+        Description:
+        Parses one crontab time field
+
+        Inputs:
+        text - the field, e.g. "*/15", "1-5", "mon,wed"
+        field_num - index into CRON_FIELDS
+
+        Outputs:
+        values - set of the matching values
+        """
+
+        low, high = CRON_FIELDS[field_num]
+        names = CRON_NAMES.get(field_num, {})
+        values = set()
+        for part in text.lower().split(','):
+            step = 1
+            if '/' in part:
+                part, step_text = part.split('/')
+                step = int(step_text)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(names.get(value, value)) for value in part.split('-'))
+            else:
+                start = int(names.get(part, part))
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Bad crontab field: {text}")
+            values.update(range(start, end + 1, step))
+        if field_num == 4 and 7 in values:
+            #Sunday can be 0 or 7
+            values.discard(7)
+            values.add(0)
+        return values
+
+    def _parse_line(self, line):
+        """
+        Description:
+        Parses the time part of a crontab line
+
+        Inputs:
+        line - a crontab line
+
+        Outputs:
+        entry - (minutes, hours, days, months, weekdays, day_restricted, weekday_restricted)
+        """
+
+        fields = line.split()
+        if fields[0] in CRON_NICKNAMES:
+            fields = CRON_NICKNAMES[fields[0]].split()
+        if len(fields) < 5:
+            raise ValueError(f"Bad crontab line: {line}")
+        values = [self._parse_field(fields[num], num) for num in range(5)]
+        return tuple(values) + (fields[2] != '*', fields[4] != '*')
+
+    def reload(self):
+        """
+        Description:
+        Reads the crontab and keeps the lines that start the alarm. Blocks
+        while crontab runs, next_time() runs it on a background thread.
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self.loaded_time = time.monotonic()
+        try:
+            crontab = subprocess.run(["crontab", "-l"], capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.SubprocessError):
+            logging.warning("cron_schedule: unable to read the crontab")
+            return
+        entries = []
+        for line in crontab.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#') or self.match_text not in line:
+                continue
+            try:
+                entries.append(self._parse_line(line))
+            except ValueError:
+                logging.warning(f"cron_schedule: skipping crontab line {line}")
+        self.entries = entries
+        logging.debug(f"cron_schedule: {len(entries)} alarm lines in the crontab")
+
+    def _day_matches(self, entry, day):
+        """
+        Description:
+        Checks the date fields of an entry. Like cron, when both the day of month
+        and the day of week are restricted, either one matching is enough.
+
+        Inputs:
+        entry - parsed crontab line
+        day - datetime.date
+
+        Outputs:
+        True if the entry runs on that day
+        """
+
+        _, _, days, months, weekdays, day_restricted, weekday_restricted = entry
+        if day.month not in months:
+            return False
+        day_match = day.day in days
+        weekday_match = (day.weekday() + 1) % 7 in weekdays
+        if day_restricted and weekday_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def next_time(self, now=None):
+        """
+        Description:
+        Time the alarm will next go off
+
+        Inputs:
+        now - time.time() to search from, None for now
+
+        Outputs:
+        next_time - time.time() of the next alarm after now, None if there isn't one
+                    in the next year
+        """
+
+        if time.monotonic() - self.loaded_time > self.reload_seconds and \
+                (self._reload_thread is None or not self._reload_thread.is_alive()):
+            self._reload_thread = threading.Thread(target=self.reload, daemon=True)
+            self._reload_thread.start()
+        entries = self.entries
+        if not entries:
+            return None
+        if now is None:
+            now = time.time()
+        start = datetime.datetime.fromtimestamp(now).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        for day_offset in range(367):
+            day = start.date() + datetime.timedelta(days=day_offset)
+            best = None
+            for entry in entries:
+                if not self._day_matches(entry, day):
+                    continue
+                for hour in sorted(entry[1]):
+                    minutes = [minute for minute in sorted(entry[0])
+                               if datetime.datetime.combine(day, datetime.time(hour, minute)) >= start]
+                    if minutes:
+                        candidate = datetime.datetime.combine(day, datetime.time(hour, minutes[0]))
+                        if best is None or candidate < best:
+                            best = candidate
+                        break
+            if best is not None:
+                return best.timestamp()
+        return None
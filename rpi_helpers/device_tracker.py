@@ -1,51 +1,121 @@
 import logging
-import time, os
+import os
+import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from rpi_helpers.icmp_prober import icmp_prober
+from rpi_helpers.presence_history import presence_history
+from rpi_helpers.neighbour_table import neighbour_table
 
 class device_tracker:
     """
     Description:
-    This class tracks a device by its IP address. It pings the device every hour
-    and records whether it recieves a reply. Then the parent can call
-    is_device_present(num_hours), which will return true if the device was
-    present for all of the previous num_hours hours.
-    
+    This class tracks devices by their IP addresses. It pings every device and
+    records whether it recieves a reply in a minute by minute presence_history
+    for each device. The probes follow an adaptive schedule: every probe_interval
+    seconds while nothing changes, every dense_interval seconds in the
+    dense_window seconds before the next alarm, and again after recheck_seconds
+    when a device comes or goes. Between probes the thread sleeps until the next
+    one is due. All the devices are probed at
+    the same time on a small thread pool, so a round takes as long as the slowest
+    device, not the sum of them. With passive on, the kernel neighbour table is
+    watched as well: reachability changes are recorded as they happen, and a
+    device is only actively probed when the kernel has no fresh answer for it,
+    which saves waking the phones up. Then the parent can call
+    is_device_present(num_hours), which will return true if the devices were
+    present for all of the previous num_hours hours, according to the policy:
+      any - at least one of the devices was present
+      all - every device was present
+
     Usage:
-    Instantiate the class, and run is_device_present() to see if the device
-    has responded to pings within that time period
+    Instantiate the class, and run is_device_present() to see if the devices
+    have responded to pings within that time period
+    tracker_handle = device_tracker({'gabe_phone': "192.168.1.50", 'partner_phone': "192.168.1.51"})
+    tracker_handle.is_device_present(6, policy='all')
 
     Inputs:
-    device_ip - A string with the device IP, e.g. "192.168.1.1"
+    devices - A dict of device name to IP, e.g. {'phone': "192.168.1.1"}, or a
+              single IP string, which is tracked under the name 'device'
+    probe_timeout - Seconds allowed for each presence check, see icmp_prober
+    max_workers - Maximum number of devices probed at the same time
+    probe_interval - Seconds between probes while presence is stable
+    dense_interval - Seconds between probes in the window before an alarm
+    dense_window - Seconds before the next alarm that are probed densely
+    recheck_seconds - Seconds until a re-probe after a device came or went
+    next_alarm_function - Returns the time.time() of the next alarm or None, e.g.
+                          cron_schedule.next_time. None to never probe densely.
+    change_function - Called as change_function(name, present) when a device comes
+                      or goes, from the tracker's threads. None for no callback.
+    history_hours - Longest trailing window that can be checked
+    passive - Use the kernel neighbour table before probing, see neighbour_table
+    history_dir - Directory to keep each device's presence history file in, so it
+                  survives a restart. None to keep it in memory only.
 
     Outputs:
     None
     """
 
-    def __init__(self, device_ip):
+    policies = ('any', 'all')
+
+    def __init__(self, devices, probe_timeout=2.0, max_workers=4, probe_interval=1800, history_hours=24,
+                 passive=True, history_dir=None, dense_interval=60, dense_window=3600, recheck_seconds=15,
+                 next_alarm_function=None, change_function=None):
         """
         Description:
         Initialization of the alarm_sequence class
-        
+
         Inputs:
-        device_ip - See class description
+        devices - See class description
+        probe_timeout - See class description
+        max_workers - See class description
+        probe_interval - See class description
+        history_hours - See class description
+        passive - See class description
+        history_dir - See class description
+        dense_interval - See class description
+        dense_window - See class description
+        recheck_seconds - See class description
+        next_alarm_function - See class description
+        change_function - See class description
 
         Outputs:
         None
         """
 
-        self.device_ip = device_ip
+        if isinstance(devices, str):
+            devices = {'device': devices}
+        if not devices:
+            raise ValueError("device_tracker needs at least one device")
+        self.devices = dict(devices)
+        self.prober = icmp_prober(timeout=probe_timeout)
+        self.probe_pool = ThreadPoolExecutor(max_workers=min(max_workers, len(self.devices)))
+        self.probe_interval = probe_interval
+        self.dense_interval = dense_interval
+        self.dense_window = dense_window
+        self.recheck_seconds = recheck_seconds
+        self.next_alarm_function = next_alarm_function
+        self.change_function = change_function
+        self.history_hours = history_hours
+        self.history_dir = history_dir
         self.initialize_devicetrack_dict()
-        self.current_hr = int(time.localtime()[3])-1
+        #The neighbour listener can call neighbour_change() straight away, which needs these
         self.stop_flag = threading.Event()
+        self.wake_flag = threading.Event()
+        self.neighbours = None
+        if passive:
+            self.neighbours = neighbour_table(self.devices, self.neighbour_change)
+            self.neighbours.start()
         self.start_ping_loop()
-        logging.info("Device tracker successfully initialized")
+        logging.info(f"Device tracker successfully initialized for {', '.join(self.devices)}")
 
     def initialize_devicetrack_dict(self):
         """
         Description:
-        Initialization of the devicetrack_dict that tracks whether the device
-        has responded to pings in the last 24 hours.
-        
+        Initialization of the devicetrack dict, which holds the presence_history
+        of each device for the last history_hours hours. With a history_dir, the
+        histories are mapped from their files, so what was recorded before a
+        restart is kept.
+
         Inputs:
         None
 
@@ -54,35 +124,106 @@ class device_tracker:
         """
 
         self.devicetrack = {}
-        for i in range(24):
-            self.devicetrack[i] = False
+        for name in self.devices:
+            filepath = None
+            if self.history_dir is not None:
+                filepath = os.path.join(self.history_dir, f"{name}.presence")
+            self.devicetrack[name] = presence_history(self.history_hours * 60, filepath)
 
-    def ping(self):
+    def ping(self, name):
         """
         Description:
-        Function to ping the device located at the initialized IP address.
-        
+        Function to ping one of the tracked devices.
+
         Inputs:
-        None
+        name - name of the device
 
         Outputs:
-        None
+        True if the device answered
         """
 
-        command = "ping -c 10 " + self.device_ip
-        result = os.system(f"{command} > /dev/null 2>&1") #Add output suppression to the command
-        if result == 0:
-            logging.info("Initialized device WAS found on the network.")
+        if self.neighbours is not None:
+            present = self.neighbours.get_state(name)
+            if present is not None:
+                logging.debug(f"Device {name} {'is' if present else 'is not'} in the neighbour table, not probing")
+                return present
+        result = self.prober.probe(self.devices[name])
+        if result['alive']:
+            if result['method'] == 'icmp':
+                logging.info(f"Device {name} WAS found on the network. RTT {result['rtt_avg']*1000:.1f} ms")
+            else:
+                logging.info(f"Device {name} WAS found on the network (ARP).")
             return True
         else:
-            logging.info("Initialized device WAS NOT found on the network.")
+            logging.info(f"Device {name} WAS NOT found on the network.")
             return False
 
+    def neighbour_change(self, name, present):
+        """
+        Description:
+        Records a presence change reported by the neighbour table. Runs on the
+        neighbour_table listener thread.
+
+        Inputs:
+        name - name of the device
+        present - True if the device became reachable
+
+        Outputs:
+        None
+        """
+
+        logging.info(f"Device {name} {'appeared on' if present else 'left'} the network (neighbour table)")
+        self.devicetrack[name].record(present)
+        if self.change_function is not None:
+            self.change_function(name, present)
+        self.wake_flag.set()
+
+    def ping_all(self):
+        """
+        Description:
+        Pings every tracked device at the same time
+
+        Inputs:
+        None
+
+        Outputs:
+        results - dict of device name to True if the device answered
+        """
+
+        return dict(zip(self.devices, self.probe_pool.map(self.ping, self.devices)))
+
+    def probe_delay(self, changed):
+        """
+        Description:
+        Works out how long to sleep until the next probe
+
+        Inputs:
+        changed - True if the last probe found a device had come or gone
+
+        Outputs:
+        delay - seconds until the next probe
+        """
+
+        if changed:
+            return self.recheck_seconds
+        delay = self.probe_interval
+        if self.next_alarm_function is not None:
+            next_alarm = self.next_alarm_function()
+            if next_alarm is not None:
+                until_alarm = next_alarm - time.time()
+                if until_alarm <= self.dense_window:
+                    delay = self.dense_interval
+                else:
+                    #Wake up when the dense window starts
+                    delay = min(delay, until_alarm - self.dense_window)
+        return delay
+
     def ping_loop(self):
         """
         Description:
-        Function to call the ping function every hour.
-        
+        Function to ping the devices on the adaptive schedule, see probe_delay().
+        A neighbour table change wakes it up early.
+
         Inputs:
         None
 
@@ -90,18 +231,27 @@ class device_tracker:
         None
         """
 
-        while(1):
-            hr = int(time.localtime()[3])
-            if self.current_hr != hr:
-                self.devicetrack[hr] = self.ping()
-                self.current_hr = hr
-            time.sleep(10)
+        last_results = {}
+        while not self.stop_flag.is_set():
+            self.wake_flag.clear()
+            results = self.ping_all()
+            changed = False
+            for name, present in results.items():
+                self.devicetrack[name].record(present)
+                if last_results.get(name, present) != present:
+                    changed = True
+                    if self.change_function is not None:
+                        self.change_function(name, present)
+            last_results = results
+            delay = self.probe_delay(changed)
+            logging.debug(f"Device tracker: next probe in {delay:.0f} s")
+            self.wake_flag.wait(delay)
 
     def start_ping_loop(self):
         """
         Description:
         Starts off a new thread for the ping_loop() function
-        
+
         Inputs:
         None
 
@@ -116,7 +266,7 @@ class device_tracker:
         """
         Description:
         Stops the thread started by start_ping_loop()
-        
+
         Inputs:
         None
 
@@ -125,37 +275,81 @@ class device_tracker:
         """
 
         self.stop_flag.set()
+        self.wake_flag.set()
         self.ping_thread.join()
+        self.probe_pool.shutdown(wait=False)
+        if self.neighbours is not None:
+            self.neighbours.stop()
+        for history in self.devicetrack.values():
+            history.close()
 
-    def is_device_present(self, trailing_hours = 6):
+    def _is_present(self, name, trailing_hours, min_fraction):
         """
         Description:
-        Checks the self.devicetrack dict to see if the device has been present
+        Checks the presence history to see if one device has been present
         for the last trailing_hours hours
-        
+
         Inputs:
+        name - name of the device
         trailing_hours - number of hours to check for the device being present
+        min_fraction - see is_device_present()
 
         Outputs:
-        None
+        True if the device was present
+        """
+
+        minutes = int(trailing_hours * 60)
+        if min_fraction >= 1:
+            return self.devicetrack[name].present_for(minutes)
+        return self.devicetrack[name].fraction_present(minutes) >= min_fraction
+
+    def fraction_present(self, name, trailing_hours = 6):
+        """
+        Description:
+        Fraction of the last trailing_hours hours a device was present
+
+        Inputs:
+        name - name of the device
+        trailing_hours - number of hours to look back
+
+        Outputs:
+        fraction - from 0 to 1
         """
 
-        hr = int(time.localtime()[3])
-        for i in range(trailing_hours):
-            test_hr = hr - i
-            if test_hr < 0:
-                test_hr + 24
-            if not self.devicetrack[test_hr]:
-                logging.debug("Device not present")
-                return False
-        logging.debug("Device present")
-        return True
+        return self.devicetrack[name].fraction_present(int(trailing_hours * 60))
+
+    def is_device_present(self, trailing_hours = 6, policy = 'any', names = None, min_fraction = 1.0):
+        """
+        Description:
+        Checks whether the devices have been present for the last
+        trailing_hours hours
+
+        Inputs:
+        trailing_hours - number of hours to check for the devices being present
+        policy - 'any' if one present device is enough, 'all' if every device
+                 has to be present
+        names - list of the device names to check, None for every device
+        min_fraction - fraction of the time a device has to have been present,
+                       1 for all of it. Lower values allow for missed pings.
+
+        Outputs:
+        True if the devices were present according to the policy
+        """
+
+        if policy not in self.policies:
+            raise ValueError(f"Unknown presence policy: {policy}")
+        if names is None:
+            names = self.devices
+        check = any if policy == 'any' else all
+        present = check(self._is_present(name, trailing_hours, min_fraction) for name in names)
+        logging.debug(f"Devices {'present' if present else 'not present'} ({policy} of {', '.join(names)})")
+        return present
 
     def __del__(self):
         """
         Description:
         Destructor for the class, ensures all threads are stopped
-        
+
         Inputs:
         None
 
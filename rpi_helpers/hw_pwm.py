@@ -72,6 +72,24 @@ class hw_pwm:
         self.pwmobj = pigpio.pi()
         self.pwmobj.set_mode(self.gpio_num, pigpio.OUTPUT)
 
+    def is_connected(self):
+        """
+        Description:
+        Checks that pigpiod is still answering commands
+        
+        Inputs:
+        None
+
+        Outputs:
+        True if pigpiod responded, False if not
+        """
+
+        try:
+            self.pwmobj.get_current_tick()
+        except Exception:
+            return False
+        return bool(self.pwmobj.connected)
+
     def _set_pwm(self, pwm):
         """
         Private helper that clamps and writes PWM to hardware.
@@ -104,7 +122,7 @@ class hw_pwm:
 
         # update last-known duty cycle
         self._dutycycle = pwm_val
-        logging.info("HW PWM on GPIO %s set to %s%%", self.gpio_num, pwm_val)
+        logging.debug("HW PWM on GPIO %s set to %s%%", self.gpio_num, pwm_val)
 
     def set_pwm(self, pwm):
         """
@@ -0,0 +1,315 @@
+import logging
+import os
+import socket
+import select
+import struct
+import time
+from rpi_helpers.neighbour_table import (NLMSG_HEADER, NDMSG, RTATTR, RTM_GETNEIGH, RTM_NEWNEIGH, NLM_F_REQUEST,
+                                         NLM_F_DUMP, NLMSG_DONE, NLMSG_ERROR, NDA_DST, NUD_REACHABLE, NUD_FAILED)
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+#UDP port the ARP fallback sends its poke to, any port works since only the ARP exchange matters
+ARP_POKE_PORT = 9
+ARP_TABLE_FILEPATH = "/proc/net/arp"
+#/proc/net/arp flag for a resolved entry
+ATF_COM = 0x2
+
+class icmp_prober:
+    """
+    Description:
+    Checks whether a device is on the network without starting a process.
+    It sends ICMP echo requests itself, on an unprivileged datagram ICMP socket
+    (allowed when the user's group is in net.ipv4.ping_group_range), or a raw
+    socket when running as root. It returns at the first reply. If neither socket
+    can be opened, or the device does not answer pings (phones often don't while
+    asleep), it falls back to ARP: a UDP packet makes the kernel resolve the
+    address, and only a fresh answer counts. With netlink that is the neighbour
+    entry being REACHABLE (the device answered the kernel in the last ~30 s).
+    Without it, the /proc/net/arp entry has to be seen unresolved after the poke
+    and then resolved again. A cached entry for a device that has left is not
+    enough. A STALE entry only becomes REACHABLE after the kernel's ~5 s DELAY
+    state, so the ARP fallback has its own, longer, arp_timeout.
+
+    Usage:
+    prober_handle = icmp_prober()
+    result = prober_handle.probe("192.168.1.1")
+    if result['alive']:
+        print(result['rtt_avg'])
+
+    Inputs:
+    timeout - Total time allowed for one probe, in seconds
+    interval - Time between echo requests, in seconds
+    replies - Number of replies to collect for the RTT stats before returning
+    arp_fallback - Whether to try ARP when the ping gets no reply
+    arp_timeout - Time allowed for the ARP fallback, in seconds
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, timeout=1.0, interval=0.2, replies=1, arp_fallback=True, arp_timeout=6.0):
+        """
+        Description:
+        Initialization of the icmp_prober class
+
+        Inputs:
+        See class def
+
+        Outputs:
+        None
+        """
+
+        self.timeout = timeout
+        self.interval = interval
+        self.replies = replies
+        self.arp_fallback = arp_fallback
+        self.arp_timeout = arp_timeout
+        self._ident = os.getpid() & 0xFFFF
+        self._sequence = 0
+
+    def _checksum(self, data):
+        """
+        Description:
+        Internet checksum (RFC 1071)
+
+        Inputs:
+        data - bytes to checksum
+
+        Outputs:
+        checksum - 16 bit checksum
+        """
+
+        if len(data) % 2:
+            data += b'\x00'
+        total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
+
+    def _open_socket(self):
+        """
+        Description:
+        Opens an ICMP socket, datagram if allowed, otherwise raw
+
+        Inputs:
+        None
+
+        Outputs:
+        icmp_socket - the socket, or None if neither kind is allowed
+        raw - True if it is a raw socket (replies include the IP header)
+        """
+
+        for sock_type, raw in ((socket.SOCK_DGRAM, False), (socket.SOCK_RAW, True)):
+            try:
+                return socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP), raw
+            except OSError:
+                continue
+        return None, False
+
+    def _echo_request(self, sequence):
+        """
+        Description:
+        Builds an ICMP echo request carrying its send time
+
+        Inputs:
+        sequence - ICMP sequence number
+
+        Outputs:
+        packet - bytes
+        """
+
+        payload = struct.pack("!d", time.monotonic())
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self._ident, sequence)
+        checksum = self._checksum(header + payload)
+        return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, self._ident, sequence) + payload
+
+    def _ping(self, ip, deadline):
+        """
+        Description:
+        Sends echo requests every interval until enough replies come back or the
+        deadline passes
+
+        Inputs:
+        ip - address to probe
+        deadline - time.monotonic() to give up at
+
+        Outputs:
+        rtts - list of round trip times in seconds, None if no ICMP socket could be opened
+        """
+
+        icmp_socket, raw = self._open_socket()
+        if icmp_socket is None:
+            logging.debug("icmp_prober: no ICMP socket allowed, using ARP")
+            return None
+        rtts = []
+        sent = set()
+        next_send = time.monotonic()
+        try:
+            while len(rtts) < self.replies:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if now >= next_send:
+                    self._sequence = (self._sequence + 1) & 0xFFFF
+                    try:
+                        icmp_socket.sendto(self._echo_request(self._sequence), (ip, 0))
+                    except OSError:
+                        #e.g. no route to host
+                        break
+                    sent.add(self._sequence)
+                    next_send = now + self.interval
+                readable, _, _ = select.select([icmp_socket], [], [], max(0, min(next_send, deadline) - now))
+                if not readable:
+                    continue
+                packet, address = icmp_socket.recvfrom(1024)
+                received = time.monotonic()
+                if raw:
+                    packet = packet[(packet[0] & 0x0F) * 4:]
+                if address[0] != ip or len(packet) < 16:
+                    continue
+                icmp_type, _, _, ident, sequence = struct.unpack("!BBHHH", packet[:8])
+                #Datagram sockets rewrite the identifier, so only raw sockets check it
+                if icmp_type != ICMP_ECHO_REPLY or sequence not in sent or (raw and ident != self._ident):
+                    continue
+                sent.discard(sequence)
+                rtts.append(received - struct.unpack("!d", packet[8:16])[0])
+        finally:
+            icmp_socket.close()
+        return rtts
+
+    def _nud_state(self, ip):
+        """
+        Description:
+        Reads the neighbour (NUD) state of an address with an rtnetlink dump
+
+        Inputs:
+        ip - address to look up
+
+        Outputs:
+        state - NUD state, 0 if there is no entry, None if netlink is unavailable
+        """
+
+        try:
+            with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as netlink_socket:
+                request = NLMSG_HEADER.pack(NLMSG_HEADER.size + NDMSG.size, RTM_GETNEIGH,
+                                            NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+                netlink_socket.send(request + NDMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0))
+                address = socket.inet_aton(ip)
+                found = 0
+                while True:
+                    readable, _, _ = select.select([netlink_socket], [], [], 1.0)
+                    if not readable:
+                        return found
+                    data = netlink_socket.recv(65536)
+                    offset = 0
+                    while offset + NLMSG_HEADER.size <= len(data):
+                        msg_len, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                        if msg_len < NLMSG_HEADER.size or msg_type in (NLMSG_DONE, NLMSG_ERROR):
+                            return found
+                        if msg_type == RTM_NEWNEIGH:
+                            body = offset + NLMSG_HEADER.size
+                            state = NDMSG.unpack_from(data, body)[4]
+                            attr = body + NDMSG.size
+                            while attr + RTATTR.size <= offset + msg_len:
+                                attr_len, attr_type = RTATTR.unpack_from(data, attr)
+                                if attr_len < RTATTR.size:
+                                    break
+                                if attr_type == NDA_DST and data[attr + RTATTR.size:attr + attr_len] == address:
+                                    found = state
+                                attr += (attr_len + 3) & ~3
+                        offset += (msg_len + 3) & ~3
+        except (OSError, AttributeError):
+            return None
+
+    def _arp_entry(self, ip):
+        """
+        Description:
+        Looks up an address in /proc/net/arp
+
+        Inputs:
+        ip - address to look up
+
+        Outputs:
+        resolved - True if there is a resolved entry with a hardware address,
+                   False if the entry is unresolved or missing
+        """
+
+        try:
+            with open(ARP_TABLE_FILEPATH, 'r') as arp_file:
+                next(arp_file)
+                for line in arp_file:
+                    fields = line.split()
+                    if len(fields) >= 4 and fields[0] == ip:
+                        return bool(int(fields[2], 16) & ATF_COM) and fields[3] != "00:00:00:00:00:00"
+        except (OSError, StopIteration, ValueError):
+            pass
+        return False
+
+    def _arp(self, ip, deadline):
+        """
+        Description:
+        Makes the kernel resolve the address with a UDP packet, then polls the
+        neighbour table until the device has freshly answered or the deadline
+        passes. A resolved entry left over from before the poke does not count.
+
+        Inputs:
+        ip - address to probe
+        deadline - time.monotonic() to give up at
+
+        Outputs:
+        alive - True if the device answered the kernel
+        """
+
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as poke_socket:
+                poke_socket.sendto(b'', (ip, ARP_POKE_PORT))
+        except OSError:
+            return False
+        seen_unresolved = False
+        while True:
+            state = self._nud_state(ip)
+            if state is not None:
+                if state & NUD_REACHABLE:
+                    return True
+                if state & NUD_FAILED:
+                    return False
+            else:
+                #No netlink: the entry has to go unresolved after the poke, then resolve
+                resolved = self._arp_entry(ip)
+                if not resolved:
+                    seen_unresolved = True
+                elif seen_unresolved:
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def probe(self, ip):
+        """
+        Description:
+        Probes one device, returning as soon as it answers
+
+        Inputs:
+        ip - address of the device, e.g. "192.168.1.1"
+
+        Outputs:
+        result - dict with:
+                 alive - True if the device answered
+                 method - 'icmp' or 'arp', whichever got the answer (None if neither did)
+                 rtt_min, rtt_avg, rtt_max - round trip times in seconds, None without ping replies
+                 elapsed - time the probe took in seconds
+        """
+
+        start = time.monotonic()
+        deadline = start + self.timeout
+        result = {'alive': False, 'method': None, 'rtt_min': None, 'rtt_avg': None, 'rtt_max': None}
+        rtts = self._ping(ip, deadline)
+        if rtts:
+            result.update(alive=True, method='icmp', rtt_min=min(rtts), rtt_avg=sum(rtts) / len(rtts),
+                          rtt_max=max(rtts))
+        elif self.arp_fallback or rtts is None:
+            if self._arp(ip, time.monotonic() + self.arp_timeout):
+                result.update(alive=True, method='arp')
+        result['elapsed'] = time.monotonic() - start
+        return result
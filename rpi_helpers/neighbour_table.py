@@ -0,0 +1,312 @@
+import logging
+import socket
+import select
+import struct
+import threading
+import time
+
+#rtnetlink constants, see linux/rtnetlink.h and linux/neighbour.h
+RTMGRP_NEIGH = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NDA_DST = 1
+NLMSG_HEADER = struct.Struct("=IHHII")
+NDMSG = struct.Struct("=BBHiHBB")
+RTATTR = struct.Struct("=HH")
+
+#Neighbour (NUD) states
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_DELAY = 0x08
+NUD_PROBE = 0x10
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+#States that say for sure whether the device answered the kernel recently.
+#INCOMPLETE is not one of them, it only means a resolution is in progress.
+NUD_PRESENT = NUD_REACHABLE | NUD_PERMANENT | NUD_NOARP
+NUD_ABSENT = NUD_FAILED
+
+ARP_TABLE_FILEPATH = "/proc/net/arp"
+#/proc/net/arp flag for a resolved entry
+ATF_COM = 0x2
+
+class neighbour_table:
+    """
+    Description:
+    Passive presence source. The kernel already keeps track of which devices on
+    the LAN answer it, in the IPv4 neighbour cache. This class subscribes to the
+    rtnetlink neighbour events, so it hears about every reachability change of the
+    tracked addresses as it happens, without sending anything to the devices.
+    A REACHABLE entry means the device was heard from in the last ~30 seconds, and
+    FAILED (or the entry being deleted) means it did not answer the kernel.
+    INCOMPLETE only means the kernel is resolving the address right now, which
+    happens for a present device too. It and the in-between states (STALE, DELAY,
+    PROBE) say nothing new, so for those get_state() returns None, the caller
+    should probe, and the reported presence is left as it was. change_function is
+    only called when the presence flips, not on the kernel's regular
+    REACHABLE -> STALE -> REACHABLE cycle. No state is trusted for longer than
+    max_age_seconds, so an old absent entry leads to a probe too. If netlink cannot
+    be opened, /proc/net/arp is read instead, which can't tell an unresolved entry
+    from a failed one, so neither kind of entry is ever fresh there.
+
+    Usage:
+    neighbour_handle = neighbour_table({'phone': "192.168.1.50"}, change_function)
+    neighbour_handle.start()
+    neighbour_handle.get_state('phone') #True, False or None
+
+    Inputs:
+    devices - dict of device name to IP
+    change_function - called as change_function(name, present) on the listener
+                      thread when a device's presence flips: it becomes REACHABLE
+                      after being absent or unknown, or FAILED / deleted after
+                      being present or unknown.
+                      None to only poll get_state()
+    max_age_seconds - Age after which any entry is treated as stale and the device
+                      should be probed, e.g. in case the kernel's move to STALE
+                      was missed, or a device came back without talking
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, devices, change_function=None, max_age_seconds=60):
+        """
+        Description:
+        Initialization of the neighbour_table class
+
+        Inputs:
+        See class def
+
+        Outputs:
+        None
+        """
+
+        self.devices = dict(devices)
+        self.names_by_ip = {ip: name for name, ip in self.devices.items()}
+        self.change_function = change_function
+        self.max_age_seconds = max_age_seconds
+        self.states = {}
+        #Last presence reported to change_function for each name
+        self.present = {}
+        self.stop_flag = threading.Event()
+        self.listen_thread = None
+        self.netlink_socket = None
+        try:
+            self.netlink_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.netlink_socket.bind((0, RTMGRP_NEIGH))
+        except (OSError, AttributeError):
+            self.netlink_socket = None
+            logging.warning("neighbour_table: rtnetlink is unavailable, falling back to /proc/net/arp")
+
+    def _parse(self, data):
+        """
+        Description:
+        Parses a buffer of netlink messages and updates the neighbour states
+
+        Inputs:
+        data - bytes received from the netlink socket
+
+        Outputs:
+        done - True if the buffer ended a dump
+        """
+
+        done = False
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            msg_len, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+            if msg_len < NLMSG_HEADER.size:
+                break
+            if msg_type in (NLMSG_DONE, NLMSG_ERROR):
+                done = True
+            elif msg_type in (RTM_NEWNEIGH, RTM_DELNEIGH):
+                body = offset + NLMSG_HEADER.size
+                family, _, _, _, state, _, _ = NDMSG.unpack_from(data, body)
+                if family == socket.AF_INET:
+                    attr = body + NDMSG.size
+                    end = offset + msg_len
+                    while attr + RTATTR.size <= end:
+                        attr_len, attr_type = RTATTR.unpack_from(data, attr)
+                        if attr_len < RTATTR.size:
+                            break
+                        if attr_type == NDA_DST:
+                            ip = socket.inet_ntoa(data[attr + RTATTR.size:attr + RTATTR.size + 4])
+                            if msg_type == RTM_DELNEIGH:
+                                state = NUD_FAILED
+                            self._update(ip, state)
+                        attr += (attr_len + 3) & ~3
+            offset += (msg_len + 3) & ~3
+        return done
+
+    def _update(self, ip, state, fresh=True):
+        """
+        Description:
+        Records a neighbour state and reports a change of presence
+
+        Inputs:
+        ip - address of the neighbour
+        state - NUD state
+        fresh - True if the kernel just reported the state. False if it was only
+                read back, then an unchanged state keeps its age.
+
+        Outputs:
+        None
+        """
+
+        name = self.names_by_ip.get(ip)
+        if name is None:
+            return
+        previous, updated = self.states.get(name, (0, 0))
+        if fresh or state != previous:
+            updated = time.monotonic()
+        self.states[name] = (state, updated)
+        if state & NUD_PRESENT:
+            present = True
+        elif state & NUD_ABSENT:
+            present = False
+        else:
+            #INCOMPLETE, STALE, DELAY, PROBE: the presence stays as it was
+            return
+        logging.debug(f"neighbour_table: {name} state 0x{state:02x}")
+        if self.present.get(name) == present:
+            return
+        self.present[name] = present
+        if self.change_function is not None:
+            self.change_function(name, present)
+
+    def _dump(self):
+        """
+        Description:
+        Asks the kernel for the whole IPv4 neighbour table, to start from the
+        current states
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        request = NLMSG_HEADER.pack(NLMSG_HEADER.size + NDMSG.size, RTM_GETNEIGH, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+        request += NDMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0)
+        self.netlink_socket.send(request)
+        while not self.stop_flag.is_set():
+            readable, _, _ = select.select([self.netlink_socket], [], [], 1.0)
+            if not readable or self._parse(self.netlink_socket.recv(65536)):
+                return
+
+    def _listen_loop(self):
+        """
+        Description:
+        Reads neighbour events until stop() is called
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        try:
+            self._dump()
+            while not self.stop_flag.is_set():
+                readable, _, _ = select.select([self.netlink_socket], [], [], 1.0)
+                if readable:
+                    self._parse(self.netlink_socket.recv(65536))
+        except OSError:
+            logging.exception("neighbour_table: netlink listener failed")
+
+    def _read_arp_table(self):
+        """
+        Description:
+        Updates the states from /proc/net/arp, used when netlink is unavailable.
+        Resolved entries are recorded as STALE since their age is unknown, and
+        unresolved ones as INCOMPLETE since they may still be resolving.
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        try:
+            with open(ARP_TABLE_FILEPATH, 'r') as arp_file:
+                next(arp_file)
+                for line in arp_file:
+                    fields = line.split()
+                    if len(fields) >= 4 and fields[0] in self.names_by_ip:
+                        resolved = int(fields[2], 16) & ATF_COM and fields[3] != "00:00:00:00:00:00"
+                        self._update(fields[0], NUD_STALE if resolved else NUD_INCOMPLETE, fresh=False)
+        except (OSError, StopIteration, ValueError):
+            pass
+
+    def start(self):
+        """
+        Description:
+        Starts listening for neighbour events
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        if self.netlink_socket is None:
+            return
+        self.stop_flag.clear()
+        self.listen_thread = threading.Thread(target=self._listen_loop, daemon=True)
+        self.listen_thread.start()
+        logging.info("Neighbour table listener started")
+
+    def stop(self):
+        """
+        Description:
+        Stops the listener thread
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self.stop_flag.set()
+        if self.listen_thread is not None:
+            self.listen_thread.join()
+        if self.netlink_socket is not None:
+            self.netlink_socket.close()
+            self.netlink_socket = None
+
+    def get_state(self, name):
+        """
+        Description:
+        Presence of a device according to the kernel, if the kernel knows
+
+        Inputs:
+        name - name of the device
+
+        Outputs:
+        present - True if REACHABLE, False if FAILED or deleted, None if the
+                  entry is INCOMPLETE (still resolving), STALE, DELAY, PROBE,
+                  older than max_age_seconds or missing and the device should
+                  be probed
+        """
+
+        if self.netlink_socket is None:
+            self._read_arp_table()
+        state, updated = self.states.get(name, (0, 0))
+        if time.monotonic() - updated > self.max_age_seconds:
+            return None
+        if state & NUD_PRESENT:
+            return True
+        if state & NUD_ABSENT:
+            return False
+        return None
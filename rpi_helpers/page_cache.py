@@ -0,0 +1,191 @@
+import logging
+import os
+import mmap
+import shutil
+import hashlib
+
+class page_cache:
+    """
+    Description:
+    Keeps files hot in memory so the first read doesn't have to wait on the SD card.
+    There are three modes:
+      off - do nothing
+      fadvise - ask the kernel to read the file into the page cache in the background
+                (posix_fadvise WILLNEED), the file is still played from its normal path
+      tmpfs - copy the file to a tmpfs directory and keep it mmapped with MAP_POPULATE,
+              so every page is in RAM and the copy is what gets played
+
+    Usage:
+    cache_handle = page_cache("tmpfs")
+    file_path = cache_handle.hot_path("/home/gabe/Music/alarms/alarm.mp3")
+    #play file_path
+    cache_handle.prefetch("/home/gabe/Music/music_playlist/next_song.mp3")
+
+    Inputs:
+    mode - one of 'off', 'fadvise', 'tmpfs'
+    tmpfs_dir - directory on a tmpfs mount to copy files to in tmpfs mode
+
+    Outputs:
+    None
+    """
+
+    modes = ('off', 'fadvise', 'tmpfs')
+
+    def __init__(self, mode="off", tmpfs_dir="/dev/shm/smartbed"):
+        """
+        Description:
+        Initialization of the page_cache class
+
+        Inputs:
+        mode - see class def
+        tmpfs_dir - see class def
+
+        Outputs:
+        None
+        """
+
+        if mode not in self.modes:
+            raise ValueError(f"Unknown page cache mode: {mode}")
+        self.mode = mode
+        self.tmpfs_dir = tmpfs_dir
+        self._pinned = {}
+        logging.info(f"Page cache initialized in {mode} mode")
+
+    def __del__(self):
+        """
+        Description:
+        Destructor for the class, removes the tmpfs copies
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self.release_all()
+
+    def prefetch(self, file_path):
+        """
+        Description:
+        Starts reading the file into the page cache without waiting for it.
+        Does nothing in off mode.
+
+        Inputs:
+        file_path - path of the file
+
+        Outputs:
+        True if the kernel was asked to read the file, False if not
+        """
+
+        if self.mode == 'off':
+            return False
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            logging.warning(f"page_cache: unable to open {file_path}")
+            return False
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+        logging.debug(f"page_cache: prefetching {file_path}")
+        return True
+
+    def pin(self, file_path):
+        """
+        Description:
+        Copies the file to tmpfs and maps every page of the copy into memory.
+        The mapping is kept until release() so the pages stay resident. The copy
+        is named after a hash of the full path, so files with the same name in
+        different directories don't overwrite each other, and it is made again
+        if the source file's size or modification time has changed.
+
+        Inputs:
+        file_path - path of the file
+
+        Outputs:
+        pinned_path - path of the tmpfs copy, or None if it could not be made
+        """
+
+        try:
+            source_stat = os.stat(file_path)
+        except OSError:
+            logging.warning(f"page_cache: unable to pin {file_path}, it can't be read")
+            return None
+        signature = (source_stat.st_mtime_ns, source_stat.st_size)
+        if file_path in self._pinned:
+            if self._pinned[file_path][2] == signature:
+                return self._pinned[file_path][0]
+            logging.info(f"page_cache: {file_path} has changed, copying it again")
+            self.release(file_path)
+        path_hash = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16]
+        pinned_path = os.path.join(self.tmpfs_dir, f"{path_hash}_{os.path.basename(file_path)}")
+        try:
+            os.makedirs(self.tmpfs_dir, exist_ok=True)
+            shutil.copyfile(file_path, pinned_path)
+            with open(pinned_path, 'rb') as pinned_file:
+                mapping = mmap.mmap(pinned_file.fileno(), 0, flags=mmap.MAP_SHARED | mmap.MAP_POPULATE,
+                                    prot=mmap.PROT_READ)
+        except (OSError, ValueError):
+            logging.warning(f"page_cache: unable to pin {file_path} in {self.tmpfs_dir}")
+            return None
+        self._pinned[file_path] = (pinned_path, mapping, signature)
+        logging.info(f"page_cache: pinned {file_path} at {pinned_path}")
+        return pinned_path
+
+    def hot_path(self, file_path):
+        """
+        Description:
+        Gets the file ready to be read from memory according to the mode
+
+        Inputs:
+        file_path - path of the file
+
+        Outputs:
+        file_path - the path to play: the tmpfs copy in tmpfs mode, otherwise
+                    the original path
+        """
+
+        if self.mode == 'tmpfs':
+            pinned_path = self.pin(file_path)
+            if pinned_path is not None:
+                return pinned_path
+        self.prefetch(file_path)
+        return file_path
+
+    def release(self, file_path):
+        """
+        Description:
+        Unmaps and deletes the tmpfs copy of a file
+
+        Inputs:
+        file_path - the original path given to pin()
+
+        Outputs:
+        None
+        """
+
+        pinned_path, mapping, _ = self._pinned.pop(file_path, (None, None, None))
+        if mapping is None:
+            return
+        mapping.close()
+        try:
+            os.remove(pinned_path)
+        except OSError:
+            pass
+
+    def release_all(self):
+        """
+        Description:
+        Releases every pinned file
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        for file_path in list(self._pinned):
+            self.release(file_path)
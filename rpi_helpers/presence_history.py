@@ -0,0 +1,302 @@
+import logging
+import os
+import mmap
+import threading
+import time
+import numpy as np
+
+#Counts are stored as uint32 and wrap around, differences are taken modulo 2**32
+COUNT_MASK = 0xFFFFFFFF
+#History file layout: a header of int64 fields, then the uint32 count ring
+HISTORY_MAGIC = 0x50524553454E4331 #"PRESENC1"
+HEADER_MAGIC, HEADER_CAPACITY, HEADER_FIRST_MINUTE, HEADER_LAST_MINUTE, HEADER_LAST_STATE = range(5)
+HEADER_FIELDS = 8
+#first_minute/last_minute before the first sample
+NO_MINUTE = -1
+
+class presence_history:
+    """
+    Description:
+    Minute by minute presence record of one device. Minutes are numbered from the
+    epoch, so there is no wrap at midnight. The ring does not store the samples
+    themselves, but the running count of present minutes (a prefix sum) for the
+    last capacity+1 minutes. "Present for the last N minutes" and "fraction of the
+    last N minutes present" are then one subtraction each, whatever N is. Minutes
+    between two samples take the state of the earlier sample, and so do the
+    minutes from the last sample up to now.
+
+    With a filepath, the header and the ring live in a fixed-size memory-mapped
+    file, so the history survives a restart and is usable as soon as the file is
+    mapped, with nothing to parse. Recording a sample is a few stores into the
+    mapping, and the kernel writes the pages back. After a restart, the time the
+    tracker was down is filled with the last recorded state.
+
+    Usage:
+    history_handle = presence_history()
+    history_handle.record(True)
+    history_handle.present_for(360) #Present for the last 6 hours?
+    history_handle.fraction_present(60) #Fraction of the last hour present
+
+    Inputs:
+    capacity_minutes - Longest window that can be queried, in minutes
+    filepath - File to keep the history in, None to keep it in memory only
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, capacity_minutes=24*60, filepath=None):
+        """
+        Description:
+        Initialization of the presence_history class
+
+        Inputs:
+        capacity_minutes - see class def
+        filepath - see class def
+
+        Outputs:
+        None
+        """
+
+        self.capacity = capacity_minutes
+        self.filepath = filepath
+        self.mapping = None
+        size = HEADER_FIELDS * 8 + (capacity_minutes + 1) * 4
+        buffer = None
+        if filepath is not None:
+            buffer = self._map_file(filepath, size)
+        if buffer is None:
+            buffer = bytearray(size)
+        self.header = np.frombuffer(buffer, dtype=np.int64, count=HEADER_FIELDS)
+        self.cum = np.frombuffer(buffer, dtype=np.uint32, offset=HEADER_FIELDS * 8)
+        if self.header[HEADER_MAGIC] != HISTORY_MAGIC or self.header[HEADER_CAPACITY] != capacity_minutes:
+            if filepath is not None and self.header[HEADER_MAGIC] != 0:
+                logging.warning(f"presence_history: {filepath} does not match, starting a new history")
+            self.cum[:] = 0
+            self.header[:] = 0
+            self.header[HEADER_CAPACITY] = capacity_minutes
+            self.header[HEADER_FIRST_MINUTE] = NO_MINUTE
+            self.header[HEADER_LAST_MINUTE] = NO_MINUTE
+            self.header[HEADER_MAGIC] = HISTORY_MAGIC
+        elif self.first_minute is not None:
+            logging.info(f"presence_history: recovered {self.last_minute - self.first_minute + 1} minutes from {filepath}")
+        self.lock = threading.Lock()
+
+    def _map_file(self, filepath, size):
+        """
+        Description:
+        Opens (or creates) the history file at the right size and maps it
+
+        Inputs:
+        filepath - path of the history file
+        size - size of the file in bytes
+
+        Outputs:
+        mapping - writable mmap of the file, or None if it could not be mapped
+        """
+
+        try:
+            os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+            fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                self.mapping = mmap.mmap(fd, size, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+        except OSError:
+            logging.warning(f"presence_history: unable to map {filepath}, keeping the history in memory")
+            return None
+        return self.mapping
+
+    @property
+    def first_minute(self):
+        minute = int(self.header[HEADER_FIRST_MINUTE])
+        return None if minute == NO_MINUTE else minute
+
+    @first_minute.setter
+    def first_minute(self, minute):
+        self.header[HEADER_FIRST_MINUTE] = NO_MINUTE if minute is None else minute
+
+    @property
+    def last_minute(self):
+        minute = int(self.header[HEADER_LAST_MINUTE])
+        return None if minute == NO_MINUTE else minute
+
+    @last_minute.setter
+    def last_minute(self, minute):
+        self.header[HEADER_LAST_MINUTE] = NO_MINUTE if minute is None else minute
+
+    @property
+    def last_state(self):
+        return bool(self.header[HEADER_LAST_STATE])
+
+    @last_state.setter
+    def last_state(self, state):
+        self.header[HEADER_LAST_STATE] = int(state)
+
+    def close(self):
+        """
+        Description:
+        Writes the history file back to disk and unmaps it. The history can't be
+        used afterwards.
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        if self.mapping is None:
+            return
+        with self.lock:
+            self.mapping.flush()
+            #The NumPy views have to go before the mapping can be closed
+            del self.header, self.cum
+            self.mapping.close()
+            self.mapping = None
+
+    def _minute(self, now=None):
+        """
+        Description:
+        Minute number of a time
+
+        Inputs:
+        now - time.time() value, None for now
+
+        Outputs:
+        minute - minutes since the epoch
+        """
+
+        if now is None:
+            now = time.time()
+        return int(now // 60)
+
+    def _count(self, minute):
+        """
+        Description:
+        Number of present minutes from the first sample up to and including minute.
+        minute has to be within the ring.
+
+        Inputs:
+        minute - minute number
+
+        Outputs:
+        count - present minute count (modulo 2**32)
+        """
+
+        if minute < self.first_minute:
+            return 0
+        return int(self.cum[minute % len(self.cum)])
+
+    def _advance(self, minute):
+        """
+        Description:
+        Fills the ring forward from the last sample up to minute with the state of
+        the last sample. At most capacity+1 slots are written, however long the gap.
+
+        Inputs:
+        minute - minute number to fill up to
+
+        Outputs:
+        None
+        """
+
+        if self.last_minute is None or minute <= self.last_minute:
+            return
+        last_count = self._count(self.last_minute)
+        start = max(self.last_minute + 1, minute - self.capacity)
+        steps = np.arange(start - self.last_minute, minute - self.last_minute + 1, dtype=np.uint64)
+        counts = (last_count + steps * int(self.last_state)) & COUNT_MASK
+        slots = np.arange(start, minute + 1) % len(self.cum)
+        self.cum[slots] = counts
+        self.last_minute = minute
+
+    def record(self, present, now=None):
+        """
+        Description:
+        Records a sample. A second sample in the same minute replaces the first.
+
+        Inputs:
+        present - True if the device was seen
+        now - time.time() of the sample, None for now
+
+        Outputs:
+        None
+        """
+
+        minute = self._minute(now)
+        with self.lock:
+            if self.first_minute is None:
+                self.first_minute = minute
+                self.last_minute = minute
+            elif minute < self.last_minute:
+                logging.debug("presence_history: ignoring a sample older than the last one")
+                return
+            else:
+                self._advance(minute)
+            self.cum[minute % len(self.cum)] = (self._count(minute - 1) + int(present)) & COUNT_MASK
+            self.last_state = bool(present)
+
+    def _window(self, minutes, now):
+        """
+        Description:
+        Present minute count and number of recorded minutes in the trailing window
+
+        Inputs:
+        minutes - length of the window, at most capacity
+        now - time.time() the window ends at, None for now
+
+        Outputs:
+        present - number of present minutes in the window
+        covered - number of minutes of the window that have been recorded
+        """
+
+        if not 0 < minutes <= self.capacity:
+            raise ValueError(f"Presence window must be 1 to {self.capacity} minutes")
+        minute = self._minute(now)
+        with self.lock:
+            if self.first_minute is None:
+                return 0, 0
+            self._advance(minute)
+            minute = min(minute, self.last_minute)
+            present = (self._count(minute) - self._count(minute - minutes)) & COUNT_MASK
+            covered = min(minutes, minute - self.first_minute + 1)
+        return present, covered
+
+    def present_for(self, minutes, now=None):
+        """
+        Description:
+        Checks whether the device was present for every one of the last minutes
+
+        Inputs:
+        minutes - length of the window
+        now - time.time() the window ends at, None for now
+
+        Outputs:
+        True if every minute of the window was recorded as present
+        """
+
+        present, covered = self._window(minutes, now)
+        return covered == minutes and present == minutes
+
+    def fraction_present(self, minutes, now=None):
+        """
+        Description:
+        Fraction of the last minutes the device was present, out of the minutes
+        that have been recorded
+
+        Inputs:
+        minutes - length of the window
+        now - time.time() the window ends at, None for now
+
+        Outputs:
+        fraction - from 0 to 1, 0 if nothing has been recorded
+        """
+
+        present, covered = self._window(minutes, now)
+        if covered == 0:
+            return 0.0
+        return present / covered
@@ -0,0 +1,269 @@
+import logging
+import os
+import gc
+import math
+import ctypes
+import threading
+import time
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+class realtime:
+    """
+    Description:
+    Opt-in "realtime" helpers for the timing critical threads (the sunrise/PWM thread and
+    the input threads). Each privilege is tried on its own and the result is kept in
+    self.report, since most of them need root or CAP_SYS_NICE / CAP_IPC_LOCK:
+      - SCHED_FIFO scheduling for a thread, falling back to a raised nice level
+      - pinning a thread to the given CPUs
+      - mlockall() so the process memory never gets paged out
+      - gc.freeze() so the garbage collector stops scanning everything created at startup
+
+    Usage:
+    realtime_handle = realtime(priority=50, cpus=[3])
+    realtime_handle.lock_memory()
+    Then at the start of each timing critical thread, which logs what the kernel
+    actually applied to it:
+    realtime_handle.enable_thread("sunrise")
+    Threads started from a realtime thread inherit its policy, so helper threads
+    go back to normal scheduling first:
+    realtime_handle.disable_thread("warmup")
+    And once startup is done:
+    realtime_handle.freeze_heap()
+
+    Inputs:
+    priority - SCHED_FIFO priority (1-99) for the threads
+    cpus - list of CPUs to pin the threads to, None to leave the affinity alone
+    fallback_nice - nice level to use if SCHED_FIFO is not allowed
+
+    Outputs:
+    None
+    """
+
+    def __init__(self, priority=50, cpus=None, fallback_nice=-10):
+        """
+        Description:
+        Initialization of the realtime class
+
+        Inputs:
+        priority - see class def
+        cpus - see class def
+        fallback_nice - see class def
+
+        Outputs:
+        None
+        """
+
+        self.priority = priority
+        self.cpus = cpus
+        self.fallback_nice = fallback_nice
+        self.report = {}
+        #Affinity of the main thread, which disable_thread() goes back to
+        try:
+            self.default_cpus = os.sched_getaffinity(0)
+        except (OSError, AttributeError):
+            self.default_cpus = None
+        logging.info("Realtime mode initialized")
+
+    def lock_memory(self):
+        """
+        Description:
+        Locks all current and future process memory into RAM with mlockall()
+
+        Inputs:
+        None
+
+        Outputs:
+        True if the memory was locked, False if not
+        """
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            granted = True
+        except (OSError, AttributeError) as e:
+            logging.warning(f"Realtime: mlockall not granted ({e})")
+            granted = False
+        self.report['mlockall'] = granted
+        return granted
+
+    def freeze_heap(self):
+        """
+        Description:
+        Collects garbage once, then moves everything left into the permanent
+        generation so later collections only look at new objects
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        gc.collect()
+        gc.freeze()
+        self.report['gc_freeze'] = gc.get_freeze_count()
+        logging.info(f"Realtime: froze {self.report['gc_freeze']} objects")
+
+    def enable_thread(self, name):
+        """
+        Description:
+        Raises the scheduling priority of the calling thread and pins it to
+        self.cpus. Must be called from inside the thread.
+
+        Inputs:
+        name - name of the thread, used in the report
+
+        Outputs:
+        None
+        """
+
+        thread_id = threading.get_native_id()
+        try:
+            os.sched_setscheduler(thread_id, os.SCHED_FIFO, os.sched_param(self.priority))
+            scheduling = f"SCHED_FIFO {self.priority}"
+        except (OSError, AttributeError):
+            try:
+                os.setpriority(os.PRIO_PROCESS, thread_id, self.fallback_nice)
+                scheduling = f"nice {self.fallback_nice}"
+            except OSError:
+                scheduling = "not granted"
+
+        affinity = "not requested"
+        if self.cpus is not None:
+            try:
+                os.sched_setaffinity(thread_id, self.cpus)
+                affinity = f"CPUs {sorted(self.cpus)}"
+            except (OSError, ValueError):
+                affinity = "not granted"
+
+        self.report[name] = {'scheduling': scheduling, 'affinity': affinity}
+        self._log_thread(name, thread_id)
+
+    def disable_thread(self, name):
+        """
+        Description:
+        Puts the calling thread back on normal (SCHED_OTHER) scheduling with the
+        main thread's affinity. For helper threads started from a realtime thread,
+        which would otherwise inherit SCHED_FIFO. Must be called from inside the thread.
+
+        Inputs:
+        name - name of the thread, used in the report
+
+        Outputs:
+        None
+        """
+
+        thread_id = threading.get_native_id()
+        try:
+            os.sched_setscheduler(thread_id, os.SCHED_OTHER, os.sched_param(0))
+            scheduling = "SCHED_OTHER"
+        except (OSError, AttributeError):
+            scheduling = "not reset"
+        try:
+            #Only needed after the nice fallback, lowering the priority is always allowed
+            os.setpriority(os.PRIO_PROCESS, thread_id, 0)
+        except OSError:
+            pass
+        affinity = "not requested"
+        if self.cpus is not None and self.default_cpus is not None:
+            try:
+                os.sched_setaffinity(thread_id, self.default_cpus)
+                affinity = f"CPUs {sorted(self.default_cpus)}"
+            except (OSError, ValueError):
+                affinity = "not reset"
+        self.report[name] = {'scheduling': scheduling, 'affinity': affinity}
+        self._log_thread(name, thread_id)
+
+    def _log_thread(self, name, thread_id):
+        """
+        Description:
+        Logs the scheduling the kernel reports for a thread, along with the
+        process wide privileges, so the report reflects what each thread really runs with
+
+        Inputs:
+        name - name of the thread
+        thread_id - native id of the thread
+
+        Outputs:
+        None
+        """
+
+        try:
+            policy = os.sched_getscheduler(thread_id)
+            policy_name = {os.SCHED_FIFO: "SCHED_FIFO", os.SCHED_RR: "SCHED_RR",
+                           os.SCHED_OTHER: "SCHED_OTHER"}.get(policy, str(policy))
+            applied = f"{policy_name} {os.sched_getparam(thread_id).sched_priority}, " \
+                      f"nice {os.getpriority(os.PRIO_PROCESS, thread_id)}, CPUs {sorted(os.sched_getaffinity(thread_id))}"
+        except (OSError, AttributeError):
+            applied = "unknown"
+        self.report[name]['applied'] = applied
+        logging.info(f"Realtime: {name} thread requested {self.report[name]['scheduling']}, affinity "
+                     f"{self.report[name]['affinity']}; running with {applied}; "
+                     f"mlockall {self.report.get('mlockall')}, gc_freeze {self.report.get('gc_freeze')}")
+
+    def measure_jitter(self, use_realtime=False, period=0.005, samples=200):
+        """
+        Description:
+        Measures how late a thread wakes up from periodic sleeps, which is what
+        the sunrise and input threads do all day. Runs in its own thread so the
+        realtime settings can be applied to it like to the real threads.
+
+        Inputs:
+        use_realtime - apply enable_thread() to the measuring thread first
+        period - sleep period in seconds
+        samples - number of sleeps to measure
+
+        Outputs:
+        stats - dict with the mean, 99th percentile and max wakeup lateness in microseconds
+        """
+
+        lateness = []
+
+        def measure():
+            if use_realtime:
+                self.enable_thread("jitter_test")
+            deadline = time.monotonic()
+            for _ in range(samples):
+                deadline += period
+                time.sleep(max(0, deadline - time.monotonic()))
+                lateness.append((time.monotonic() - deadline)*1e6)
+
+        measure_thread = threading.Thread(target=measure)
+        measure_thread.start()
+        measure_thread.join()
+
+        lateness.sort()
+        stats = {
+            'mean_us': sum(lateness)/len(lateness),
+            #Nearest-rank percentile: the smallest sample with at least 99% of them at or below it
+            'p99_us': lateness[min(len(lateness) - 1, math.ceil(len(lateness)*0.99) - 1)],
+            'max_us': lateness[-1],
+        }
+        logging.info("Realtime: %s wakeup lateness mean %.0fus, p99 %.0fus, max %.0fus",
+                     "realtime" if use_realtime else "normal", stats['mean_us'], stats['p99_us'], stats['max_us'])
+        return stats
+
+    def log_report(self):
+        """
+        Description:
+        Measures the wakeup jitter with and without the realtime settings, and
+        logs the improvement. Each thread logs its own scheduling when it calls
+        enable_thread(), so this does not report on the threads.
+
+        Inputs:
+        None
+
+        Outputs:
+        report - dict of everything that was tried and the jitter results
+        """
+
+        normal = self.measure_jitter(use_realtime=False)
+        tuned = self.measure_jitter(use_realtime=True)
+        self.report['jitter_normal'] = normal
+        self.report['jitter_realtime'] = tuned
+        logging.info("Realtime: p99 wakeup lateness %.0fus -> %.0fus, max %.0fus -> %.0fus",
+                     normal['p99_us'], tuned['p99_us'], normal['max_us'], tuned['max_us'])
+        return self.report
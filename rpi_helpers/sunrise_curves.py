@@ -0,0 +1,258 @@
+import logging
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def _exponential(t, start=1.0, end=100.0):
+    """
+    Exponential rise from start to end, because pwm works better that way.
+    With the defaults this is the same curve the alarm always used:
+    np.exp(np.linspace(0, np.log(100), n))
+    """
+    return start * np.exp(t * np.log(end / start))
+
+def _logistic(t, start=1.0, end=100.0, steepness=10.0, midpoint=0.5):
+    """
+    S-shaped rise, normalized so that it starts exactly at start and ends exactly at end
+    """
+    s = 1.0 / (1.0 + np.exp(-steepness * (t - midpoint)))
+    s0 = 1.0 / (1.0 + np.exp(steepness * midpoint))
+    s1 = 1.0 / (1.0 + np.exp(-steepness * (1.0 - midpoint)))
+    return start + (end - start) * (s - s0) / (s1 - s0)
+
+def _cie_linear(t, start=0.0, end=100.0):
+    """
+    Rise that is linear in perceived lightness (CIE 1976 L*), converted back to
+    luminance, which is what the PWM duty cycle controls
+    """
+    lightness = t * 100.0
+    luminance = np.where(lightness > 8.0, ((lightness + 16.0) / 116.0) ** 3, lightness / 903.3)
+    return start + (end - start) * luminance
+
+def _keyframes(t, keyframes=((0.0, 1.0), (1.0, 100.0))):
+    """
+    Piecewise linear curve through (fraction_of_sunrise, pwm) keyframes
+    """
+    keyframe_times, keyframe_values = zip(*sorted(keyframes))
+    return np.interp(t, keyframe_times, keyframe_values)
+
+class sunrise_curves:
+    """
+    Description:
+    Library of named, parameterized sunrise curves. Every curve is generated in one
+    vectorized NumPy call and memoized by (shape, duration, frame rate, channel count,
+    parameters), so once a curve has been built, starting an alarm does no curve math.
+    A small in-memory LRU holds the recent curves, and if cache_dir is given the curves
+    are also saved as .npy files so they survive a reboot.
+
+    Usage:
+    curve_handle = sunrise_curves("/home/gabe/.smartbed/curve_cache")
+    curve = curve_handle.get_curve("exponential", 900, 10)
+    for pwm_value in curve[:, 0]:
+        led_handle.set_pwm(pwm_value)
+
+    Available shapes:
+    exponential - start, end
+    logistic - start, end, steepness, midpoint
+    cie_linear - start, end
+    keyframes - keyframes, a list of (fraction_of_sunrise, pwm) pairs
+
+    Inputs:
+    cache_dir - Directory for the on-disk cache, None to keep the curves in memory only
+    max_entries - Number of curves to keep in the in-memory LRU
+
+    Outputs:
+    None
+    """
+
+    shapes = {
+        'exponential': _exponential,
+        'logistic': _logistic,
+        'cie_linear': _cie_linear,
+        'keyframes': _keyframes,
+    }
+
+    def __init__(self, cache_dir=None, max_entries=8):
+        """
+        Description:
+        Initialization of the sunrise_curves class
+
+        Inputs:
+        cache_dir - see class def
+        max_entries - see class def
+
+        Outputs:
+        None
+        """
+
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            except OSError:
+                logging.warning("sunrise_curves: unable to create cache dir %s, disk cache disabled", self.cache_dir)
+                self.cache_dir = None
+        logging.info("Sunrise curve library initialized")
+
+    def get_curve(self, shape, duration_s, frame_rate, channels=1, **params):
+        """
+        Description:
+        Returns the curve for the given shape and timing, building it only if it is not
+        already cached
+
+        Inputs:
+        shape - name of the curve, one of sunrise_curves.shapes
+        duration_s - length of the sunrise in seconds
+        frame_rate - number of pwm updates per second
+        channels - number of light channels
+        params - shape specific parameters, see class def
+
+        Outputs:
+        curve - read-only array of pwm values (0-100) with shape (frames, channels)
+        """
+
+        if shape not in self.shapes:
+            raise ValueError(f"Unknown sunrise curve shape: {shape}")
+        if not frame_rate > 0:
+            raise ValueError(f"Sunrise frame rate must be more than 0, not {frame_rate}")
+        key = (shape, float(duration_s), float(frame_rate), int(channels), self._freeze(params))
+
+        with self._lock:
+            curve = self._cache.get(key)
+            if curve is not None:
+                self._cache.move_to_end(key)
+                return curve
+
+        curve = self._load(key)
+        if curve is None:
+            curve = self._build(shape, duration_s, frame_rate, channels, params)
+            self._save(key, curve)
+
+        with self._lock:
+            self._cache[key] = curve
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return curve
+
+    def clear(self):
+        """
+        Description:
+        Empties the in-memory LRU. The on-disk cache is left alone.
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        with self._lock:
+            self._cache.clear()
+
+    def _build(self, shape, duration_s, frame_rate, channels, params):
+        """
+        Description:
+        Generates the curve, one frame per 1/frame_rate seconds, with every channel
+        following the same curve
+
+        Inputs:
+        See get_curve()
+
+        Outputs:
+        curve - see get_curve()
+        """
+
+        num_frames = max(2, int(round(duration_s * frame_rate)))
+        t = np.linspace(0.0, 1.0, num_frames)
+        values = np.clip(self.shapes[shape](t, **params), 0.0, 100.0)
+        curve = np.repeat(values[:, np.newaxis], channels, axis=1)
+        curve.flags.writeable = False
+        logging.info(f"Built {shape} sunrise curve: {num_frames} frames, {channels} channel(s)")
+        return curve
+
+    def _cache_path(self, key):
+        """
+        Description:
+        Returns the on-disk cache location for the key, or None if the disk cache is off
+
+        Inputs:
+        key - the memoization key from get_curve()
+
+        Outputs:
+        path - string path to the .npy file
+        """
+
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{key[0]}_{digest}.npy")
+
+    def _load(self, key):
+        """
+        Description:
+        Loads a curve from the on-disk cache
+
+        Inputs:
+        key - the memoization key from get_curve()
+
+        Outputs:
+        curve - the cached curve, or None if it was not found
+        """
+
+        path = self._cache_path(key)
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            curve = np.load(path)
+        except (OSError, ValueError):
+            logging.warning("sunrise_curves: unable to read cached curve %s", path)
+            return None
+        curve.flags.writeable = False
+        return curve
+
+    def _save(self, key, curve):
+        """
+        Description:
+        Writes a curve to the on-disk cache. Failures are logged and otherwise ignored.
+
+        Inputs:
+        key - the memoization key from get_curve()
+        curve - the curve to save
+
+        Outputs:
+        None
+        """
+
+        path = self._cache_path(key)
+        if path is None:
+            return
+        try:
+            np.save(path, curve)
+        except OSError:
+            logging.warning("sunrise_curves: unable to write cached curve %s", path)
+
+    @staticmethod
+    def _freeze(params):
+        """
+        Description:
+        Turns the curve parameters into something hashable, so lists from the config
+        (e.g. keyframes) can be part of the memoization key
+
+        Inputs:
+        params - dict of curve parameters
+
+        Outputs:
+        frozen - sorted tuple of (name, value) pairs
+        """
+
+        def freeze_value(value):
+            if isinstance(value, (list, tuple)):
+                return tuple(freeze_value(v) for v in value)
+            return value
+        return tuple(sorted((name, freeze_value(value)) for name, value in params.items()))
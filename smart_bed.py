@@ -53,13 +53,17 @@ from evdev import InputDevice, categorize, ecodes, list_devices
 from collections import deque
 
 #Local Module Imports
-from input_devices.keypad import keypad
+from input_devices.keypad import keypad, keypad_irq
 from input_devices.switch import switch
 from input_devices.toggle_button import toggle_button
 from input_devices.mini_keyboard import mini_keyboard
 from output_devices.sound_blaster import sound_blaster
+from output_devices.music_visualizer import music_visualizer
 from rpi_helpers.device_tracker import device_tracker
+from rpi_helpers.cron_schedule import cron_schedule
 from rpi_helpers.hw_pwm import hw_pwm
+from rpi_helpers.sunrise_curves import sunrise_curves
+from rpi_helpers.realtime import realtime
 
 class smart_bed:
     """
@@ -81,10 +85,46 @@ class smart_bed:
     logfile_filepath = "/home/gabe/.smartbed/smart_bed.log" #Location of the main log file
     cron_alarm_filepath = "/home/gabe/.smartbed/startalarm.start" #Location of the empty file created by cron when the alarm should start
     myphone_ip = "192.168.68.50" #IP of the device you would like to track
+    tracked_devices = {'myphone': myphone_ip} #Name and IP of every device to track, e.g. both sleepers' phones
+    presence_policy = "any" #"any" if one tracked device being home allows the alarm, "all" if every one has to be
+    presence_trailing_hours = 6 #Hours the devices have to have been present for the alarm to go off
+    presence_min_fraction = 1.0 #Fraction of presence_trailing_hours a device has to have been seen, below 1 allows for missed pings
+    presence_history_dir = "/home/gabe/.smartbed/presence" #Location of the presence history files, kept across restarts
+    presence_gate_enabled = False #Disable the alarm when the tracked devices are not present
+    alarm_gate_lead_seconds = 300 #Seconds before the next cron alarm to decide whether it will go off
+    alarm_gate_valid_seconds = 900 #Seconds a precomputed alarm decision is trusted for, unless an input changes
     sunrise_minutes = 15 #Number of minutes for the sun to "rise" before the alarm goes off
+    sunrise_curve = "exponential" #Shape of the sunrise, see rpi_helpers/sunrise_curves.py for the options
+    sunrise_curve_params = {} #Parameters for the sunrise curve, e.g. {'keyframes': [(0, 1), (0.5, 10), (1, 100)]}
+    sunrise_frame_rate = 10 #Number of brightness updates per second during the sunrise
+    curve_cache_dir = "/home/gabe/.smartbed/curve_cache" #Location of the on-disk sunrise curve cache
+    preview_alarm_filepath = "/home/gabe/.smartbed/preview.start" #Create this file to preview the alarm sequence
+    preview_seconds = 60 #Default length of the compressed alarm preview
+    preview_frame_rate = 50 #Number of brightness updates per second during a preview
     alarm_volume = 50 #Volume of the alarm, out of 100
+    alarm_fade_minutes = 5 #Number of minutes at the end of the sunrise over which the alarm fades in from silent, 0 to disable
+    volume_update_hz = 4 #Max number of volume changes per second during the alarm fade-in
+    alarm_warmup_seconds = 120 #Seconds before the alarm sound starts to pre-load it and check the hardware, 0 to disable
     music_dir = "/home/gabe/Music/music_playlist" #Directory of the music to play
     alarm_filepath = "/home/gabe/Music/alarms/soft_naturey_song.mp3" #File location for the alarm song
+    music_library_filepath = "/home/gabe/.smartbed/music_library.json" #Location of the saved index of music_dir
+    prefetch_bytes = None #Bytes of the next song to pre-read while the current one plays, 0 to not pre-read, None for all
+    page_cache_mode = "off" #Keep the alarm file in memory: "off", "fadvise" (page cache hint) or "tmpfs" (pinned RAM copy)
+    prefetch_tracks = 2 #Number of upcoming songs to hint into the page cache when page_cache_mode is not "off"
+    shuffle_window = 3 #Number of upcoming songs kept in the player when shuffling music_dir
+    crossfade_seconds = 3 #Length of the fades between the music and the alarm
+    duck_level = 0.0 #Music level (0-1) while the alarm plays, 0 fades the music out and pauses it
+    mix_update_hz = 20 #Volume updates per second while fading between the music and the alarm
+    vlc_profile = "low_latency" #libVLC option set, see VLC_PROFILES in sound_blaster (run vlc_benchmark.py to compare)
+    audio_output = None #libVLC audio output module, e.g. "alsa". None lets VLC pick
+    visualizer_frame_rate = 50 #LED updates per second in the music visualizer light mode
+    visualizer_unhook_timeout = 0.2 #Longest the main loop waits for the playback worker when the visualizer is turned off
+    alarm_tone = "chime" #Synthesized alarm played if alarm_filepath is missing or broken: "chime", "rising", "pink_noise" or None
+
+    #REALTIME CONFIG VARIABLES
+    realtime_mode = False #Run the sunrise and input threads with realtime priority, lock memory and freeze the GC heap
+    realtime_priority = 50 #SCHED_FIFO priority for the timing critical threads (1-99)
+    realtime_cpus = [3] #CPUs to pin the timing critical threads to, None to not pin them
 
     #GPIO CONFIG VARIABLES
     keypad_gpio_defs = { #Keypad connections to the GPIO
@@ -103,8 +143,13 @@ class smart_bed:
     brightness_step = 1
     volume_step = 1
     mini_keyboard_last_five = deque(maxlen=5)
-    alarm_disable_soft = False
+    _alarm_disable_soft = False
+    _alarm_gate = None
+    _alarm_gate_expiry = 0
+    _next_alarm_time = None
+    _next_alarm_check = 0
     _last_brightness = 50
+    _alarm_fade_started = False
 
     def __init__(self):
         """
@@ -146,16 +191,26 @@ class smart_bed:
         gpio.setwarnings(False)
         gpio.setmode(gpio.BCM)
 
+        #***********************************************
+        #REALTIME SECTION
+        #Only used if realtime_mode is set, each thread logs its scheduling when it applies it
+        thread_init_function = None
+        if self.realtime_mode:
+            self.realtime_handle = realtime(self.realtime_priority, self.realtime_cpus)
+            self.realtime_handle.lock_memory()
+            thread_init_function = self.realtime_handle.enable_thread
+
         #***********************************************
         #CLASS INITIALIZATION
         #Initialize the keypad class
-        #self.keypad_handle = keypad(self.keypad_gpio_defs) #Removed this in favor of the mini_keyboard
+        #self.keypad_handle = keypad(self.keypad_gpio_defs, thread_init_function=thread_init_function) #Removed this in favor of the mini_keyboard
+        #self.keypad_handle = keypad_irq(self.keypad_gpio_defs) #Interrupt driven alternative, no scanning while idle
 
         #Initialize the mini keyboard class
-        self.mini_keyboard_handle = mini_keyboard(self.mini_keyboard_device_name)
+        self.mini_keyboard_handle = mini_keyboard(self.mini_keyboard_device_name, thread_init_function)
 
         #Initialize the smileyface button
-        #self.smiley_handle = toggle_button(self.smiley_button_gpio, self.smiley_button) #Removed this in favor of the mini_keyboard
+        #self.smiley_handle = toggle_button(self.smiley_button_gpio) #Events arrive in smiley_handle.toggle_button_queue. Removed this in favor of the mini_keyboard
 
         #Initialize the switch
         #self.switch1_handle = switch(self.switch1_gpio) #Removed this in favor of the mini_keyboard
@@ -163,16 +218,39 @@ class smart_bed:
         #LED initialization
         self.led_handle = hw_pwm(self.led_gpio)
 
+        #Next alarm time from the crontab, the device tracker probes more often before it
+        self.alarm_schedule = cron_schedule(self.cron_alarm_filepath)
+
         #Cell phone device tracking class
-        self.device_tracker_handle = device_tracker(self.myphone_ip)
+        self.device_tracker_handle = device_tracker(self.tracked_devices, history_dir=self.presence_history_dir,
+                                                   next_alarm_function=self.alarm_schedule.next_time,
+                                                   change_function=self.presence_change)
         #self.device_tracker_handle._debug_force_devicetrack_true()
 
+        #Sunrise curve library, the curve is built now so starting the alarm does no curve math
+        self.curve_handle = sunrise_curves(self.curve_cache_dir)
+        self.curve_handle.get_curve(self.sunrise_curve, self.sunrise_minutes*60, self.sunrise_frame_rate, **self.sunrise_curve_params)
+        self.curve_handle.get_curve(self.sunrise_curve, self.preview_seconds, self.preview_frame_rate, **self.sunrise_curve_params)
+
         #Alarm class
         #self.alarm_handle = alarm_sequence(self.led_handle.set_pwm, self.alarm_activate)
-        self.alarm_handle = alarm_sequence(self.brightness_set, self.alarm_activate)
+        self.alarm_handle = alarm_sequence(self.brightness_set, self.alarm_activate, self.curve_handle, self.volume_set, self.alarm_fade_start,
+                                           self.alarm_warmup, thread_init_function)
 
         #Music class
-        self.music_handle = sound_blaster(self.music_dir, self.alarm_filepath)
+        self.music_handle = sound_blaster(self.music_dir, self.alarm_filepath, self.music_library_filepath, self.prefetch_bytes,
+                                          self.page_cache_mode, self.prefetch_tracks, self.shuffle_window,
+                                          self.alarm_tone, self.crossfade_seconds, self.duck_level, self.mix_update_hz,
+                                          self.vlc_profile, self.audio_output)
+
+        #Music visualizer light mode, toggled with R1C2 on the mini keyboard (a key that isn't in the arm/disarm codes)
+        self.visualizer_handle = music_visualizer(self.music_handle.instance, self.brightness_set, frame_rate=self.visualizer_frame_rate)
+        self.visualizer_active = False
+
+        #Startup is done, measure the jitter improvement and freeze the heap so the GC leaves it alone from now on
+        if self.realtime_mode:
+            self.realtime_handle.log_report()
+            self.realtime_handle.freeze_heap()
 
         self.mainloop()
 
@@ -207,14 +285,16 @@ class smart_bed:
 
             if not self.mini_keyboard_handle.keypad_queue.empty():
                 if self.alarm_handle.is_running():
-                    self.alarm_handle.stop()
+                    self.alarm_cancel()
                 self.button_decode('mini_keyboard', self.mini_keyboard_handle.keypad_queue.get())
 
             #See if we need to ping the cell phone
             # self.device_tracker_handle.update_devicetrack_if_necessary()
 
             #See if we should start the alarm
+            self.update_alarm_gate()
             self.check_alarm()
+            self.check_preview()
             pass
 
     def signal_handler(self):
@@ -258,10 +338,95 @@ class smart_bed:
         time.sleep(0.1)
         self.led_handle.set_pwm(0)
 
+    def alarm_warmup(self):
+        """
+        Description:
+        Kicks off the pre-alarm warm-up in its own thread, so the sunrise
+        timeline isn't held up by it.
+        
+        Usage:
+        The function is forwarded to the alarm controller as a pointer, so it
+        is actually run by the alarm_sequence class
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+        threading.Thread(target=self._alarm_warmup, daemon=True).start()
+
+    def _alarm_warmup(self):
+        """
+        Description:
+        Gets everything ready for the alarm sound a while before it is needed:
+        checks that pigpiod still answers (reconnecting if it doesn't) and has the
+        sound_blaster pre-parse the alarm media and open the audio output at zero
+        volume. Failures are logged now, while there is still time to fall back.
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+        #Started from the sunrise thread, so it would inherit SCHED_FIFO and compete with the light frames
+        if self.realtime_mode:
+            self.realtime_handle.disable_thread("alarm_warmup")
+        logging.info("Alarm warm-up started")
+        if not self.led_handle.is_connected():
+            logging.error("Alarm warm-up: pigpiod is not responding, reconnecting")
+            self.led_handle.init_pwm()
+            if not self.led_handle.is_connected():
+                logging.error("Alarm warm-up: pigpiod still not responding, the lights may not work")
+        if not self.music_handle.prepare_alarm():
+            logging.error("Alarm warm-up: alarm sound could not be prepared, it will be loaded when the alarm starts")
+        logging.info("Alarm warm-up finished")
+
+    def alarm_fade_start(self):
+        """
+        Description:
+        This function starts the alarm sound silently, so the alarm_sequence
+        can fade the volume in along with the lights.
+        
+        Usage:
+        The function is forwarded to the alarm controller as a pointer, so it
+        is actually run by the alarm_sequence class
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+        self._alarm_fade_started = True
+        self.music_handle.play_alarm(volume=0)
+
+    def alarm_cancel(self):
+        """
+        Description:
+        Stops the alarm sequence. If the alarm sound already started fading in,
+        the sound is stopped too.
+        
+        Usage:
+        This is run when a button is pressed during the sunrise
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+        self.alarm_handle.stop()
+        if self._alarm_fade_started:
+            self._alarm_fade_started = False
+            self.music_handle.stop()
+
     def alarm_activate(self):
         """
         Description:
-        This function simply plays the alarm sound.
+        This function plays the alarm sound at full alarm volume. If the fade-in
+        already started the alarm sound, it just makes sure the volume is right.
         
         Usage:
         The function is forwarded to the alarm controller as a pointer, so it
@@ -273,16 +438,115 @@ class smart_bed:
         Outputs:
         None
         """
-        self.volume_set(self.alarm_volume)
-        self.music_handle.play_alarm()
+        if self.music_handle.is_alarm_playing():
+            self.volume_set(self.alarm_volume)
+        else:
+            self.music_handle.play_alarm(volume=self.alarm_volume)
+
+    @property
+    def alarm_disable_soft(self):
+        return self._alarm_disable_soft
+
+    @alarm_disable_soft.setter
+    def alarm_disable_soft(self, disabled):
+        self._alarm_disable_soft = disabled
+        self.invalidate_alarm_gate()
+
+    def presence_change(self, name, present):
+        """
+        Description:
+        Called by the device tracker when a device comes or goes. Throws away the
+        precomputed alarm decision, since it may no longer hold.
+
+        Inputs:
+        name - name of the device
+        present - True if the device came
+
+        Outputs:
+        None
+        """
+
+        self.invalidate_alarm_gate()
+
+    def invalidate_alarm_gate(self):
+        """
+        Description:
+        Throws away the precomputed alarm decision, so it is worked out again
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        self._alarm_gate = None
+
+    def evaluate_alarm_gate(self):
+        """
+        Description:
+        Checks everything that can stop the alarm: the alarm disable switch, the
+        soft disable and whether the IP devices are present.
+
+        Inputs:
+        None
+
+        Outputs:
+        gate - (allowed, reason) where reason says why the alarm is disabled
+        """
+
+        # I removed the alarm disable switch due to only wanting the keypad visible
+        # if self.switch1_handle.get_state(): #There is an inversion here, a short means it reads 0
+        #     return (False, "Alarm switch not enabled, alarm disabled")
+        if self.alarm_disable_soft:
+            return (False, "Soft alarm disable engaged, alarm disabled")
+        if self.presence_gate_enabled and not self.device_tracker_handle.is_device_present(self.presence_trailing_hours,
+                                                                                             self.presence_policy,
+                                                                                             min_fraction=self.presence_min_fraction):
+            return (False, "Device not present, alarm disabled")
+        return (True, None)
+
+    def update_alarm_gate(self):
+        """
+        Description:
+        Works out ahead of time whether the next cron alarm will go off, so
+        check_alarm() doesn't have to. Once the next alarm is less than
+        alarm_gate_lead_seconds away the decision is computed and kept for
+        alarm_gate_valid_seconds, or until an input changes. The next alarm time
+        is looked up at most once a minute.
+
+        Usage:
+        This is run via the main_loop() function, so no user intervention is needed
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        now = time.time()
+        if self._alarm_gate is not None and now < self._alarm_gate_expiry:
+            return
+        if now >= self._next_alarm_check:
+            self._next_alarm_time = self.alarm_schedule.next_time(now)
+            self._next_alarm_check = now + 60
+        if self._next_alarm_time is None or self._next_alarm_time - now > self.alarm_gate_lead_seconds:
+            return
+        self._alarm_gate = self.evaluate_alarm_gate()
+        self._alarm_gate_expiry = now + self.alarm_gate_valid_seconds
+        logging.info(f"Alarm decision for {time.strftime('%H:%M', time.localtime(self._next_alarm_time))} precomputed: "
+                     f"{'go' if self._alarm_gate[0] else self._alarm_gate[1]}")
 
     def check_alarm(self):
         """
         Description:
         This function checks to see if the alarm should be run. First, it checks
-        for the cron_alarm_filepath file. If it exists, it then checks the alarm
-        disable switch. Then, it checks whether the IP device is present. If all
-        these conditions are met, it will run the alarm sequence
+        for the cron_alarm_filepath file. If it exists, it uses the alarm decision
+        precomputed by update_alarm_gate() (the alarm disable switch, the soft
+        disable and whether the IP devices are present), or works it out now if
+        there isn't a valid one. If the alarm is allowed, it will run the alarm
+        sequence
         
         Usage:
         This is run via the main_loop() function, so no user intervention is needed
@@ -297,17 +561,80 @@ class smart_bed:
             #logging.debug("Alarm file not found")
             return
         os.remove(self.cron_alarm_filepath)
-        # I removed the alarm disable switch due to only wanting the keypad visible
-        # if self.switch1_handle.get_state(): #There is an inversion here, a short means it reads 0
-        #     logging.info("Alarm switch not enabled, alarm disabled")
-        #     return
-        if self.alarm_disable_soft:
-            logging.info("Soft alarm disable engaged, alarm disabled")
+        gate = self._alarm_gate
+        if gate is None or time.time() >= self._alarm_gate_expiry:
+            #Nothing precomputed, e.g. the alarm was not in the crontab a few minutes ago
+            gate = self.evaluate_alarm_gate()
+        allowed, reason = gate
+        if not allowed:
+            logging.info(reason)
+            return
+        self.start_sunrise()
+
+    def check_preview(self):
+        """
+        Description:
+        This function checks for the preview_alarm_filepath file. If it exists,
+        it runs the full alarm sequence (lights, volume fade-in, warm-up and
+        alarm sound) compressed into preview_seconds, skipping the alarm
+        disable checks. The file may contain a number of seconds to use
+        instead of preview_seconds, e.g. echo 30 > preview.start
+        
+        Usage:
+        This is run via the main_loop() function, so no user intervention is needed
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+        if not os.path.isfile(self.preview_alarm_filepath):
+            return
+        try:
+            with open(self.preview_alarm_filepath) as preview_file:
+                contents = preview_file.read().strip()
+        except OSError:
+            logging.warning("Unable to read the preview file, using preview_seconds")
+            contents = ""
+        #The file has to go before the preview starts, or it would start again on the next loop
+        try:
+            os.remove(self.preview_alarm_filepath)
+        except OSError:
+            logging.warning("Unable to remove the preview file, skipping the preview")
+            return
+        try:
+            preview_seconds = float(contents) if contents else self.preview_seconds
+        except ValueError:
+            preview_seconds = None
+        if preview_seconds is None or not 0 < preview_seconds < math.inf:
+            logging.warning(f"Invalid preview length {contents!r}, skipping the preview")
             return
-        # if not self.device_tracker_handle.is_device_present():
-        #     logging.info("Device not present, alarm disabled")
-        #     return
-        self.alarm_handle.start_alarm_sequence(self.sunrise_minutes)
+        logging.info(f"Previewing the alarm in {preview_seconds} seconds")
+        self.start_sunrise(preview_seconds)
+
+    def start_sunrise(self, preview_seconds=None):
+        """
+        Description:
+        Starts the alarm sequence with the configured sunrise settings
+        
+        Usage:
+        This is run by check_alarm() and check_preview()
+
+        Inputs:
+        preview_seconds - if set, the whole sequence is compressed into this
+                          many seconds
+
+        Outputs:
+        None
+        """
+        self._alarm_fade_started = False
+        #The sunrise needs the lights to itself
+        if self.visualizer_active:
+            self.visualizer_toggle()
+        self.alarm_handle.start_alarm_sequence(self.sunrise_minutes, self.sunrise_curve, self.sunrise_curve_params, self.sunrise_frame_rate,
+                                               self.alarm_fade_minutes, self.alarm_volume, self.volume_update_hz,
+                                               self.alarm_warmup_seconds, preview_seconds, self.preview_frame_rate)
     
     def smiley_button(self, gpio_num):
         """
@@ -346,16 +673,21 @@ class smart_bed:
         This is run via the main_loop() function, so no user intervention is needed
 
         Inputs:
-        None
+        source - "keypad" or "mini_keyboard"
+        btn - the key name from the mini keyboard, or the (key, event, timestamp)
+              tuple from the keypad. Only keypad 'press' events run a handler.
 
         Outputs:
         None
         """
         if source == "keypad":
-            func_to_call = getattr(self, f'keypad_btn_{btn}')
+            key, event, timestamp = btn
+            if event != 'press':
+                return
+            func_to_call = getattr(self, f'keypad_btn_{key}')
         elif source == "mini_keyboard":
             if self.alarm_handle.is_running():
-                self.alarm_handle.stop()
+                self.alarm_cancel()
                 return
             func_to_call = getattr(self, f'mini_keyboard_{btn}')
             self.mini_keyboard_stack_update(btn)
@@ -437,6 +769,7 @@ class smart_bed:
 
     def mini_keyboard_R1C2(self):
         logging.info("Mini keyboard: R1C2 pressed")
+        self.visualizer_toggle()
         pass
 
     def mini_keyboard_R1C3(self):
@@ -559,6 +892,36 @@ class smart_bed:
             self.led_handle.dutycycle = restore_level
             logging.info(f"Brightness toggled ON (restored {restore_level}%)")
 
+    def visualizer_toggle(self):
+        """
+        Description:
+        Toggle the music visualizer light mode.
+        When turning it on, the lights follow the music that is playing.
+        When turning it off, the brightness from before is restored.
+
+        Inputs:
+        None
+
+        Outputs:
+        None
+        """
+
+        if self.visualizer_active:
+            self.visualizer_active = False
+            #Unhook it first, so a song change already queued can't restart it after the stop.
+            #The wait is short, the main loop must not stall behind a busy playback worker.
+            if not self.music_handle.set_visualizer(None, timeout=self.visualizer_unhook_timeout):
+                logging.warning("Music visualizer: the playback worker is busy, stopping without waiting for it")
+            self.visualizer_handle.stop()
+            self.brightness_set(self._visualizer_saved_brightness)
+            logging.info("Music visualizer OFF")
+        else:
+            self.visualizer_active = True
+            self._visualizer_saved_brightness = self.led_handle.dutycycle
+            self.visualizer_handle.start()
+            self.music_handle.set_visualizer(self.visualizer_handle)
+            logging.info("Music visualizer ON")
+
     def volume_up(self, step=None):
         """
         Description:
@@ -660,7 +1023,7 @@ class alarm_sequence:
     functions, then when required, runs the alarm sequence.
     
     Usage:
-    Instantiate the class, and run run_sequence() when you want the alarm
+    Instantiate the class, and run start_alarm_sequence() when you want the alarm
     sequence to start.
 
     Inputs:
@@ -669,17 +1032,26 @@ class alarm_sequence:
     alarm_finish_function - The pointer to a function to run when the alarm
                             finishes. sound_blaster.play_alarm() is a good
                             suggestion.
+    curve_handle - A sunrise_curves instance that supplies the light curve
+    volume_function - The pointer to a function to set the volume during the
+                      alarm fade-in, sound_blaster.volume for example
+    fade_start_function - The pointer to a function to run when the fade-in
+                          starts, it should start the alarm sound at zero volume
+    warmup_function - The pointer to a function to run a while before the alarm
+                      sound starts, it should get the sound ready and must not block
+    thread_init_function - The pointer to a function to run at the start of the
+                           alarm thread, realtime.enable_thread() for example
 
     Outputs:
     None
     """
 
-    stop_thread = False
     pwm_function = None
     alarm_finish_function = None
     alarm_thread = None
 
-    def __init__(self, pwm_function, alarm_finish_function):
+    def __init__(self, pwm_function, alarm_finish_function, curve_handle, volume_function=None, fade_start_function=None,
+                 warmup_function=None, thread_init_function=None):
         """
         Description:
         Initialization of the alarm_sequence class
@@ -687,6 +1059,11 @@ class alarm_sequence:
         Inputs:
         pwm_function - See class description
         alarm_finish_function - See class description
+        curve_handle - See class description
+        volume_function - See class description
+        fade_start_function - See class description
+        warmup_function - See class description
+        thread_init_function - See class description
 
         Outputs:
         None
@@ -694,6 +1071,12 @@ class alarm_sequence:
 
         self.pwm_function = pwm_function
         self.alarm_finish_function = alarm_finish_function
+        self.curve_handle = curve_handle
+        self.volume_function = volume_function
+        self.fade_start_function = fade_start_function
+        self.warmup_function = warmup_function
+        self.thread_init_function = thread_init_function
+        self.stop_event = threading.Event()
         logging.info("Alarm sequence initialized")
 
     def __del__(self):
@@ -710,50 +1093,136 @@ class alarm_sequence:
 
         self.stop()
 
-    def _alarm_sequence(self, sunrise_minutes):
+    def _wait_until(self, deadline):
         """
         Description:
-        Function to run the alarm sequence. Will slowly ramp up
-        the LED intensity over the sunrise_minutes time frame,
-        then it will run the alarm_finish_function
+        Sleeps until the given time.monotonic() deadline, waking up immediately
+        if stop() is called
         
         Inputs:
-        sunrise_minutes - number of minutes over which to ramp
-                          the LED intensity
+        deadline - time.monotonic() value to sleep until
+
+        Outputs:
+        True if the sequence was stopped, False if the deadline was reached
+        """
+
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            return self.stop_event.wait(remaining)
+        return self.stop_event.is_set()
+
+    def _build_timeline(self, curve, frame_rate, fade_seconds, target_volume, volume_update_hz, warmup_seconds):
+        """
+        Description:
+        Builds the alarm timeline: the warm-up, the fade-in start and every volume
+        change, sorted by time. The light frames are not copied into it, they are
+        read straight from the cached curve, and _alarm_sequence() walks the two
+        in step, so the lights and the sound run off the same clock without
+        thousands of frame events being built and sorted for every alarm. Volume
+        steps are limited to volume_update_hz and only the steps where the
+        whole-number volume changes are kept, so VLC isn't called every frame.
+        
+        Inputs:
+        curve - array of pwm values from sunrise_curves.get_curve()
+        frame_rate - number of curve frames per second
+        fade_seconds - length of the fade-in at the end of the sunrise, 0 for none
+        target_volume - volume at the end of the fade-in
+        volume_update_hz - max number of volume changes per second
+        warmup_seconds - how long before the alarm sound starts to run the warm-up
+
+        Outputs:
+        events - list of (seconds_from_start, order, function, argument)
+        sunrise_seconds - total length of the sunrise
+        """
+
+        if not frame_rate > 0:
+            raise ValueError(f"Sunrise frame rate must be more than 0, not {frame_rate}")
+        sunrise_seconds = len(curve)/frame_rate
+        events = []
+
+        fade_seconds = min(fade_seconds, sunrise_seconds)
+        sound_start = sunrise_seconds
+        if fade_seconds > 0 and self.volume_function is not None and self.fade_start_function is not None:
+            fade_start = sunrise_seconds - fade_seconds
+            sound_start = fade_start
+            events.append((fade_start, 2, self.fade_start_function, None))
+            num_steps = max(1, int(fade_seconds*volume_update_hz))
+            step_times = fade_start + np.arange(1, num_steps + 1)*(fade_seconds/num_steps)
+            step_volumes = np.rint(np.linspace(0, target_volume, num_steps + 1)[1:]).astype(int)
+            changed = np.diff(step_volumes, prepend=0) != 0
+            events.extend((t, 3, self.volume_function, int(v))
+                          for t, v in zip(step_times[changed], step_volumes[changed]))
+
+        if warmup_seconds > 0 and self.warmup_function is not None:
+            events.append((max(0.0, sound_start - warmup_seconds), 1, self.warmup_function, None))
+
+        #Only a few hundred audio events at most
+        events.sort(key=lambda event: (event[0], event[1]))
+        return events, sunrise_seconds
+
+    def _alarm_sequence(self, curve, frame_rate, events, sunrise_seconds):
+        """
+        Description:
+        Function to run the alarm sequence. Runs every light frame of the curve
+        and every event from _build_timeline() at its time, slowly ramping up the
+        LED intensity (and the volume if there is a fade-in), then it will run the
+        alarm_finish_function. A light frame goes before an event at the same time.
+        
+        Inputs:
+        curve - array of pwm values from sunrise_curves.get_curve()
+        frame_rate - number of curve frames per second
+        events - list of events from _build_timeline()
+        sunrise_seconds - total length of the sunrise
 
         Outputs:
         None
         """
 
         logging.debug("Running alarm sequence")
-
-        #Break the sleep times into parts to only sleep for max 1 second
-        #This makes it so we can stop the thread quickly
-        total_seconds = sunrise_minutes*60
-        time_step = total_seconds/100
-        time_step_int = int(math.floor(time_step))
-        time_step_remainder = time_step - time_step_int
-
-        #Exponential rise because pwm works better that way
-        #pwm_values = range(1,101) #old linear
-        pwm_values = np.exp(np.linspace(0, np.log(100), 100))
-        for pwm_value in pwm_values:
-            logging.debug(f"Setting PWM to {pwm_value}")
-            self.pwm_function(pwm_value)
-
-            for i in range(time_step_int):
-                if self.stop_thread:
+        if self.thread_init_function is not None:
+            self.thread_init_function("sunrise")
+
+        #Every event is scheduled against the start time, so the sleeps don't
+        #drift no matter how long the functions take. If the thread falls
+        #behind, light frames that are already out of date are skipped
+        #instead of being played back in a burst.
+        frame_values = curve[:, 0]
+        num_frames = len(frame_values)
+        num_events = len(events)
+        frame_period = 1.0/frame_rate
+        frame_num = 0
+        event_num = 0
+        start_time = time.monotonic()
+        while frame_num < num_frames or event_num < num_events:
+            frame_time = frame_num*frame_period if frame_num < num_frames else math.inf
+            if event_num < num_events and events[event_num][0] < frame_time:
+                event_time, _, function, argument = events[event_num]
+                event_num += 1
+                if self._wait_until(start_time + event_time):
                     return
-                time.sleep(1)
+                if argument is None:
+                    function()
+                else:
+                    function(argument)
+                continue
 
-            if self.stop_thread:
+            if self._wait_until(start_time + frame_time):
                 return
-
-            time.sleep(time_step_remainder)
-
+            frame_num += 1
+            if frame_num < num_frames:
+                next_frame_time = frame_num*frame_period
+                next_is_frame = event_num >= num_events or events[event_num][0] >= next_frame_time
+                if next_is_frame and time.monotonic() >= start_time + next_frame_time:
+                    continue
+            self.pwm_function(frame_values[frame_num - 1])
+
+        if self._wait_until(start_time + sunrise_seconds):
+            return
         self.alarm_finish_function()
 
-    def start_alarm_sequence(self, sunrise_minutes=15):
+    def start_alarm_sequence(self, sunrise_minutes=15, curve_shape="exponential", curve_params=None, frame_rate=10,
+                             fade_minutes=0, target_volume=50, volume_update_hz=4, warmup_seconds=0,
+                             preview_seconds=None, preview_frame_rate=50):
         """
         Description:
         Function to kick off the alarm sequence. Is just a wrapper
@@ -762,18 +1231,47 @@ class alarm_sequence:
         Inputs:
         sunrise_minutes - number of minutes over which to ramp
                           the LED intensity
+        curve_shape - name of the sunrise curve, see sunrise_curves
+        curve_params - dict of parameters for the sunrise curve
+        frame_rate - number of brightness updates per second
+        fade_minutes - number of minutes at the end of the sunrise over
+                       which the volume ramps from 0 to target_volume
+        target_volume - volume at the end of the fade-in
+        volume_update_hz - max number of volume changes per second
+        warmup_seconds - how long before the alarm sound starts to run
+                         the warm-up
+        preview_seconds - if set, the same timeline is compressed into this
+                          many seconds, for trying out the settings
+        preview_frame_rate - number of brightness updates per second in
+                             a preview
 
         Outputs:
         None
         """
 
-        self.stop_thread = False
         if self.alarm_thread != None:
             if self.alarm_thread.is_alive():
                 logging.warning(f"Alarm start was triggered, but the alarm thread is already running")
                 return
+        self.stop_event.clear()
+        sunrise_seconds = sunrise_minutes*60
+        fade_seconds = fade_minutes*60
+        if preview_seconds is not None:
+            if not preview_seconds > 0:
+                raise ValueError(f"Preview length must be more than 0 seconds, not {preview_seconds}")
+            #Everything is scaled by the same factor, only the frame rate is raised
+            #so the compressed curve is still smooth
+            time_scale = preview_seconds/sunrise_seconds
+            sunrise_seconds = preview_seconds
+            fade_seconds *= time_scale
+            warmup_seconds *= time_scale
+            frame_rate = preview_frame_rate
+        curve = self.curve_handle.get_curve(curve_shape, sunrise_seconds, frame_rate, **(curve_params or {}))
+        events, sunrise_seconds = self._build_timeline(curve, frame_rate, fade_seconds, target_volume, volume_update_hz,
+                                                          warmup_seconds)
         logging.info(f"Started the alarm sequence thread")
-        self.alarm_thread = threading.Thread(target=self._alarm_sequence, args=(sunrise_minutes,))
+        self.alarm_thread = threading.Thread(target=self._alarm_sequence,
+                                             args=(curve, frame_rate, events, sunrise_seconds))
         self.alarm_thread.start()
 
     def stop(self):
@@ -788,7 +1286,7 @@ class alarm_sequence:
         None
         """
 
-        self.stop_thread = True
+        self.stop_event.set()
 
     def is_running(self):
         """
@@ -0,0 +1,74 @@
+import vlc
+import time
+import threading
+import statistics
+from output_devices.sound_blaster import VLC_PROFILES, vlc_options
+
+#Compares the libVLC instance profiles in sound_blaster.
+#For each profile it measures:
+#  instance - time to create the vlc.Instance
+#  playing - time from play() until the player reports Playing (MediaPlayerPlaying event)
+#  vol_call - time for audio_set_volume() plus an audio_get_volume() that reads the new value.
+#             This is only the libVLC call round-trip, not when the change is heard: the
+#             samples already in the audio output buffer still play at the old volume.
+#Run it on the Rpi with the audio output the smart bed uses:
+#  python3 vlc_benchmark.py
+
+sound_filepath = '/home/gabe/Music/alarms/mixkit-battleship-alarm-1001.mp3'
+audio_output = None #e.g. 'alsa'
+runs = 5
+
+def time_to_playing(instance, file_path, timeout=5):
+    player = instance.media_player_new()
+    player.set_media(instance.media_new(file_path))
+    playing = threading.Event()
+    player.event_manager().event_attach(vlc.EventType.MediaPlayerPlaying, lambda event: playing.set())
+    start = time.perf_counter()
+    player.play()
+    if not playing.wait(timeout):
+        player.stop()
+        player.release()
+        return None, None
+    elapsed = time.perf_counter() - start
+    return player, elapsed
+
+def volume_call_time(player, volume, timeout=1):
+    start = time.perf_counter()
+    player.audio_set_volume(volume)
+    while player.audio_get_volume() != volume:
+        if time.perf_counter() - start > timeout:
+            return None
+        time.sleep(0.0005)
+    return time.perf_counter() - start
+
+def benchmark(profile):
+    results = {'instance': [], 'playing': [], 'vol_call': []}
+    for run in range(runs):
+        start = time.perf_counter()
+        instance = vlc.Instance(vlc_options(profile, audio_output))
+        results['instance'].append(time.perf_counter() - start)
+
+        player, elapsed = time_to_playing(instance, sound_filepath)
+        if player is None:
+            print(f"{profile}: run {run} never reached Playing")
+            instance.release()
+            continue
+        results['playing'].append(elapsed)
+        for volume in (20, 60, 40):
+            call_time = volume_call_time(player, volume)
+            if call_time is not None:
+                results['vol_call'].append(call_time)
+        player.stop()
+        player.release()
+        instance.release()
+    return results
+
+if __name__ == "__main__":
+    print(f"{'profile':<14}{'measure':<10}{'median ms':>10}{'max ms':>10}")
+    for profile in VLC_PROFILES:
+        results = benchmark(profile)
+        for measure, values in results.items():
+            if not values:
+                print(f"{profile:<14}{measure:<10}{'n/a':>10}{'n/a':>10}")
+                continue
+            print(f"{profile:<14}{measure:<10}{statistics.median(values)*1000:>10.1f}{max(values)*1000:>10.1f}")